@@ -0,0 +1,595 @@
+# Copyright 2018 Pedro Cuadra - pjcuadra@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from dataset_manifest import refresh_manifest, supported_img
+from options import getopts
+from sys import argv
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Benchmarks of the tools over the data sets of the repository
+#
+# Every benchmark runs in its own interpreter so that its peak memory isn't
+# mixed up with the others' and the modules it imports are loaded fresh. A
+# benchmark is set up first, e.g. by copying its data set to a work
+# directory, then run once as warm up and `repeat` times timed. Fast
+# benchmarks are looped so that each timed run lasts at least `min_time`
+# seconds, short runs are too noisy to compare. The median time of a single
+# run is reported along with the items (frames, files or pairs) and bytes
+# processed per second. The modules benchmarked are only imported by their
+# benchmark.
+#
+# Results are written as JSON;
+#
+#   {"version": 1, "python": ..., "platform": ..., "cpus": ...,
+#    "repeat": 5,
+#    "benchmarks": {"<name>": {"seconds": ..., "runs": [...],
+#                              "loops": ..., "items": ...,
+#                              "unit": "frames",
+#                              "bytes": ..., "items_per_s": ...,
+#                              "mb_per_s": ..., "peak_rss_mb": ...}}}
+#
+# Benchmarks that couldn't run, or had nothing to process, hold an "error"
+# message instead. A benchmark that fails, or is missing, while it ran in
+# the baseline is a regression.
+#
+# The images and log of `data/process_data` are stored with Git LFS. If only
+# their pointer files were fetched a synthetic data set of the same camera
+# and a synthetic log are benchmarked instead, see synthetic_scenes.py and
+# synthetic_log.py, and the result is marked as "synthetic".
+
+results_version = 1
+default_threshold = 0.1
+default_repeat = 5
+min_time = 0.2
+
+# Sets of points compared against each other by compare_coords_sets
+compare_points = 200
+
+# Frames of the log generated by synthetic_log for process_log_synthetic
+synthetic_log_frames = 20000
+
+# Frames of the data set and log generated in place of Git LFS stubs
+synthetic_frames = 24
+
+# Camera distances in meters for the whole board to fit the narrow field of
+# view of the HoloLens
+synthetic_distance = (1.0, 1.6)
+
+lfs_pointer = b'version https://git-lfs.github.com/spec/v1'
+
+
+def get_data_paths(data_path):
+    """Get the paths of the data sets and calibrations used"""
+    calibration = os.path.join(data_path, 'calibration')
+
+    return {
+        'process_data': os.path.join(data_path, 'process_data'),
+        'log': os.path.join(data_path, 'process_data', 'data.log'),
+        'hololens': os.path.join(calibration, 'hololens', 'hololens1',
+                                 'hololens1.yml'),
+        'original': os.path.join(data_path, 'original'),
+        'circles_distance': os.path.join(data_path, 'circles_distance'),
+        'iphone': os.path.join(calibration, 'iphone5s', 'camera.yml')}
+
+
+def list_images(in_path):
+    manifest = refresh_manifest(in_path, save=False)
+
+    return sorted(os.path.join(in_path, filename)
+                  for filename, info in manifest.items()
+                  if info['type'] in supported_img)
+
+
+def get_size(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+
+def is_lfs_stub(path):
+    """Check if a file is a Git LFS pointer instead of its content"""
+    with open(path, 'rb') as f:
+        return f.read(len(lfs_pointer)) == lfs_pointer
+
+
+def has_lfs_stubs(in_path):
+    return any(is_lfs_stub(os.path.join(in_path, filename))
+               for filename in os.listdir(in_path)
+               if os.path.isfile(os.path.join(in_path, filename)))
+
+
+def get_log(paths, work_path):
+    """Get the process_data log, a synthetic one if it's a Git LFS stub"""
+    if not is_lfs_stub(paths['log']):
+        return paths['log']
+
+    import synthetic_log
+
+    log_path = os.path.join(work_path, 'data.log')
+
+    logging.warning('{} is a Git LFS stub, using a synthetic log'.format(
+        paths['log']))
+    synthetic_log.generate_log(log_path, {'frames': synthetic_frames,
+                                          'dropped': 0.0})
+
+    return log_path
+
+
+def copy_data_set(in_path, work_path):
+    """Copy a data set without the outputs of a previous run"""
+    out_path = os.path.join(work_path, os.path.basename(in_path))
+
+    shutil.copytree(in_path, out_path,
+                    ignore=shutil.ignore_patterns('augmented', 'coords',
+                                                  'stats', 'manifest.json'))
+
+    return out_path
+
+
+def prepare_data_set(paths, work_path):
+    """Copy the process_data data set and process its images and log"""
+    import process_data_set
+    import process_log
+
+    in_path = get_process_data(paths, work_path)
+
+    process_data_set.process_data_set(in_path, paths['hololens'])
+    process_log.process_log(get_log(paths, work_path), in_path)
+
+    return in_path
+
+
+def get_process_data(paths, work_path):
+    """
+    Copy the process_data data set to the work directory
+
+    A synthetic data set of the same camera is generated instead if the
+    images are Git LFS stubs.
+    """
+    if not has_lfs_stubs(paths['process_data']):
+        return copy_data_set(paths['process_data'], work_path)
+
+    import synthetic_scenes
+
+    out_path = os.path.join(work_path,
+                            os.path.basename(paths['process_data']))
+
+    logging.warning('{} holds Git LFS stubs, using a synthetic data '
+                    'set'.format(paths['process_data']))
+    synthetic_scenes.generate_scenes(paths['hololens'], out_path,
+                                     {'frames': synthetic_frames,
+                                      'distance': synthetic_distance})
+
+    return out_path
+
+
+def is_synthetic(paths):
+    return is_lfs_stub(paths['log']) or has_lfs_stubs(paths['process_data'])
+
+
+def setup_get_coordinates(paths, work_path):
+    from get_shared_coord import get_coordinates
+
+    images = list_images(paths['original'])
+
+    def run():
+        for img_path in images:
+            get_coordinates(img_path, paths['iphone'])
+
+    return run, len(images), 'frames', get_size(images)
+
+
+def setup_process_data_set(paths, work_path):
+    import process_data_set
+
+    in_path = get_process_data(paths, work_path)
+    images = list_images(in_path)
+
+    def run():
+        process_data_set.process_data_set(in_path, paths['hololens'],
+                                          force=True)
+
+    return run, len(images), 'frames', get_size(images)
+
+
+def setup_process_log(paths, work_path):
+    import process_log
+
+    log_path = get_log(paths, work_path)
+    parsed = process_log.parse_log(log_path)
+
+    if parsed is None:
+        raise ValueError('Empty log ' + log_path)
+
+    def run():
+        process_log.parse_log(log_path)
+
+    return run, len(parsed[0]), 'frames', get_size([log_path])
+
+
+def setup_process_log_synthetic(paths, work_path):
+    import process_log
+    import synthetic_log
+
+    log_path = os.path.join(work_path, 'synthetic.log')
+    frames, size = synthetic_log.generate_log(
+        log_path, {'frames': synthetic_log_frames, 'noise': 0.1})
+
+    def run():
+        process_log.parse_log(log_path)
+
+    return run, frames, 'frames', size
+
+
+def setup_calc_stats(paths, work_path):
+    import calc_stats
+
+    in_path = prepare_data_set(paths, work_path)
+    out_path = os.path.join(work_path, 'stats')
+
+    files = list()
+    for sub_dir, file_append in (('hl_dl', '_camera.json'),
+                                 ('hl_rc', '_dl_coords.json'),
+                                 ('marker', '_marker.json')):
+        files += calc_stats.get_coords_files(in_path, sub_dir, file_append)
+
+    def run():
+        calc_stats.calc_stats(in_path, out_path)
+
+    return run, len(files), 'files', get_size(files)
+
+
+def setup_compare_coords_sets(paths, work_path):
+    import calc_stats
+    from compare_perspective_stats import compare_coords_sets
+
+    in_path = prepare_data_set(paths, work_path)
+    stats = calc_stats.get_marker_stats(
+        calc_stats.load_coords_files(in_path, 'marker', '_marker.json'))
+
+    points = list()
+    for key in sorted(stats):
+        points += stats[key]['all']
+
+    if not points:
+        raise ValueError('No marker coordinates in ' + in_path)
+
+    # Repeat the points of the data set to get a measurable workload
+    points = (points * (compare_points // len(points) + 1))[:compare_points]
+
+    def run():
+        compare_coords_sets(points, points)
+
+    return (run, len(points) * len(points), 'pairs',
+            len(json.dumps(points)))
+
+
+def setup_circles_distance(paths, work_path):
+    from circles_distance import circles_distance
+    from get_shared_coord import get_coordinates
+
+    # circles_distance needs the marker to be found
+    images = [img_path
+              for img_path in list_images(paths['circles_distance'])
+              if get_coordinates(img_path, paths['iphone'])[0] is not None]
+
+    if not images:
+        raise ValueError('No marker found in ' + paths['circles_distance'])
+
+    def run():
+        for img_path in images:
+            circles_distance(img_path, None, paths['iphone'])
+
+    return run, len(images), 'frames', get_size(images)
+
+
+benchmarks = {'get_coordinates': setup_get_coordinates,
+              'process_data_set': setup_process_data_set,
+              'process_log': setup_process_log,
+              'process_log_synthetic': setup_process_log_synthetic,
+              'calc_stats': setup_calc_stats,
+              'compare_coords_sets': setup_compare_coords_sets,
+              'circles_distance': setup_circles_distance}
+
+# Benchmarks of the Git LFS data, see get_process_data and get_log
+synthetic_benchmarks = ['process_data_set', 'process_log', 'calc_stats',
+                        'compare_coords_sets']
+
+benchmark_order = ['get_coordinates', 'process_data_set', 'process_log',
+                   'process_log_synthetic', 'calc_stats',
+                   'compare_coords_sets', 'circles_distance']
+
+
+def get_peak_rss():
+    """Get the peak resident memory of this process and its children in MB"""
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    # Kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return peak / float(1 << 20)
+
+    return peak / 1024.0
+
+
+def get_median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+
+    if len(values) % 2:
+        return values[middle]
+
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def run_benchmark(name, data_path, repeat=default_repeat):
+    """Set up and time a benchmark in this process"""
+    paths = get_data_paths(data_path)
+    work_path = tempfile.mkdtemp(prefix='benchmark_')
+
+    try:
+        run, items, unit, size = benchmarks[name](paths, work_path)
+
+        if not items:
+            raise ValueError('No {} to benchmark'.format(unit))
+
+        # Warm up
+        start = time.perf_counter()
+        run()
+        loops = max(1, int(min_time / (time.perf_counter() - start)))
+
+        runs = list()
+        for i in range(repeat):
+            start = time.perf_counter()
+            for j in range(loops):
+                run()
+            runs.append((time.perf_counter() - start) / loops)
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    seconds = get_median(runs)
+
+    return {'synthetic': (name in synthetic_benchmarks and
+                          is_synthetic(paths)),
+            'seconds': seconds,
+            'runs': runs,
+            'loops': loops,
+            'items': items,
+            'unit': unit,
+            'bytes': size,
+            'items_per_s': items / seconds,
+            'mb_per_s': size / seconds / 1e6,
+            'peak_rss_mb': get_peak_rss()}
+
+
+def run_benchmark_process(name, data_path, repeat=default_repeat):
+    """Run a benchmark in its own interpreter"""
+    fd, result_path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+
+    try:
+        ret = subprocess.call([sys.executable,
+                               os.path.abspath(__file__),
+                               '--single', name,
+                               '-d', data_path,
+                               '-n', str(repeat),
+                               '--result', result_path])
+
+        if os.path.getsize(result_path) > 0:
+            with open(result_path) as f:
+                result = json.loads(f.read())
+
+            if ret == 0 or 'error' in result:
+                return result
+
+        return {'error': 'Benchmark exited with {}'.format(ret)}
+    finally:
+        os.remove(result_path)
+
+
+def run_benchmarks(names, data_path, repeat=default_repeat):
+    results = {'version': results_version,
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'cpus': os.cpu_count(),
+               'repeat': repeat,
+               'benchmarks': dict()}
+
+    for name in names:
+        logging.info('Running ' + name)
+        results['benchmarks'][name] = run_benchmark_process(name,
+                                                            data_path,
+                                                            repeat)
+
+    return results
+
+
+def print_results(results):
+    print('{:<22}{:>10}{:>8}{:>7}{:>12}{:>10}{:>10}'.format(
+        'benchmark', 'time [s]', 'items', 'unit', 'items/s', 'MB/s',
+        'RSS [MB]'))
+
+    for name, result in sorted(results['benchmarks'].items(),
+                               key=lambda item: order_key(item[0])):
+        if 'error' in result:
+            print('{:<22}{}'.format(name, result['error']))
+            continue
+
+        print('{:<22}{:>10.4f}{:>8}{:>7}{:>12.1f}{:>10.2f}{:>10.1f}{}'.format(
+            name, result['seconds'], result['items'], result['unit'],
+            result['items_per_s'], result['mb_per_s'],
+            result['peak_rss_mb'],
+            '  synthetic' if result.get('synthetic') else ''))
+
+
+def order_key(name):
+    if name in benchmark_order:
+        return benchmark_order.index(name), name
+
+    return len(benchmark_order), name
+
+
+def compare_results(baseline, results, threshold=default_threshold):
+    """
+    Compare results against a baseline
+
+    A benchmark regressed if its median time or peak memory grew by more
+    than `threshold` (0.1 is 10%), or if it fails or is missing while it
+    ran in the baseline. Returns the changes by benchmark name and the
+    names of the regressed ones. Changes of benchmarks that can't be
+    compared hold a "status" instead of the time and memory growth.
+    """
+    changes = dict()
+    regressions = list()
+
+    for name, base in baseline['benchmarks'].items():
+        if name not in results['benchmarks'] and 'error' not in base:
+            changes[name] = {'status': 'missing'}
+            regressions.append(name)
+
+    for name, result in results['benchmarks'].items():
+        base = baseline['benchmarks'].get(name)
+
+        if base is None:
+            changes[name] = {'status': 'new'}
+            continue
+
+        if 'error' in result:
+            if 'error' in base:
+                changes[name] = {'status': 'failing'}
+            else:
+                changes[name] = {'status': 'failed: ' + result['error']}
+                regressions.append(name)
+            continue
+
+        if 'error' in base:
+            changes[name] = {'status': 'fixed'}
+            continue
+
+        if base.get('synthetic', False) != result.get('synthetic', False):
+            changes[name] = {'status': 'data changed'}
+            continue
+
+        change = {'time': result['seconds'] / base['seconds'] - 1,
+                  'rss': result['peak_rss_mb'] / base['peak_rss_mb'] - 1}
+        changes[name] = change
+
+        if change['time'] > threshold or change['rss'] > threshold:
+            regressions.append(name)
+
+    return changes, regressions
+
+
+def print_comparison(changes, regressions):
+    print('{:<22}{:>10}{:>10}'.format('benchmark', 'time', 'RSS'))
+
+    for name in sorted(changes, key=order_key):
+        if 'status' in changes[name]:
+            print('{:<22}{}{}'.format(
+                name, changes[name]['status'],
+                '  REGRESSION' if name in regressions else ''))
+            continue
+
+        print('{:<22}{:>+10.1%}{:>+10.1%}{}'.format(
+            name, changes[name]['time'], changes[name]['rss'],
+            '  REGRESSION' if name in regressions else ''))
+
+
+def load_results(results_path):
+    with open(results_path) as f:
+        return json.loads(f.read())
+
+
+if __name__ == '__main__':
+    myargs = getopts(argv)
+    data_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'data')
+    names = benchmark_order
+    repeat = default_repeat
+    threshold = default_threshold
+    results = None
+
+    if '-v' in myargs:
+        logging.basicConfig(level=logging.INFO)
+
+    if '-d' in myargs:
+        data_path = myargs['-d']
+
+    if '-n' in myargs:
+        repeat = int(myargs['-n'])
+
+    if '-t' in myargs:
+        threshold = float(myargs['-t'])
+
+    if '--single' in myargs:
+        ret = 0
+
+        try:
+            result = run_benchmark(myargs['--single'], data_path, repeat)
+        except Exception as e:
+            logging.exception('Benchmark {} failed'.format(
+                myargs['--single']))
+            result = {'error': '{}: {}'.format(type(e).__name__, e)}
+            ret = -1
+
+        with open(myargs['--result'], 'w') as f:
+            json.dump(result, f)
+
+        exit(ret)
+
+    if '-b' in myargs:
+        names = myargs['-b'].split(',')
+
+        for name in names:
+            if name not in benchmarks:
+                logging.error('Unknown benchmark ' + name)
+                exit(-1)
+
+    if '-i' in myargs:
+        results = load_results(myargs['-i'])
+    else:
+        results = run_benchmarks(names, data_path, repeat)
+
+    print_results(results)
+
+    if '-o' in myargs:
+        with open(myargs['-o'], 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if '--compare' in myargs:
+        baseline = load_results(myargs['--compare'])
+
+        if '-b' in myargs:
+            # Only the benchmarks asked for can be missing
+            baseline['benchmarks'] = {
+                name: result
+                for name, result in baseline['benchmarks'].items()
+                if name in names}
+
+        changes, regressions = compare_results(baseline, results, threshold)
+
+        print('')
+        print_comparison(changes, regressions)
+
+        if regressions:
+            logging.error('{} regressed'.format(', '.join(regressions)))
+            exit(-1)
+
+    exit(0)
@@ -11,11 +11,13 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from options import getopts
 from sys import argv
 import logging
 import json
+import math
 import os
-import numpy as np
+import tracing
 # import re
 
 
@@ -23,36 +25,118 @@ detected_obj = dict()
 
 supported_img = ["jpeg", "png"]
 
+manifest_file = "manifest.json"
 
-def getopts(argv):
-    opts = {}  # Empty dictionary to store key-value pairs.
-    while argv:  # While there are arguments left to parse...
-        if argv[0][0] is '-':  # Found a "-name value" pair.
-            if len(argv) > 1:
-                if argv[1][0] != '-':
-                    opts[argv[0]] = argv[1]
-                else:
-                    opts[argv[0]] = True
-            elif len(argv) == 1:
-                opts[argv[0]] = True
 
-        # Reduce the argument list by copying it starting from index 1.
-        argv = argv[1:]
-    return opts
+# The statistics are computed without NumPy so that calc_stats starts fast
+# enough to be run in loops, importing NumPy takes longer than the whole
+# run on a data set. The values are reduced in the same order NumPy reduces
+# the first axis, so the results are the same to the last bit.
 
 
-def xyz_to_numpy(xyz):
-    return np.array([xyz['x'], xyz['y'], xyz['z']])
+def to_floats(values):
+    """Convert nested lists of numbers to floats, as NumPy arrays do"""
+    if isinstance(values, list):
+        return [to_floats(value) for value in values]
 
+    return float(values)
 
-def uvd_to_numpy(uvd):
-    return np.array([uvd['u'], uvd['v'], uvd['depth']])
 
+def xyz_to_list(xyz):
+    return to_floats([xyz['x'], xyz['y'], xyz['z']])
 
-def calc_hl_dl_stats(in_path, out_path):
-    hl_dl_in_path = os.path.join(in_path, 'coords', 'hl_dl')
-    stats_out_path = os.path.join(out_path, 'hl_dl.json')
 
+def uvd_to_list(uvd):
+    return to_floats([uvd['u'], uvd['v'], uvd['depth']])
+
+
+def reduce_axis(values, func):
+    """Reduce equally shaped nested lists element wise"""
+    if isinstance(values[0], list):
+        return [reduce_axis([value[i] for value in values], func)
+                for i in range(len(values[0]))]
+
+    return func(values)
+
+
+def get_mean(values):
+    total = values[0]
+    for value in values[1:]:
+        total += value
+
+    return total / len(values)
+
+
+def get_std_dev(values):
+    mean = get_mean(values)
+
+    return math.sqrt(get_mean([(value - mean) * (value - mean)
+                               for value in values]))
+
+
+def get_axis_stats(values):
+    """Get the mean, standard deviation, max and min of a list of points"""
+    return {"mean": reduce_axis(values, get_mean),
+            "std_dev": reduce_axis(values, get_std_dev),
+            "max": reduce_axis(values, max),
+            "min": reduce_axis(values, min)}
+
+
+def get_manifest(in_path):
+    """Get the manifest of a position directory, if there is any"""
+    manifest_path = os.path.join(in_path, manifest_file)
+
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path) as f:
+        return json.loads(f.read())
+
+
+def get_coords_files(in_path, sub_dir, file_append):
+    """
+    List the coordinates files of a data set
+
+    If the data set was separated with a manifest the files are listed from
+    the source data set, otherwise from the `coords` directory itself.
+    """
+    manifest = get_manifest(in_path)
+
+    if manifest is None:
+        coords_in_path = os.path.join(in_path, 'coords', sub_dir)
+        return [os.path.join(coords_in_path, filename)
+                for filename in os.listdir(coords_in_path)
+                if filename.endswith(file_append)]
+
+    coords_in_path = os.path.join(manifest['source'], 'coords', sub_dir)
+    files = list()
+
+    for pic in manifest['pictures']:
+        filename, _ = os.path.splitext(pic)
+        coords_file = os.path.join(coords_in_path, filename + file_append)
+
+        if os.path.exists(coords_file):
+            files.append(coords_file)
+
+    return files
+
+
+def load_coords_files(in_path, sub_dir, file_append):
+    """Load the coordinates files of a data set"""
+    records = list()
+
+    for coords_file in get_coords_files(in_path, sub_dir, file_append):
+        logging.debug('Analyzing {}'.format(coords_file))
+
+        with tracing.span('load', path=coords_file):
+            with open(coords_file) as f:
+                records.append(json.loads(f.read()))
+
+    return records
+
+
+def get_hl_dl_stats(records):
+    """Get the statistics of the hl_dl coordinates of a set of frames"""
     pos = dict()
     pos['lettuce'] = list()
     pos['ham'] = list()
@@ -66,86 +150,68 @@ def calc_hl_dl_stats(in_path, out_path):
     pos['ham_homo'] = list()
     pos['bread_homo'] = list()
 
-    for filename in os.listdir(hl_dl_in_path):
-        hl_dl_in_path_full = os.path.join(hl_dl_in_path, filename)
-        logging.debug('Analyzing {}'.format(hl_dl_in_path_full))
-
-        with open(hl_dl_in_path_full) as f:
-            json_data = json.loads(f.read())
+    json_data = dict()
 
+    for json_data in records:
         for key, val in json_data.items():
             logging.debug('Gathering {} - {}'.format(key, val))
             if '_o' in key:
-                pos[key].append(uvd_to_numpy(val['location']))
+                pos[key].append(uvd_to_list(val['location']))
                 continue
 
-            pos[key].append(xyz_to_numpy(val['location']))
+            pos[key].append(xyz_to_list(val['location']))
 
     njson = dict()
 
     for key, val in json_data.items():
-        njson[key] = dict() 
-        njson[key]["mean"] = np.mean(pos[key],
-                                     axis=0).tolist()
-        njson[key]["std_dev"] = np.std(pos[key],
-                                       axis=0).tolist()
-        njson[key]["max"] = np.max(pos[key],
-                                   axis=0).tolist()
-        njson[key]["min"] = np.min(pos[key],
-                                   axis=0).tolist()
-
-        for idx, sval in enumerate(pos[key]):
-            pos[key][idx] = sval.tolist()
-
+        njson[key] = get_axis_stats(pos[key])
         njson[key]['all'] = pos[key]
 
-    with open(stats_out_path, 'w') as f:
-        json.dump(njson, f, indent=4)
+    return njson
 
 
-def calc_hl_rc_stats(in_path, out_path):
-    hl_rc_in_path = os.path.join(in_path, 'coords', 'hl_rc')
-    stats_out_path = os.path.join(out_path, 'hl_rc.json')
+def calc_hl_dl_stats(in_path, out_path):
+    stats_out_path = os.path.join(out_path, 'hl_dl.json')
 
-    lettuce_pos = list()
+    records = load_coords_files(in_path, 'hl_dl', '_camera.json')
 
-    for filename in os.listdir(hl_rc_in_path):
+    with tracing.span('aggregate', stats='hl_dl'):
+        njson = get_hl_dl_stats(records)
 
-        if "shared_coords.json" in filename:
-            continue
+    tracing.write_json(stats_out_path, njson)
 
-        hl_rc_in_path_full = os.path.join(hl_rc_in_path, filename)
 
-        with open(hl_rc_in_path_full) as f:
-            json_data = json.loads(f.read())
+def get_hl_rc_stats(records):
+    """Get the statistics of the hl_rc coordinates of a set of frames"""
+    lettuce_pos = list()
 
+    for json_data in records:
         if 'New lettuce position' in json_data:
             # logging.debug(json_data['New lettuce position'])
-            lettuce_pos.append(xyz_to_numpy(json_data['New lettuce position']))
+            lettuce_pos.append(xyz_to_list(json_data['New lettuce position']))
 
     json_data = dict()
-    json_data['lettuce'] = dict()
+    json_data['lettuce'] = get_axis_stats(lettuce_pos)
+    json_data['lettuce']["all"] = lettuce_pos
 
-    json_data['lettuce']["mean"] = np.mean(lettuce_pos, axis=0).tolist()
-    json_data['lettuce']["std_dev"] = np.std(lettuce_pos, axis=0).tolist()
-    json_data['lettuce']["max"] = np.max(lettuce_pos, axis=0).tolist()
-    json_data['lettuce']["min"] = np.min(lettuce_pos, axis=0).tolist()
+    return json_data
 
-    for idx, pos in enumerate(lettuce_pos):
-        lettuce_pos[idx] = pos.tolist()
 
-    json_data['lettuce']["all"] = lettuce_pos
+def calc_hl_rc_stats(in_path, out_path):
+    stats_out_path = os.path.join(out_path, 'hl_rc.json')
 
-    with open(stats_out_path, 'w') as f:
-        json.dump(json_data, f, indent=4)
+    records = load_coords_files(in_path, 'hl_rc', '_dl_coords.json')
 
-    # logging.debug(np.min(lettuce_pos, axis=0))
+    with tracing.span('aggregate', stats='hl_rc'):
+        json_data = get_hl_rc_stats(records)
 
+    tracing.write_json(stats_out_path, json_data)
 
-def calc_marker_stats(in_path, out_path):
-    coords_in_path = os.path.join(in_path, 'coords', 'marker')
-    stats_out_path = os.path.join(out_path, 'marker.json')
+    # logging.debug(np.min(lettuce_pos, axis=0))
 
+
+def get_marker_stats(records):
+    """Get the statistics of the marker coordinates of a set of frames"""
     camera_pos = dict()
     camera_pos['lettuce'] = list()
     camera_pos['bread'] = list()
@@ -156,21 +222,15 @@ def calc_marker_stats(in_path, out_path):
     marker_pos['bread'] = list()
     marker_pos['ham'] = list()
 
-    for filename in os.listdir(coords_in_path):
-
-        if '_marker.json' not in filename:
-            continue
-
-        coords_in_path_full = os.path.join(coords_in_path, filename)
-
-        with open(coords_in_path_full) as f:
-            json_data = json.loads(f.read())
-
+    for json_data in records:
         for key, val in json_data.items():
-            data_array = np.array(val['camera_location'])
-            camera_pos[key].append(data_array)
-            data_array = np.array(val['marker_location'])
-            marker_pos[key].append(data_array)
+            # Skip the lettuce location of the answer file, it has no
+            # camera location
+            if key not in camera_pos:
+                continue
+
+            camera_pos[key].append(to_floats(val['camera_location']))
+            marker_pos[key].append(to_floats(val['marker_location']))
 
     json_data = dict()
 
@@ -179,15 +239,7 @@ def calc_marker_stats(in_path, out_path):
             continue
 
         key_cam = key + "_cam"
-        json_data[key_cam] = dict()
-        json_data[key_cam]["mean"] = np.mean(val, axis=0).tolist()
-        json_data[key_cam]["std_dev"] = np.std(val, axis=0).tolist()
-        json_data[key_cam]["max"] = np.max(val, axis=0).tolist()
-        json_data[key_cam]["min"] = np.min(val, axis=0).tolist()
-
-        for idx, pos in enumerate(val):
-            val[idx] = pos.tolist()
-
+        json_data[key_cam] = get_axis_stats(val)
         json_data[key_cam]['all'] = val
 
     for key, val in marker_pos.items():
@@ -195,19 +247,21 @@ def calc_marker_stats(in_path, out_path):
             continue
 
         key_marker = key + "_marker"
-        json_data[key_marker] = dict()
-        json_data[key_marker]["mean"] = np.mean(val, axis=0).tolist()
-        json_data[key_marker]["std_dev"] = np.std(val, axis=0).tolist()
-        json_data[key_marker]["max"] = np.max(val, axis=0).tolist()
-        json_data[key_marker]["min"] = np.min(val, axis=0).tolist()
+        json_data[key_marker] = get_axis_stats(val)
+        json_data[key_marker]['all'] = val
 
-        for idx, pos in enumerate(val):
-            val[idx] = pos.tolist()
+    return json_data
 
-        json_data[key_marker]['all'] = val
 
-    with open(stats_out_path, 'w') as f:
-        json.dump(json_data, f, indent=4)
+def calc_marker_stats(in_path, out_path):
+    stats_out_path = os.path.join(out_path, 'marker.json')
+
+    records = load_coords_files(in_path, 'marker', '_marker.json')
+
+    with tracing.span('aggregate', stats='marker'):
+        json_data = get_marker_stats(records)
+
+    tracing.write_json(stats_out_path, json_data)
 
 
 def calc_stats(in_path, out_path):
@@ -230,6 +284,7 @@ if __name__ == '__main__':
     out_path = None
     in_path = None
     separate_file = None
+    trace_path = None
 
     if '-v' in myargs:
         logging.basicConfig(level=logging.DEBUG)
@@ -245,5 +300,19 @@ if __name__ == '__main__':
     if '-o' in myargs:
         out_path = myargs['-o']
 
+    if '--trace' in myargs:
+        trace_path = myargs['--trace']
+        tracing.enable()
+
+    if '--timings' in myargs:
+        tracing.enable()
+
     ret = calc_stats(in_path, out_path)
+
+    if trace_path is not None:
+        tracing.write_trace(trace_path)
+
+    if '--timings' in myargs:
+        tracing.print_timings()
+
     exit(ret)
@@ -12,35 +12,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from get_shared_coord import get_coordinates
+from detection_cache import DetectionCache
 from detect_circles import detect_circles
+from options import getopts
 from sys import argv
 import logging
 import cv2
 import numpy as np
 
 
-def getopts(argv):
-    opts = {}  # Empty dictionary to store key-value pairs.
-    while argv:  # While there are arguments left to parse...
-        if argv[0][0] is '-':  # Found a "-name value" pair.
-            if len(argv) > 1:
-                if argv[1][0] != '-':
-                    opts[argv[0]] = argv[1]
-                else:
-                    opts[argv[0]] = True
-            elif len(argv) == 1:
-                opts[argv[0]] = True
-
-        # Reduce the argument list by copying it starting from index 1.
-        argv = argv[1:]
-    return opts
-
-
 def circles_distance(in_path,
                      out_path,
                      camera,
                      show_window=False,
-                     marker_size=0.071):
+                     marker_size=0.071,
+                     cache=None):
 
     marker_pixel_size = 150
     pixels_per_cm = marker_pixel_size / (marker_size * 100)
@@ -51,7 +37,8 @@ def circles_distance(in_path,
                                       out_path,
                                       None,
                                       False,
-                                      marker_size)
+                                      marker_size,
+                                      cache)
 
     logging.info(ids)
 
@@ -101,7 +88,8 @@ def circles_distance(in_path,
                                      distortion.mat(),
                                      newCameraMatrix=newCamMatrix)
 
-    undistortedMarkersCorners = cv2.undistortPoints(corners,
+    # Corners of the first marker, OpenCV returns a tuple of them
+    undistortedMarkersCorners = cv2.undistortPoints(corners[0],
                                                     intrinsics.mat(),
                                                     distortion.mat(),
                                                     P=newCamMatrix)
@@ -153,6 +141,7 @@ if __name__ == '__main__':
     params_path = None
     show_window = False
     marker_size = 0.071
+    cache = None
 
     if '-v' in myargs:
         logging.basicConfig(level=logging.INFO)
@@ -182,8 +171,12 @@ if __name__ == '__main__':
     if '-m' in myargs:
         marker_size = myargs['-m']
 
+    if '-k' in myargs:
+        cache = DetectionCache(myargs['-k'])
+
     circles_distance(in_path,
                      out_path,
                      camera,
                      show_window,
-                     float(marker_size))
+                     float(marker_size),
+                     cache)
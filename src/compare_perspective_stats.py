@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from options import getopts
 from sys import argv
 import logging
 import json
@@ -29,23 +30,6 @@ llevel_mapping = {'info': logging.INFO,
                   'error': logging.ERROR}
 
 
-def getopts(argv):
-    opts = {}  # Empty dictionary to store key-value pairs.
-    while argv:  # While there are arguments left to parse...
-        if argv[0][0] is '-':  # Found a "-name value" pair.
-            if len(argv) > 1:
-                if argv[1][0] != '-':
-                    opts[argv[0]] = argv[1]
-                else:
-                    opts[argv[0]] = True
-            elif len(argv) == 1:
-                opts[argv[0]] = True
-
-        # Reduce the argument list by copying it starting from index 1.
-        argv = argv[1:]
-    return opts
-
-
 def xyz_to_numpy(xyz):
     return np.array([xyz['x'], xyz['y'], xyz['z']])
 
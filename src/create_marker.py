@@ -11,29 +11,14 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from options import getopts
 from sys import argv
 import logging
 import cv2
 import numpy as np
 import json
 import cv2.aruco as aruco
-
-
-def getopts(argv):
-    opts = {}  # Empty dictionary to store key-value pairs.
-    while argv:  # While there are arguments left to parse...
-        if argv[0][0] is '-':  # Found a "-name value" pair.
-            if len(argv) > 1:
-                if argv[1][0] != '-':
-                    opts[argv[0]] = argv[1]
-                else:
-                    opts[argv[0]] = True
-            elif len(argv) == 1:
-                opts[argv[0]] = True
-
-        # Reduce the argument list by copying it starting from index 1.
-        argv = argv[1:]
-    return opts
+from transforms import Transform
 
 
 def get_coordinates(in_path,
@@ -106,30 +91,15 @@ def get_coordinates(in_path,
 
     for i in range(0, len(rvecs)):
         # Reverse the pose
-        # Calculate the reversed Rotation matrix
-        rotation_matrix, d = cv2.Rodrigues(rvecs[i])
-
-        logging.info(rotation_matrix)
-
-        reversed_rotation_matrix = np.linalg.inv(rotation_matrix)
-        logging.info(reversed_rotation_matrix)
-
-        # Calculate the reversed tranlation vector
-        reversed_translation = np.matmul(reversed_rotation_matrix,
-                                         -np.transpose(tvecs[i]))
+        camera_to_marker = Transform.from_pose(rvecs[i], tvecs[i]).inverse
 
-        rod, d = cv2.Rodrigues(reversed_rotation_matrix)
-        rrvecs.append(np.transpose(rod))
-        rtvecs.append(np.transpose(reversed_translation))
+        logging.info(camera_to_marker.matrix)
 
-        # Calculate the normal vector by projecting the point (0, 0, 1)
-        normal = cv2.gemm(reversed_rotation_matrix,
-                          (0, 0, 1),
-                          1,
-                          reversed_translation,
-                          1)
+        rrvecs.append(np.transpose(camera_to_marker.rvec))
+        rtvecs.append(camera_to_marker.translation.reshape(1, 3))
 
-        normal -= reversed_translation
+        # The normal vector is the direction (0, 0, 1) of the camera
+        normal = camera_to_marker.apply_vectors((0, 0, 1)).reshape(3, 1)
 
         nvecs.append(normal)
 
@@ -11,64 +11,54 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from options import getopts
 from sys import argv
 import logging
 import json
 import os
-import imghdr
 import cv2
 import cv2.aruco as aruco
+from dataset_manifest import create_img_list
+from detection_cache import DetectionCache
+from shared_frames import map_frames
 
 supported_img = ["jpeg", "png"]
 
+# Detection caches opened by this (worker) process
+worker_caches = dict()
+
 llevel_mapping = {'info': logging.INFO,
                   'warning': logging.WARNING,
                   'debug': logging.DEBUG,
                   'error': logging.ERROR}
 
 
-def getopts(argv):
-    opts = {}  # Empty dictionary to store key-value pairs.
-    while argv:  # While there are arguments left to parse...
-        if argv[0][0] is '-':  # Found a "-name value" pair.
-            if len(argv) > 1:
-                if argv[1][0] != '-':
-                    opts[argv[0]] = argv[1]
-                else:
-                    opts[argv[0]] = True
-            elif len(argv) == 1:
-                opts[argv[0]] = True
-
-        # Reduce the argument list by copying it starting from index 1.
-        argv = argv[1:]
-    return opts
-
-
-def create_img_list(in_path):
-    img_list = list()
-    for filename in os.listdir(in_path):
-        full_path = os.path.join(in_path, filename)
-        if os.path.isdir(full_path):
-            continue
+def detect_sep_marker(img_file, marker_id, cache=None, input_image=None):
+    cache_key = None
+    detection = None
 
-        im_type = imghdr.what(full_path)
-        if im_type in supported_img:
-            img_list.append(filename)
-
-    return img_list
+    if cache is not None:
+        # Detection runs without camera model nor pose estimation
+        cache_key = cache.get_key(cache.digest_file(img_file), None, None)
+        detection = cache.get(cache_key)
 
+    if detection is not None:
+        ids = detection[0]
+    else:
+        aruco_dict = aruco.Dictionary_get(aruco.DICT_6X6_250)
+        parameters = aruco.DetectorParameters_create()
+        parameters.cornerRefinementMethod = aruco.CORNER_REFINE_SUBPIX
 
-def detect_sep_marker(img_file, marker_id):
-    aruco_dict = aruco.Dictionary_get(aruco.DICT_6X6_250)
-    parameters = aruco.DetectorParameters_create()
-    parameters.cornerRefinementMethod = aruco.CORNER_REFINE_SUBPIX
+        if input_image is None:
+            input_image = cv2.imread(img_file)
 
-    input_image = cv2.imread(img_file)
+        corners, ids, rejectedImgPoints = aruco.detectMarkers(
+                                            input_image,
+                                            aruco_dict,
+                                            parameters=parameters)
 
-    corners, ids, rejectedImgPoints = aruco.detectMarkers(input_image,
-                                                          aruco_dict,
-                                                          parameters=parameters
-                                                          )
+        if cache is not None:
+            cache.put(cache_key, ids, corners)
 
     if ids is None:
         return False
@@ -83,6 +73,19 @@ def detect_sep_marker(img_file, marker_id):
     return False
 
 
+def detect_sep_marker_frame(input_image, img_file, marker_id,
+                           cache_path=None):
+    """Look for the separation marker in a frame handed over by map_frames"""
+    cache = None
+
+    if cache_path is not None:
+        if cache_path not in worker_caches:
+            worker_caches[cache_path] = DetectionCache(cache_path)
+        cache = worker_caches[cache_path]
+
+    return detect_sep_marker(img_file, marker_id, cache, input_image)
+
+
 def get_base_file(img_file):
     base = os.path.splitext(img_file)[0]
     return base
@@ -100,7 +103,8 @@ def is_within_sep_imgs(img_file, prev_pos, next_pos):
     return True
 
 
-def create_separation_file(in_path, marker_id, out_path):
+def create_separation_file(in_path, marker_id, out_path, cache=None,
+                           workers=1):
     ret = 0
 
     img_list = create_img_list(in_path)
@@ -109,10 +113,23 @@ def create_separation_file(in_path, marker_id, out_path):
     pos_counter = 0
     prev_sep = 0
 
-    for img_file in img_list:
-        img_full = os.path.join(in_path, img_file)
+    img_paths = [os.path.join(in_path, img_file) for img_file in img_list]
 
-        if detect_sep_marker(img_full, marker_id):
+    if workers > 1:
+        cache_path = None
+        if cache is not None:
+            cache_path = cache.cache_path
+
+        detections = map_frames(detect_sep_marker_frame,
+                                img_paths,
+                                (marker_id, cache_path),
+                                workers)
+    else:
+        detections = ((img_full, detect_sep_marker(img_full, marker_id, cache))
+                      for img_full in img_paths)
+
+    for img_file, (_, found) in zip(img_list, detections):
+        if found:
             sep_imgs.append(int(get_base_file(img_file)))
 
     sep_imgs.sort()
@@ -148,6 +165,8 @@ if __name__ == '__main__':
     in_path = None
     separate_file = None
     marker_id = 1
+    cache = None
+    workers = 1
 
     if '-l' in myargs:
         logging.basicConfig(level=llevel_mapping[myargs['-l']])
@@ -170,5 +189,12 @@ if __name__ == '__main__':
     if '-m' in myargs:
         marker_id = int(myargs['-m'])
 
-    ret = create_separation_file(in_path, marker_id, out_path)
+    if '-k' in myargs:
+        cache = DetectionCache(myargs['-k'])
+
+    if '-j' in myargs:
+        workers = int(myargs['-j'])
+
+    ret = create_separation_file(in_path, marker_id, out_path, cache,
+                                 workers)
     exit(ret)
@@ -0,0 +1,209 @@
+# Copyright 2018 Pedro Cuadra - pjcuadra@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from options import getopts
+from sys import argv
+import logging
+import json
+import os
+import struct
+
+
+supported_img = ["jpeg", "png"]
+
+manifest_file = ".dataset_manifest.json"
+
+png_signature = b'\x89PNG\r\n\x1a\n'
+
+# JPEG start of frame markers, the ones holding the image size
+jpeg_sof_markers = [0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7,
+                    0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf]
+
+
+def read_jpeg_size(f):
+    """Walk the JPEG segments until the start of frame one"""
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            return None, None
+
+        # Markers may be padded with 0xff bytes
+        while marker[1] == 0xff:
+            marker = marker[1:] + f.read(1)
+            if len(marker) < 2:
+                return None, None
+
+        # Markers without payload
+        if marker[1] == 0x01 or 0xd0 <= marker[1] <= 0xd7:
+            continue
+
+        length = f.read(2)
+        if len(length) < 2:
+            return None, None
+        length = struct.unpack('>H', length)[0]
+
+        if marker[1] in jpeg_sof_markers:
+            sof = f.read(5)
+            if len(sof) < 5:
+                return None, None
+            height, width = struct.unpack('>HH', sof[1:5])
+            return width, height
+
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+def read_image_header(img_path):
+    """
+    Get the type and size of an image by reading its header only
+
+    Returns the image type (one of `supported_img`), its width and height.
+    If the file isn't a supported image (None, None, None) is returned.
+    """
+    with open(img_path, 'rb') as f:
+        head = f.read(24)
+
+        if head.startswith(png_signature) and head[12:16] == b'IHDR':
+            width, height = struct.unpack('>II', head[16:24])
+            return 'png', width, height
+
+        if head.startswith(b'\xff\xd8'):
+            f.seek(2)
+            width, height = read_jpeg_size(f)
+            return 'jpeg', width, height
+
+    return None, None, None
+
+
+def load_manifest(in_path):
+    """Load the cached manifest of a data set, empty if there is none"""
+    manifest_path = os.path.join(in_path, manifest_file)
+
+    if not os.path.exists(manifest_path):
+        return dict()
+
+    try:
+        with open(manifest_path) as f:
+            return json.loads(f.read())
+    except ValueError:
+        logging.warning('Ignoring corrupted manifest ' + manifest_path)
+        return dict()
+
+
+def save_manifest(in_path, manifest):
+    """Atomically write the manifest of a data set"""
+    manifest_path = os.path.join(in_path, manifest_file)
+    tmp_path = manifest_path + '.tmp'
+
+    try:
+        with open(tmp_path, 'w') as outfile:
+            json.dump(manifest, outfile, indent=4)
+        os.replace(tmp_path, manifest_path)
+    except OSError:
+        logging.warning('Manifest could not be written at ' + manifest_path)
+
+
+def refresh_manifest(in_path, save=True):
+    """
+    Get the up to date manifest of a data set
+
+    The manifest maps each file name to its type, width, height, size and
+    mtime. Only files that are new or whose size or mtime changed since the
+    manifest was cached are read again.
+    """
+    cached = load_manifest(in_path)
+    manifest = dict()
+    changed = False
+
+    for entry in os.scandir(in_path):
+        if entry.name.startswith(manifest_file):
+            continue
+
+        if not entry.is_file():
+            continue
+
+        stat = entry.stat()
+        info = cached.get(entry.name)
+
+        if (info is not None and
+                info['size'] == stat.st_size and
+                info['mtime'] == stat.st_mtime_ns):
+            manifest[entry.name] = info
+            continue
+
+        im_type, width, height = read_image_header(entry.path)
+        logging.debug('Sniffed {} - {}'.format(entry.name, im_type))
+
+        manifest[entry.name] = {'type': im_type,
+                                'width': width,
+                                'height': height,
+                                'size': stat.st_size,
+                                'mtime': stat.st_mtime_ns}
+        changed = True
+
+    if len(manifest) != len(cached):
+        changed = True
+
+    if save and changed:
+        save_manifest(in_path, manifest)
+
+    return manifest
+
+
+def create_img_list(in_path):
+    """List the supported images of a data set"""
+    manifest = refresh_manifest(in_path)
+
+    return sorted(filename for filename, info in manifest.items()
+                  if info['type'] in supported_img)
+
+
+def get_image_size(in_path, img_file, manifest=None):
+    """
+    Get the width and height of an image of a data set
+
+    The cached manifest entry is used if a manifest is given, otherwise
+    only the header of the image is read.
+    """
+    if manifest is not None and img_file in manifest:
+        info = manifest[img_file]
+        return info['width'], info['height']
+
+    _, width, height = read_image_header(os.path.join(in_path, img_file))
+
+    return width, height
+
+
+if __name__ == '__main__':
+    myargs = getopts(argv)
+    in_path = None
+
+    if '-v' in myargs:
+        logging.basicConfig(level=logging.DEBUG)
+
+    if '-i' in myargs:
+        in_path = myargs['-i']
+        logging.debug('Input directory at ' + in_path)
+    else:
+        logging.error('No input directory provided')
+        exit(-1)
+
+    manifest = refresh_manifest(in_path)
+
+    for filename in sorted(manifest):
+        info = manifest[filename]
+        if info['type'] not in supported_img:
+            continue
+        print('{} {} {}x{}'.format(filename,
+                                   info['type'],
+                                   info['width'],
+                                   info['height']))
@@ -0,0 +1,182 @@
+# Copyright 2018 Pedro Cuadra - pjcuadra@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import ast
+import hashlib
+import logging
+import json
+import os
+
+
+# Bytes read at once while hashing a file
+hash_chunk_size = 1024 * 1024
+
+
+def hash_file(path):
+    """Get the SHA-1 hex digest of a file, None if it doesn't exist"""
+    if not os.path.exists(path):
+        return None
+
+    sha = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(hash_chunk_size), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def hash_files(paths):
+    """Get a single digest for the contents of several files"""
+    sha = hashlib.sha1()
+
+    for path in paths:
+        sha.update(str(hash_file(path)).encode())
+
+    return sha.hexdigest()
+
+
+def get_local_modules(path):
+    """
+    Get the source file of a module and of the local modules it imports
+
+    Local modules are the ones next to it. Their imports are followed as
+    well, the ones inside functions included. Returns the sorted paths.
+    """
+    path = os.path.abspath(path)
+    directory = os.path.dirname(path)
+    modules = set()
+    pending = [path]
+
+    while pending:
+        module_path = pending.pop()
+
+        if module_path in modules:
+            continue
+
+        modules.add(module_path)
+
+        with open(module_path) as f:
+            tree = ast.parse(f.read(), module_path)
+
+        names = list()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names += [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module:
+                names.append(node.module)
+
+        for name in names:
+            local_path = os.path.join(directory,
+                                      name.split('.')[0] + '.py')
+
+            if os.path.exists(local_path):
+                pending.append(local_path)
+
+    return sorted(modules)
+
+
+def get_input_info(path, prev_info=None):
+    """
+    Get the size, mtime and digest of an input file
+
+    If the size and mtime match the ones of `prev_info` the file isn't read
+    again and the previous digest is reused, like make does.
+    """
+    if not os.path.exists(path):
+        return None
+
+    stat = os.stat(path)
+
+    if (prev_info is not None and
+            prev_info['size'] == stat.st_size and
+            prev_info['mtime'] == stat.st_mtime_ns):
+        return prev_info
+
+    return {'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'digest': hash_file(path)}
+
+
+def load_stamp(stamp_path):
+    """Load a dependency stamp, None if there is none"""
+    if not os.path.exists(stamp_path):
+        return None
+
+    try:
+        with open(stamp_path) as f:
+            return json.loads(f.read())
+    except ValueError:
+        logging.warning('Ignoring corrupted stamp ' + stamp_path)
+        return None
+
+
+def is_up_to_date(stamp_path, inputs, values):
+    """
+    Check if the outputs recorded at a stamp are up to date
+
+    `inputs` are the paths of the input files and `values` a dictionary of
+    any other JSON serializable value the outputs depend on. The outputs are
+    up to date if they all exist and neither the contents of the inputs nor
+    the values changed since the stamp was written.
+    """
+    stamp = load_stamp(stamp_path)
+
+    if stamp is None:
+        return False
+
+    if stamp['values'] != values:
+        return False
+
+    if sorted(stamp['inputs']) != sorted(inputs):
+        return False
+
+    for path, prev_info in stamp['inputs'].items():
+        info = get_input_info(path, prev_info)
+
+        if info is None or prev_info is None:
+            if info is not prev_info:
+                return False
+            continue
+
+        if info['digest'] != prev_info['digest']:
+            return False
+
+    for path in stamp['outputs']:
+        if not os.path.exists(path):
+            return False
+
+    return True
+
+
+def write_stamp(stamp_path, inputs, values, outputs):
+    """Record the inputs and values the existing outputs were built from"""
+    stamp = dict()
+    stamp['inputs'] = dict()
+    stamp['values'] = values
+    stamp['outputs'] = [path for path in outputs if os.path.exists(path)]
+
+    prev_stamp = load_stamp(stamp_path)
+
+    for path in inputs:
+        prev_info = None
+        if prev_stamp is not None:
+            prev_info = prev_stamp['inputs'].get(path)
+        stamp['inputs'][path] = get_input_info(path, prev_info)
+
+    stamp_dir = os.path.dirname(stamp_path)
+    if not os.path.exists(stamp_dir):
+        os.makedirs(stamp_dir)
+
+    with open(stamp_path, 'w') as outfile:
+        json.dump(stamp, outfile, indent=4)
@@ -0,0 +1,185 @@
+# Copyright 2018 Pedro Cuadra - pjcuadra@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+import logging
+import os
+import threading
+import zipfile
+import numpy as np
+from dependency_tracker import hash_file
+
+
+# Default maximum size of the cache in bytes
+default_max_size = 1024 * 1024 * 1024
+
+
+def hash_image(input_image):
+    """Get a digest of a decoded image"""
+    sha = hashlib.sha1()
+    sha.update(str(input_image.shape).encode())
+    sha.update(np.ascontiguousarray(input_image).data)
+    return sha.hexdigest()
+
+
+class DetectionCache(object):
+    """
+    Content addressed on-disk cache of marker detections
+
+    Each entry holds the corners, ids, rotation and translation vectors of
+    the markers detected on an image, keyed by the digest of the image, the
+    camera calibration, the marker size and the detector preset. Entries are
+    evicted least recently used first once the cache grows beyond
+    `max_size` bytes.
+    """
+
+    def __init__(self, cache_path, max_size=default_max_size):
+        self.cache_path = cache_path
+        self.max_size = max_size
+        self.file_digests = dict()
+        self.lock = threading.Lock()
+
+        if not os.path.exists(cache_path):
+            os.makedirs(cache_path)
+
+        self.size = sum(size for _, _, size in self.list_entries())
+
+    def list_entries(self):
+        """List (mtime, path, size) of all the entries of the cache"""
+        entries = list()
+
+        for sub_dir in os.scandir(self.cache_path):
+            if not sub_dir.is_dir():
+                continue
+
+            for entry in os.scandir(sub_dir.path):
+                if not entry.name.endswith('.npz'):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, entry.path, stat.st_size))
+
+        return entries
+
+    def digest_file(self, path):
+        """Get the digest of a file, rehashing only if it changed"""
+        stat = os.stat(path)
+        stamp = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+        if stamp not in self.file_digests:
+            self.file_digests[stamp] = hash_file(path)
+
+        return self.file_digests[stamp]
+
+    def get_key(self, image_digest, camera_digest, marker_size,
+                preset='default'):
+        """Get the key of a detection"""
+        key = '{}:{}:{!r}:{}'.format(image_digest,
+                                     camera_digest,
+                                     marker_size,
+                                     preset)
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def get_entry_path(self, key):
+        return os.path.join(self.cache_path, key[:2], key + '.npz')
+
+    def get(self, key):
+        """
+        Get a cached detection
+
+        Returns ids, corners, rvecs and tvecs as returned by the Aruco module
+        or None if there is no such entry.
+        """
+        entry_path = self.get_entry_path(key)
+
+        try:
+            with np.load(entry_path) as data:
+                ids = data['ids']
+                corners = data['corners']
+                rvecs = data['rvecs']
+                tvecs = data['tvecs']
+        except (IOError, ValueError, KeyError, EOFError,
+                zipfile.BadZipFile):
+            # Missing, evicted meanwhile or truncated
+            return None
+
+        # Mark as recently used
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+
+        if len(ids) == 0:
+            return None, [], None, None
+
+        corners = [marker_corners for marker_corners in corners]
+
+        if len(rvecs) == 0:
+            return ids, corners, None, None
+
+        return ids, corners, rvecs, tvecs
+
+    def put(self, key, ids, corners, rvecs=None, tvecs=None):
+        """Store a detection in the cache"""
+        entry_path = self.get_entry_path(key)
+        entry_dir = os.path.dirname(entry_path)
+
+        if ids is None:
+            ids = np.zeros((0, 1), dtype=np.int32)
+            corners = np.zeros((0, 1, 4, 2), dtype=np.float32)
+
+        if rvecs is None:
+            rvecs = np.zeros((0, 1, 3))
+            tvecs = np.zeros((0, 1, 3))
+
+        if not os.path.exists(entry_dir):
+            os.makedirs(entry_dir, exist_ok=True)
+
+        tmp_path = '{}.{}.{}.tmp'.format(entry_path,
+                                         os.getpid(),
+                                         threading.get_ident())
+
+        with open(tmp_path, 'wb') as f:
+            np.savez(f,
+                     ids=np.asarray(ids, dtype=np.int32),
+                     corners=np.asarray(corners, dtype=np.float32),
+                     rvecs=np.asarray(rvecs, dtype=np.float64),
+                     tvecs=np.asarray(tvecs, dtype=np.float64))
+
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, entry_path)
+
+        with self.lock:
+            self.size += size
+
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits"""
+        entries = sorted(self.list_entries())
+        self.size = sum(size for _, _, size in entries)
+
+        # Leave some room so eviction doesn't run on every put
+        target_size = self.max_size * 0.9
+
+        for _, path, size in entries:
+            if self.size <= target_size:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+            self.size -= size
+            logging.debug('Evicted {}'.format(path))
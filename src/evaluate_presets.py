@@ -0,0 +1,351 @@
+# Copyright 2018 Pedro Cuadra - pjcuadra@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from get_shared_coord import detect_markers_pose, detector_presets
+from dataset_manifest import refresh_manifest, supported_img
+from options import getopts
+from sys import argv
+import logging
+import json
+import os
+import time
+import cv2
+import numpy as np
+
+
+def list_images(in_path):
+    """List the images of a directory without writing its manifest"""
+    manifest = refresh_manifest(in_path, save=False)
+
+    return sorted(os.path.join(in_path, filename)
+                  for filename, info in manifest.items()
+                  if info['type'] in supported_img)
+
+
+def get_rotation_error(rvec_a, rvec_b):
+    """Get the angle in degrees between two rotations"""
+    rot_a, _ = cv2.Rodrigues(np.asarray(rvec_a).reshape(3))
+    rot_b, _ = cv2.Rodrigues(np.asarray(rvec_b).reshape(3))
+
+    cos = (np.trace(np.matmul(rot_a.T, rot_b)) - 1) / 2
+
+    return np.degrees(np.arccos(np.clip(cos, -1, 1)))
+
+
+def get_pose_errors(reference, detection):
+    """
+    Compare the poses of the markers found by two detections
+
+    Returns a list of (id, translation error, rotation error) for each
+    marker of `reference` and the ids `detection` missed.
+    """
+    ref_ids, _, ref_rvecs, ref_tvecs = reference
+    ids, _, rvecs, tvecs = detection
+
+    errors = list()
+    missed = list()
+
+    if ref_ids is None:
+        return errors, missed
+
+    found = dict()
+    if ids is not None:
+        for i, marker_id in enumerate(ids.ravel()):
+            found[int(marker_id)] = i
+
+    for i, marker_id in enumerate(ref_ids.ravel()):
+        marker_id = int(marker_id)
+
+        if marker_id not in found:
+            missed.append(marker_id)
+            continue
+
+        j = found[marker_id]
+        translation = np.linalg.norm(np.ravel(ref_tvecs[i]) -
+                                     np.ravel(tvecs[j]))
+        rotation = get_rotation_error(ref_rvecs[i], rvecs[j])
+
+        errors.append((marker_id, translation, rotation))
+
+    return errors, missed
+
+
+def load_images(in_paths):
+    """Decode the images of one or more directories up front"""
+    images = list()
+
+    for in_path in in_paths:
+        for img_path in list_images(in_path):
+            input_image = cv2.imread(img_path)
+            if input_image is not None:
+                images.append((img_path, input_image))
+
+    return images
+
+
+def load_ground_truth(gt_path):
+    """
+    Load the known camera to marker distances of a data set
+
+    The file maps image names to the distance in meters of each marker id,
+    i.e. {"IMG-1637.JPG": {"23": 0.412}}.
+    """
+    if gt_path is None:
+        return dict()
+
+    with open(gt_path) as f:
+        return json.loads(f.read())
+
+
+def get_distance_errors(detection, known):
+    """Get the camera to marker distance errors against known distances"""
+    ids, _, rvecs, tvecs = detection
+    errors = list()
+
+    if ids is None:
+        return errors
+
+    for i, marker_id in enumerate(ids.ravel()):
+        if str(marker_id) not in known:
+            continue
+
+        distance = np.linalg.norm(np.ravel(tvecs[i]))
+        errors.append(abs(distance - known[str(marker_id)]))
+
+    return errors
+
+
+def run_preset(images, intrinsics, distortion, preset, marker_size,
+               repeat=1, warm_up=False):
+    """
+    Detect the markers and their pose on decoded images with a preset
+
+    The images are processed `repeat` times, after a first image that isn't
+    timed if `warm_up` is set, as the detector is set up on first use.
+    Returns the milliseconds per image and the detection of every image.
+    """
+    if warm_up:
+        detect_markers_pose(images[0][1], intrinsics, distortion,
+                            marker_size, preset=preset)
+
+    detections = list()
+    start = time.perf_counter()
+
+    for i in range(repeat):
+        for _, input_image in images:
+            detection = detect_markers_pose(input_image,
+                                            intrinsics,
+                                            distortion,
+                                            marker_size,
+                                            preset=preset)
+            if i == 0:
+                detections.append(detection)
+
+    elapsed = time.perf_counter() - start
+
+    return 1000 * elapsed / (repeat * len(images)), detections
+
+
+def evaluate_presets(in_paths,
+                     camera,
+                     presets,
+                     reference='default',
+                     marker_size=0.071,
+                     max_translation=0.005,
+                     max_rotation=1.0,
+                     gt_path=None,
+                     timing=None,
+                     out_path=None):
+    """
+    Check the poses of detector presets against a reference preset
+
+    All images of the `in_paths` directories are decoded up front so only
+    the marker detection and pose estimation are timed, `timing` times per
+    preset after a warm up if given. For the images listed in the ground
+    truth file at `gt_path` the camera to marker distances are compared
+    with the known ones as well. Returns 0 if every marker found by the
+    reference is found by each preset within `max_translation` meters and
+    `max_rotation` degrees.
+    """
+    fs = cv2.FileStorage(camera, cv2.FILE_STORAGE_READ)
+    intrinsics = fs.getNode("camera_matrix")
+    distortion = fs.getNode("distortion_coefficients")
+
+    ground_truth = load_ground_truth(gt_path)
+
+    images = load_images(in_paths)
+    if len(images) == 0:
+        logging.error('No images found')
+        return -1
+
+    names = [reference] + [preset for preset in presets
+                           if preset != reference]
+    results = dict()
+    ref_detections = None
+    failed = 0
+
+    for name in names:
+        ms, detections = run_preset(images, intrinsics, distortion, name,
+                                    marker_size, timing or 1,
+                                    timing is not None)
+        if ref_detections is None:
+            ref_detections = detections
+
+        translations = list()
+        rotations = list()
+        distances = list()
+        missed = 0
+        out_of_tolerance = 0
+
+        for (img_path, _), ref_detection, detection in zip(images,
+                                                           ref_detections,
+                                                           detections):
+            errors, missed_ids = get_pose_errors(ref_detection, detection)
+
+            for marker_id in missed_ids:
+                logging.warning('{} {}: marker {} missed'.format(
+                    name, img_path, marker_id))
+                missed += 1
+
+            for marker_id, translation, rotation in errors:
+                logging.info('{} {}: marker {} {:.2f} mm {:.3f} deg'.format(
+                    name, img_path, marker_id, translation * 1000, rotation))
+
+                translations.append(translation)
+                rotations.append(rotation)
+
+                if translation > max_translation or rotation > max_rotation:
+                    logging.warning('{} {}: marker {} out of tolerance'.format(
+                        name, img_path, marker_id))
+                    out_of_tolerance += 1
+
+            known = ground_truth.get(os.path.basename(img_path))
+            if known is not None:
+                distances += get_distance_errors(detection, known)
+
+        failed += missed + out_of_tolerance
+
+        results[name] = {
+            'ms_per_image': ms,
+            'missed': missed,
+            'out_of_tolerance': out_of_tolerance,
+            'translation_mean': float(np.mean(translations or [0])),
+            'translation_max': float(np.max(translations or [0])),
+            'rotation_mean': float(np.mean(rotations or [0])),
+            'rotation_max': float(np.max(rotations or [0])),
+            'distance_mean': float(np.mean(distances)) if distances else None,
+            'distance_count': len(distances)}
+
+    print('{} images, errors against {}'.format(len(images), reference))
+    print('{:<10} {:>8} {:>6} {:>6} {:>10} {:>10} {:>10} {:>10} {:>10}'
+          .format('preset', 'ms/image', 'missed', 'out', 'mean mm',
+                  'max mm', 'mean deg', 'max deg', 'gt mm'))
+
+    for name in names:
+        result = results[name]
+        gt_error = '-'
+        if result['distance_mean'] is not None:
+            gt_error = '{:.2f}'.format(result['distance_mean'] * 1000)
+
+        print('{:<10} {:8.2f} {:6d} {:6d} {:10.2f} {:10.2f} {:10.3f} '
+              '{:10.3f} {:>10}'.format(name,
+                                       result['ms_per_image'],
+                                       result['missed'],
+                                       result['out_of_tolerance'],
+                                       result['translation_mean'] * 1000,
+                                       result['translation_max'] * 1000,
+                                       result['rotation_mean'],
+                                       result['rotation_max'],
+                                       gt_error))
+
+    if out_path is not None:
+        with open(out_path, 'w') as outfile:
+            json.dump(results, outfile, indent=4)
+
+    if failed:
+        print('{} markers missed or out of tolerance'.format(failed))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    myargs = getopts(argv)
+    presets = ['pyramid']
+    reference = 'default'
+    marker_size = 0.071
+    max_translation = 0.005
+    max_rotation = 1.0
+    gt_path = None
+    timing = None
+    out_path = None
+
+    if '-v' in myargs:
+        logging.basicConfig(level=logging.INFO)
+
+    if '-i' in myargs:
+        in_paths = myargs['-i'].split(',')
+    else:
+        logging.error('No input path provided')
+        exit(-1)
+
+    if '-c' in myargs:
+        camera = myargs['-c']
+    else:
+        logging.error('No Camera Distortion model provided')
+        exit(-1)
+
+    if '-p' in myargs:
+        presets = myargs['-p'].split(',')
+        if presets == ['all']:
+            presets = sorted(detector_presets)
+
+    if '-r' in myargs:
+        reference = myargs['-r']
+
+    for name in presets + [reference]:
+        if name not in detector_presets:
+            logging.error('Unknown detector preset ' + name)
+            exit(-1)
+
+    if '-m' in myargs:
+        marker_size = float(myargs['-m'])
+
+    if '-t' in myargs:
+        max_translation = float(myargs['-t'])
+
+    if '-a' in myargs:
+        max_rotation = float(myargs['-a'])
+
+    if '-g' in myargs:
+        gt_path = myargs['-g']
+
+    if '--timing' in myargs:
+        timing = 3
+        if myargs['--timing'] is not True:
+            timing = int(myargs['--timing'])
+
+    if '-o' in myargs:
+        out_path = myargs['-o']
+
+    ret = evaluate_presets(in_paths,
+                           camera,
+                           presets,
+                           reference,
+                           marker_size,
+                           max_translation,
+                           max_rotation,
+                           gt_path,
+                           timing,
+                           out_path)
+    exit(ret)
@@ -0,0 +1,187 @@
+# Copyright 2018 Pedro Cuadra - pjcuadra@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from concurrent.futures import ThreadPoolExecutor
+from shutil import SameFileError, copyfileobj
+import logging
+import os
+import time
+
+
+link_modes = ["hard", "sym", "reflink"]
+
+# Linux ioctl request to clone a file (reflink)
+FICLONE = 0x40049409
+
+# Bytes handed to the kernel per copy call
+copy_chunk_size = 64 * 1024 * 1024
+
+
+def copy_file_fast(src, dst):
+    """
+    Copy src into dst letting the kernel move the data
+
+    `os.copy_file_range` is preferred since it allows server side copies on
+    network file systems, then `os.sendfile` and finally a plain user space
+    copy. A method that stops short hands over to the next one, which
+    continues where it stopped. Returns the number of bytes copied.
+    """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        raise SameFileError('{} and {} are the same file'.format(src, dst))
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        copied = 0
+
+        for copy_call in ('copy_file_range', 'sendfile'):
+            if copied >= size:
+                break
+
+            if not hasattr(os, copy_call):
+                continue
+
+            try:
+                while copied < size:
+                    if copy_call == 'copy_file_range':
+                        sent = os.copy_file_range(fsrc.fileno(),
+                                                  fdst.fileno(),
+                                                  copy_chunk_size,
+                                                  copied,
+                                                  copied)
+                    else:
+                        os.lseek(fdst.fileno(), copied, os.SEEK_SET)
+                        sent = os.sendfile(fdst.fileno(),
+                                           fsrc.fileno(),
+                                           copied,
+                                           copy_chunk_size)
+                    if sent == 0:
+                        logging.debug('{} stopped at {} of {} bytes for '
+                                      '{}'.format(copy_call, copied, size,
+                                                  dst))
+                        break
+                    copied += sent
+            except OSError:
+                logging.debug('{} not supported for {}'.format(copy_call,
+                                                              dst))
+
+        if copied < size:
+            fsrc.seek(copied)
+            fdst.seek(copied)
+            copyfileobj(fsrc, fdst)
+            copied = fdst.tell()
+
+        if copied != size:
+            logging.warning('Copied {} of {} bytes from {}, it changed '
+                            'while copying'.format(copied, size, src))
+
+    return copied
+
+
+def reflink_file(src, dst):
+    """Clone src into dst sharing its blocks, copy if not supported"""
+    import fcntl
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return os.fstat(fsrc.fileno()).st_size
+        except OSError:
+            logging.debug('Reflink not supported for {}'.format(dst))
+
+    return copy_file_fast(src, dst)
+
+
+def place_file(src, dst, link=None):
+    """
+    Place src at dst either by copying or by linking it
+
+    Returns the number of bytes actually copied.
+    """
+    # dst itself isn't resolved, it may be a link to src left by a previous
+    # run
+    dst_path = os.path.join(os.path.realpath(os.path.dirname(
+        os.path.abspath(dst))), os.path.basename(dst))
+
+    if os.path.realpath(src) == dst_path:
+        raise SameFileError('{} and {} are the same file'.format(src, dst))
+
+    # Clean previous runs first; links can't overwrite and a link left at
+    # dst would have src truncated when copying through it
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    if link is None:
+        return copy_file_fast(src, dst)
+
+    if link == 'hard':
+        os.link(src, dst)
+    elif link == 'sym':
+        os.symlink(os.path.abspath(src), dst)
+    elif link == 'reflink':
+        return reflink_file(src, dst)
+
+    return 0
+
+
+class FileMover(object):
+    """
+    Collect files to be placed and place them concurrently
+
+    Destinations are de-duplicated, so adding the same file more than once
+    only places it once. All destination directories are created before any
+    file is placed.
+    """
+
+    def __init__(self, link=None, workers=8):
+        self.link = link
+        self.workers = workers
+        self.jobs = dict()
+
+    def add(self, src, dst):
+        """Schedule src to be placed at dst"""
+        self.jobs[os.path.abspath(dst)] = src
+
+    def place(self, job):
+        dst, src = job
+        return place_file(src, dst, self.link)
+
+    def run(self):
+        """
+        Place all scheduled files
+
+        Returns the number of files placed, the bytes copied and the time it
+        took in seconds.
+        """
+        for path in sorted(set(os.path.dirname(dst) for dst in self.jobs)):
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+        start = time.time()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            copied = sum(executor.map(self.place, self.jobs.items()))
+
+        elapsed = time.time() - start
+        files = len(self.jobs)
+
+        logging.info('Placed {} files, {:.1f} MB in {:.2f} s '
+                     '({:.1f} files/s, {:.1f} MB/s)'.format(
+                         files,
+                         copied / 1e6,
+                         elapsed,
+                         files / max(elapsed, 1e-9),
+                         copied / 1e6 / max(elapsed, 1e-9)))
+
+        self.jobs = dict()
+
+        return files, copied, elapsed
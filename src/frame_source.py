@@ -0,0 +1,69 @@
+# Copyright 2018 Pedro Cuadra - pjcuadra@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import logging
+import cv2
+import tracing
+
+
+class FrameSource(object):
+    """
+    Read and decode images ahead of their consumer
+
+    Up to `depth` images are decoded in advance by `workers` background
+    threads while the consumer works on the current one. Once `depth` images
+    are waiting no more are read until the consumer takes one. Images are
+    yielded in the order of `paths` as (path, image) tuples. `cv2.imread`
+    releases the GIL so the decoding really runs in parallel.
+    """
+
+    def __init__(self, paths, depth=4, workers=2, decode=cv2.imread):
+        self.paths = list(paths)
+        self.depth = max(1, depth)
+        self.workers = max(1, workers)
+        self.decode = decode
+
+    def __len__(self):
+        return len(self.paths)
+
+    def read(self, path):
+        with tracing.span('decode', path=path):
+            return self.decode(path)
+
+    def __iter__(self):
+        pending = deque()
+        paths = iter(self.paths)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for path in paths:
+                pending.append((path, executor.submit(self.read, path)))
+                if len(pending) >= self.depth:
+                    break
+
+            while pending:
+                path, future = pending.popleft()
+
+                # Keep the queue full while the consumer works
+                for next_path in paths:
+                    pending.append((next_path,
+                                    executor.submit(self.read, next_path)))
+                    break
+
+                image = future.result()
+
+                if image is None:
+                    logging.warning('Image could not be decoded ' + path)
+
+                yield path, image
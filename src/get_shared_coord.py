@@ -11,49 +11,114 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from options import getopts
 from sys import argv
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import cv2
 import numpy as np
 import json
+import os
 import cv2.aruco as aruco
-
-
-def getopts(argv):
-    opts = {}  # Empty dictionary to store key-value pairs.
-    while argv:  # While there are arguments left to parse...
-        if argv[0][0] is '-':  # Found a "-name value" pair.
-            if len(argv) > 1:
-                if argv[1][0] != '-':
-                    opts[argv[0]] = argv[1]
-                else:
-                    opts[argv[0]] = True
-            elif len(argv) == 1:
-                opts[argv[0]] = True
-
-        # Reduce the argument list by copying it starting from index 1.
-        argv = argv[1:]
-    return opts
+from detection_cache import DetectionCache
+from transforms import Transform
+import tracing
+
+
+# Padding added around the previous corners of a marker to search it again,
+# relative to the marker size in pixels
+roi_padding = 0.5
+roi_min_padding = 16
+
+# Marker detector settings by name
+#  * dictionary: Aruco dictionary. Only the ids 1, 23 and 66 are used so
+#    DICT_6X6_100, which holds the first 100 markers of DICT_6X6_250, is
+#    enough and cheaper to match against
+#  * refinement: Corner refinement method of the Aruco detector
+#  * refinement_window: Half size of the Aruco corner refinement window
+#  * threshold_windows: Minimum, maximum and step of the adaptive threshold
+#    window sizes. The image is thresholded once per window size
+#  * min_perimeter_rate: Minimum perimeter of a marker relative to the
+#    largest side of the image
+#  * scale: Scale the image is downscaled by before the detection. The
+#    corners found are scaled back and refined on the full resolution image
+#  * min_size: Minimum length in pixels of the largest side of the
+#    downscaled image
+#  * subpix_window: Half size of the corner refinement window on the full
+#    resolution image
+#  * tiles: Rows and columns of tiles the image is split into. Each tile is
+#    detected in parallel with the `tile_preset` settings
+#  * max_marker_size: Largest marker, width or height in pixels, the tiles
+#    must hold whole. Neighbouring tiles overlap by this size
+#  * min_tiled_size: Minimum length in pixels of the largest side of the
+#    image to split it into tiles. Smaller images, or any image if there is
+#    a single CPU to detect the tiles on, are detected whole with the
+#    `tile_preset` settings
+#  * coarse_marker_size: Size in pixels markers of `max_marker_size` are
+#    downscaled to, by a whole factor, for a coarse detection of the whole
+#    image, which finds the markers too large for the tiles. None to skip it
+#  * merge_distance: Mean distance between the corners of two detections of
+#    the same id, relative to the marker side, to consider them the same
+#    marker
+detector_presets = {
+    'default': {'dictionary': aruco.DICT_6X6_250,
+                'refinement': aruco.CORNER_REFINE_SUBPIX,
+                'scale': 1.0},
+    'pyramid': {'dictionary': aruco.DICT_6X6_250,
+                'refinement': aruco.CORNER_REFINE_NONE,
+                'scale': 0.5,
+                'min_size': 400,
+                'subpix_window': 5},
+    'fast': {'dictionary': aruco.DICT_6X6_100,
+             'refinement': aruco.CORNER_REFINE_NONE,
+             'threshold_windows': (13, 13, 10),
+             'min_perimeter_rate': 0.05,
+             'scale': 1.0},
+    'balanced': {'dictionary': aruco.DICT_6X6_100,
+                 'refinement': aruco.CORNER_REFINE_SUBPIX,
+                 'threshold_windows': (3, 23, 10),
+                 'min_perimeter_rate': 0.03,
+                 'scale': 1.0},
+    'accurate': {'dictionary': aruco.DICT_6X6_250,
+                 'refinement': aruco.CORNER_REFINE_SUBPIX,
+                 'refinement_window': 7,
+                 'threshold_windows': (3, 33, 5),
+                 'min_perimeter_rate': 0.02,
+                 'scale': 1.0},
+    'tiled': {'tiles': (2, 2),
+              'max_marker_size': 400,
+              'min_tiled_size': 1600,
+              'tile_preset': 'default',
+              'coarse_marker_size': 48,
+              'subpix_window': 5,
+              'merge_distance': 0.2},
+}
+
+subpix_criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01)
+
+# Detectors already set up, by preset name
+detectors = dict()
+
+# Thread pool detecting the tiles of an image
+tile_executor = None
 
 
 def calc_3d_location_camera(rvec, tvec, marker_3d):
-    rotation_matrix, d = cv2.Rodrigues(rvec)
+    """
+    Map points of the camera coordinates system to the marker one
 
-    logging.debug(rotation_matrix)
+    A single point is returned as 3x1 column, an (N, 3) array of points
+    as (N, 3) array.
+    """
+    camera_to_marker = Transform.from_pose(rvec, tvec).inverse
 
-    reversed_rotation_matrix = np.linalg.inv(rotation_matrix)
-    logging.debug(reversed_rotation_matrix)
+    logging.debug(camera_to_marker.matrix)
 
-    # Calculate the reversed tranlation vector
-    reversed_translation = np.matmul(reversed_rotation_matrix,
-                                     -np.transpose(tvec))
+    marker_3d = np.asarray(marker_3d, dtype=np.float64)
+    camera_3d = camera_to_marker.apply(marker_3d)
 
-    # Calculate the normal vector by projecting the point (0, 0, 1)
-    camera_3d = cv2.gemm(reversed_rotation_matrix,
-                         marker_3d,
-                         1,
-                         reversed_translation,
-                         1)
+    if marker_3d.ndim == 1:
+        return camera_3d.reshape(3, 1)
 
     return camera_3d
 
@@ -83,11 +148,38 @@ def get_coordinates(in_path,
                     out_path=None,
                     parameters_path=None,
                     show_window=False,
-                    marker_size=0.071):
+                    marker_size=0.071,
+                    cache=None,
+                    input_image=None,
+                    tracker=None,
+                    hint=None,
+                    preset='default'):
+    """
+    Get the coordinates system of the markers in an image
+
+    The image is read from `in_path` unless it was already decoded and
+    given as `input_image`. See get_coordinates_system for `hint`.
+    """
     fs = cv2.FileStorage(camera, cv2.FILE_STORAGE_READ)
 
-    # Read the input image
-    input_image = cv2.imread(in_path)
+    cache_key = None
+    detection = None
+
+    if cache is not None and tracker is None:
+        cache_key = cache.get_key(cache.digest_file(in_path),
+                                  cache.digest_file(camera),
+                                  marker_size,
+                                  preset)
+
+        # Looked up once, the entry may be evicted by another process
+        detection = cache.get(cache_key)
+
+    # The image is only needed if it has to be drawn or detection run on it
+    if input_image is None and (show_window or out_path is not None or
+                                detection is None):
+        # Read the input image
+        with tracing.span('decode', path=in_path):
+            input_image = cv2.imread(in_path)
 
     # Get the camera model
     intrinsics = fs.getNode("camera_matrix")
@@ -104,7 +196,471 @@ def get_coordinates(in_path,
                                   out_path,
                                   parameters_path,
                                   show_window,
-                                  marker_size)
+                                  marker_size,
+                                  cache,
+                                  cache_key,
+                                  tracker,
+                                  hint,
+                                  preset,
+                                  detection=detection)
+
+
+def get_detector(preset='default'):
+    """
+    Get the Aruco dictionary and detector parameters of a preset
+
+    Tiled presets get the ones of their `tile_preset`.
+    """
+    if preset in detectors:
+        return detectors[preset]
+
+    settings = detector_presets[preset]
+
+    if 'tiles' in settings:
+        detectors[preset] = get_detector(settings['tile_preset'])
+        return detectors[preset]
+
+    aruco_dict = aruco.Dictionary_get(settings['dictionary'])
+    parameters = aruco.DetectorParameters_create()
+    parameters.cornerRefinementMethod = settings['refinement']
+
+    if 'refinement_window' in settings:
+        parameters.cornerRefinementWinSize = settings['refinement_window']
+
+    if 'threshold_windows' in settings:
+        window_min, window_max, window_step = settings['threshold_windows']
+        parameters.adaptiveThreshWinSizeMin = window_min
+        parameters.adaptiveThreshWinSizeMax = window_max
+        parameters.adaptiveThreshWinSizeStep = window_step
+
+    if 'min_perimeter_rate' in settings:
+        parameters.minMarkerPerimeterRate = settings['min_perimeter_rate']
+
+    detectors[preset] = (aruco_dict, parameters)
+
+    return detectors[preset]
+
+
+def get_detection_scale(input_image, preset='default'):
+    """Get the scale the image is downscaled by to detect the markers"""
+    settings = detector_presets[preset]
+    scale = settings['scale']
+
+    if scale >= 1:
+        return 1.0
+
+    size = max(input_image.shape[:2])
+
+    return min(1.0, max(scale, settings.get('min_size', 0) / float(size)))
+
+
+def refine_corners(input_image, corners, window):
+    """Refine corners found on a downscaled image on the full resolution"""
+    gray = input_image
+    if len(input_image.shape) == 3:
+        gray = cv2.cvtColor(input_image, cv2.COLOR_BGR2GRAY)
+
+    for marker_corners in corners:
+        refined = cv2.cornerSubPix(gray,
+                                   marker_corners.reshape(-1, 1, 2),
+                                   (window, window),
+                                   (-1, -1),
+                                   subpix_criteria)
+        marker_corners[...] = refined.reshape(marker_corners.shape)
+
+    return corners
+
+
+def get_tiles(shape, tiles, overlap):
+    """
+    Get the (x0, y0, x1, y1) regions of overlapping tiles of an image
+
+    Neighbouring tiles overlap by `overlap` pixels, so anything up to that
+    size lies whole on at least one of them.
+    """
+    rows, cols = tiles
+    height, width = shape[:2]
+    tile_height = height / float(rows)
+    tile_width = width / float(cols)
+    pad_y = overlap / 2.0
+    pad_x = overlap / 2.0
+
+    regions = list()
+
+    for row in range(rows):
+        for col in range(cols):
+            regions.append((max(0, int(col * tile_width - pad_x)),
+                            max(0, int(row * tile_height - pad_y)),
+                            min(width, int((col + 1) * tile_width + pad_x)),
+                            min(height, int((row + 1) * tile_height + pad_y))))
+
+    return regions
+
+
+def get_cpu_count():
+    """Get the CPUs this process may run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count() or 1
+
+
+def get_tile_executor():
+    global tile_executor
+
+    if tile_executor is None:
+        tile_executor = ThreadPoolExecutor()
+
+    return tile_executor
+
+
+def detect_markers_tile(input_image, region, intrinsics, distortion, preset):
+    """Detect the markers of a tile and map them to the full image"""
+    x0, y0, x1, y1 = region
+    corners, ids = detect_markers(input_image[y0:y1, x0:x1],
+                                  intrinsics,
+                                  distortion,
+                                  preset)
+
+    detections = list()
+
+    if ids is None:
+        return detections
+
+    height, width = input_image.shape[:2]
+
+    for marker_id, marker_corners in zip(ids.ravel(), corners):
+        # Distance to the closest tile edge that isn't an image edge
+        margins = [np.min(marker_corners[0, :, 0]) if x0 > 0 else np.inf,
+                   np.min(marker_corners[0, :, 1]) if y0 > 0 else np.inf,
+                   x1 - x0 - np.max(marker_corners[0, :, 0])
+                   if x1 < width else np.inf,
+                   y1 - y0 - np.max(marker_corners[0, :, 1])
+                   if y1 < height else np.inf]
+
+        detections.append((int(marker_id),
+                           marker_corners + np.array([x0, y0], np.float32),
+                           min(margins)))
+
+    return detections
+
+
+def merge_detections(detections, merge_distance):
+    """
+    Merge the detections of the same marker found on several tiles
+
+    Detections of the same id whose corners are closer than `merge_distance`
+    times the marker side are the same marker. The one furthest from its
+    tile edges is kept.
+    """
+    merged = list()
+
+    for marker_id, marker_corners, margin in sorted(detections,
+                                                    key=lambda d: -d[2]):
+        duplicate = False
+
+        for other_id, other_corners in merged:
+            if other_id != marker_id:
+                continue
+
+            side = np.mean(np.linalg.norm(other_corners[0] -
+                                          np.roll(other_corners[0], 1, axis=0),
+                                          axis=1))
+            distance = np.mean(np.linalg.norm(other_corners[0] -
+                                              marker_corners[0],
+                                              axis=1))
+
+            if distance < merge_distance * side:
+                duplicate = True
+                break
+
+        if not duplicate:
+            merged.append((marker_id, marker_corners))
+
+    return merged
+
+
+def detect_markers_tiled(input_image, intrinsics, distortion, preset):
+    """
+    Detect the Aruco Markers of an image split into overlapping tiles
+
+    The tiles are detected in parallel by a thread pool, OpenCV releases
+    the GIL while detecting. The whole image is detected as well on a
+    coarse copy, downscaled so that only markers too large for the tiles
+    are found, which costs a small fraction of a tile. Markers found more
+    than once are merged before their pose is estimated. Images smaller
+    than `min_tiled_size` are detected whole, as well as any image on a
+    single CPU where the tiles can't be detected in parallel.
+    """
+    settings = detector_presets[preset]
+
+    if (max(input_image.shape[:2]) < settings['min_tiled_size'] or
+            get_cpu_count() < 2):
+        return detect_markers(input_image,
+                              intrinsics,
+                              distortion,
+                              settings['tile_preset'])
+
+    # Converted once instead of on every tile
+    if len(input_image.shape) == 3:
+        input_image = cv2.cvtColor(input_image, cv2.COLOR_BGR2GRAY)
+
+    regions = get_tiles(input_image.shape,
+                        settings['tiles'],
+                        settings['max_marker_size'])
+
+    executor = get_tile_executor()
+    futures = [executor.submit(detect_markers_tile,
+                               input_image,
+                               region,
+                               intrinsics,
+                               distortion,
+                               settings['tile_preset'])
+               for region in regions]
+
+    coarse = None
+    if settings.get('coarse_marker_size') is not None:
+        factor = max(1, settings['max_marker_size'] //
+                     settings['coarse_marker_size'])
+
+        # The corners found are off by up to the factor
+        coarse = executor.submit(detect_markers_scaled,
+                                 input_image,
+                                 intrinsics,
+                                 distortion,
+                                 settings['tile_preset'],
+                                 1.0 / factor,
+                                 max(settings['subpix_window'], factor))
+
+    detections = list()
+    for future in futures:
+        detections += future.result()
+
+    if coarse is not None:
+        corners, ids = coarse.result()
+
+        # Prefer the full resolution tiles
+        if ids is not None:
+            detections += [(int(marker_id), marker_corners, -1)
+                           for marker_id, marker_corners in zip(ids.ravel(),
+                                                                corners)]
+
+    merged = merge_detections(detections, settings['merge_distance'])
+
+    if len(merged) == 0:
+        return [], None
+
+    ids = np.array([[marker_id] for marker_id, _ in merged], dtype=np.int32)
+    corners = [marker_corners for _, marker_corners in merged]
+
+    return corners, ids
+
+
+def detect_markers(input_image, intrinsics, distortion, preset='default'):
+    """
+    Detect the Aruco Markers of an image
+
+    Presets with a scale below one detect the markers on a downscaled copy
+    of the image and refine the corners found on the full resolution one.
+    Presets with tiles detect the markers on overlapping tiles in parallel.
+    """
+    if 'tiles' in detector_presets[preset]:
+        return detect_markers_tiled(input_image,
+                                    intrinsics,
+                                    distortion,
+                                    preset)
+
+    return detect_markers_scaled(input_image,
+                                 intrinsics,
+                                 distortion,
+                                 preset,
+                                 get_detection_scale(input_image, preset),
+                                 detector_presets[preset].get('subpix_window'))
+
+
+def detect_markers_scaled(input_image, intrinsics, distortion, preset, scale,
+                          subpix_window):
+    """
+    Detect the Aruco Markers of an image downscaled by `scale`
+
+    The corners found are refined on the full resolution image within
+    `subpix_window` pixels.
+    """
+    aruco_dict, parameters = get_detector(preset)
+
+    detect_image = input_image
+    if scale < 1:
+        detect_image = cv2.resize(input_image,
+                                  None,
+                                  fx=scale,
+                                  fy=scale,
+                                  interpolation=cv2.INTER_AREA)
+
+    with tracing.span('detect_markers'):
+        corners, ids, rejectedImgPoints = aruco.detectMarkers(
+                                            detect_image,
+                                            aruco_dict,
+                                            intrinsics.mat(),
+                                            distortion.mat(),
+                                            parameters=parameters)
+
+    if scale < 1 and len(corners) != 0:
+        # Pixel centers are at half pixels
+        corners = [np.ascontiguousarray((marker_corners + 0.5) / scale - 0.5,
+                                        dtype=np.float32)
+                   for marker_corners in corners]
+        refine_corners(input_image, corners, subpix_window)
+
+    return corners, ids
+
+
+def get_marker_hint(ids, corners):
+    """Get the corners per id of a detection to use as hint on the next one"""
+    if ids is None:
+        return None
+
+    return {int(marker_id): np.asarray(marker_corners).reshape(4, 2)
+            for marker_id, marker_corners in zip(ids.ravel(), corners)}
+
+
+def get_roi(marker_corners, shape, padding=roi_padding):
+    """Get the padded bounding box (x0, y0, x1, y1) of a marker"""
+    x0, y0 = np.min(marker_corners, axis=0)
+    x1, y1 = np.max(marker_corners, axis=0)
+
+    pad = max(roi_min_padding, padding * max(x1 - x0, y1 - y0))
+
+    return (max(0, int(x0 - pad)),
+            max(0, int(y0 - pad)),
+            min(shape[1], int(np.ceil(x1 + pad))),
+            min(shape[0], int(np.ceil(y1 + pad))))
+
+
+def merge_rois(rois):
+    """Merge overlapping regions so no marker is searched for twice"""
+    rois = list(rois)
+    merged = True
+
+    while merged:
+        merged = False
+
+        for i in range(len(rois)):
+            for j in range(i + 1, len(rois)):
+                a = rois[i]
+                b = rois[j]
+
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    rois[i] = (min(a[0], b[0]), min(a[1], b[1]),
+                               max(a[2], b[2]), max(a[3], b[3]))
+                    del rois[j]
+                    merged = True
+                    break
+
+            if merged:
+                break
+
+    return rois
+
+
+def detect_markers_roi(input_image, intrinsics, distortion, hint,
+                       padding=roi_padding, preset='default'):
+    """
+    Detect the Aruco Markers of an image only around their previous corners
+
+    `hint` maps the id of each marker to its corners on the previous frame.
+    The detection runs on a padded crop around each of them and the corners
+    found are mapped back to the full frame. Returns None if any of the
+    markers was lost so a full search can be run instead.
+    """
+    rois = merge_rois(get_roi(marker_corners, input_image.shape, padding)
+                      for marker_corners in hint.values())
+
+    found = dict()
+
+    for x0, y0, x1, y1 in rois:
+        corners, ids = detect_markers(input_image[y0:y1, x0:x1],
+                                      intrinsics,
+                                      distortion,
+                                      preset)
+        if ids is None:
+            continue
+
+        for marker_id, marker_corners in zip(ids.ravel(), corners):
+            if int(marker_id) in found:
+                continue
+
+            found[int(marker_id)] = marker_corners + np.array([x0, y0],
+                                                              np.float32)
+
+    for marker_id in hint:
+        if marker_id not in found:
+            logging.debug('Marker {} lost'.format(marker_id))
+            return None
+
+    ids = np.array([[marker_id] for marker_id in found], dtype=np.int32)
+    corners = [found[marker_id] for marker_id in found]
+
+    return corners, ids
+
+
+def detect_markers_pose(input_image, intrinsics, distortion, marker_size,
+                        cache=None, cache_key=None, tracker=None, hint=None,
+                        preset='default', detection=None):
+    """
+    Detect the Aruco Markers of an image and their pose
+
+    If a cache is given the detection is looked up there first and stored
+    there afterwards, unless the cache entry was already looked up and is
+    given as `detection`. If the image is part of a sequence followed by a
+    marker_tracker.MarkerTracker the markers are obtained from it instead.
+    With a `hint` the markers are searched for around their previous corners
+    first and only the full image is searched if any of them was lost.
+    `preset` names the detector settings in detector_presets.
+    """
+    if tracker is not None:
+        return tracker.process(input_image)
+
+    if detection is None and cache is not None and cache_key is not None:
+        detection = cache.get(cache_key)
+
+    if detection is not None:
+        logging.debug('Detection cache hit {}'.format(cache_key))
+        return detection
+
+    if hint:
+        detection = detect_markers_roi(input_image,
+                                       intrinsics,
+                                       distortion,
+                                       hint,
+                                       preset=preset)
+
+    if detection is None:
+        detection = detect_markers(input_image,
+                                   intrinsics,
+                                   distortion,
+                                   preset)
+    else:
+        # Only detections on the full image are stored
+        cache_key = None
+
+    corners, ids = detection
+
+    rvecs = None
+    tvecs = None
+
+    if len(corners) != 0:
+        # Detect the camera pose
+        with tracing.span('pose_estimation'):
+            rvecs, tvecs, n = aruco.estimatePoseSingleMarkers(
+                                    corners,
+                                    marker_size,
+                                    intrinsics.mat(),
+                                    distortion.mat())
+
+    if cache is not None and cache_key is not None:
+        cache.put(cache_key, ids, corners, rvecs, tvecs)
+
+    return ids, corners, rvecs, tvecs
 
 
 def get_coordinates_system(input_image,
@@ -113,19 +669,32 @@ def get_coordinates_system(input_image,
                            out_path=None,
                            parameters_path=None,
                            show_window=False,
-                           marker_size=0.071):
-
-    # Detect the Aruco Markers
-    aruco_dict = aruco.Dictionary_get(aruco.DICT_6X6_250)
-    parameters = aruco.DetectorParameters_create()
-    parameters.cornerRefinementMethod = aruco.CORNER_REFINE_SUBPIX
-
-    corners, ids, rejectedImgPoints = aruco.detectMarkers(input_image,
-                                                          aruco_dict,
-                                                          intrinsics.mat(),
-                                                          distortion.mat(),
-                                                          parameters=parameters
-                                                          )
+                           marker_size=0.071,
+                           cache=None,
+                           cache_key=None,
+                           tracker=None,
+                           hint=None,
+                           preset='default',
+                           detection=None):
+    """
+    Get the coordinates system of the markers in an image
+
+    `hint` optionally maps marker ids to their corners on the previous frame
+    of a sequence, as returned by get_marker_hint, to search for them there
+    first. `preset` names the detector settings in detector_presets.
+    `detection` is the cache entry of `cache_key` if it was already looked
+    up, then `input_image` is only needed to draw on it.
+    """
+    ids, corners, rvecs, tvecs = detect_markers_pose(input_image,
+                                                     intrinsics,
+                                                     distortion,
+                                                     marker_size,
+                                                     cache,
+                                                     cache_key,
+                                                     tracker,
+                                                     hint,
+                                                     preset,
+                                                     detection)
     if len(corners) == 0:
         return None, None, None
 
@@ -134,6 +703,39 @@ def get_coordinates_system(input_image,
     logging.debug(ids)
     logging.debug(" -> Corners: ")
     logging.debug(corners)
+
+    logging.debug("Camera Pose: ")
+    logging.debug(" -> Rotation Vector: ")
+    logging.debug(rvecs)
+    logging.debug(" -> Translation Vector: ")
+    logging.debug(tvecs)
+
+    if show_window or out_path is not None:
+        # Prepare the output image
+        output_image = aruco.drawDetectedMarkers(input_image, corners)
+        draw_marker_axis(input_image, intrinsics.mat(), distortion.mat(),
+                         rvecs,
+                         tvecs)
+
+    # Show the window
+    if show_window:
+        cv2.imshow('Window', output_image)
+        cv2.waitKey(0)
+
+    # Write the image to the output path
+    if out_path is not None:
+        cv2.imwrite(out_path, output_image)
+
+    json_content = get_coordinates_json(ids, corners, rvecs, tvecs)
+
+    if parameters_path:
+        tracing.write_json(parameters_path, json_content)
+
+    return ids, corners, json_content
+
+
+def get_coordinates_json(ids, corners, rvecs, tvecs):
+    """Build the coordinates JSON content from the markers pose"""
     logging.debug(" -> Centers: ")
 
     centers = list()
@@ -148,72 +750,34 @@ def get_coordinates_system(input_image,
 
     logging.debug('Centers {}'.format(centers))
 
-    # Detect the camera pose
-    rvecs, tvecs, n = aruco.estimatePoseSingleMarkers(corners,
-                                                      marker_size,
-                                                      intrinsics.mat(),
-                                                      distortion.mat())
+    return get_pose_json(ids, centers, rvecs, tvecs)
 
-    logging.debug("Camera Pose: ")
-    logging.debug(" -> Rotation Vector: ")
-    logging.debug(rvecs)
-    logging.debug(" -> Translation Vector: ")
-    logging.debug(tvecs)
 
+def get_pose_json(ids, centers, rvecs, tvecs):
+    """
+    Build the coordinates JSON content from the markers pose and centers
+
+    The 3D location, normal and x axis of each marker are derived from its
+    rotation and translation vectors.
+    """
     rrvecs = list()
     rtvecs = list()
     nvecs = list()
     xvecs = list()
 
-    # Calculte normal vector for each marker
-    for i in range(0, len(rvecs)):
-        # Reverse the pose
-        # Calculate the reversed Rotation matrix
-        rotation_matrix, d = cv2.Rodrigues(rvecs[i])
-
-        logging.debug(rotation_matrix)
-
-        reversed_rotation_matrix = np.linalg.inv(rotation_matrix)
-        logging.debug(reversed_rotation_matrix)
-
-        # Calculate the reversed tranlation vector
-        reversed_translation = np.matmul(reversed_rotation_matrix,
-                                         -np.transpose(tvecs[i]))
-
-        rod, d = cv2.Rodrigues(reversed_rotation_matrix)
-        rrvecs.append(np.transpose(rod))
-        rtvecs.append(np.transpose(reversed_translation))
-
-        normal = calc_3d_location_camera(rvecs[i], tvecs[i], (0, 0, 1))
-
-        normal -= reversed_translation
-
-        nvecs.append(normal)
-
-    # Caculate the x axis unit vector
     for i in range(0, len(rvecs)):
         # Reverse the pose
-        # Calculate the reversed Rotation matrix
-        rotation_matrix, d = cv2.Rodrigues(rvecs[i])
-
-        logging.debug(rotation_matrix)
-
-        reversed_rotation_matrix = np.linalg.inv(rotation_matrix)
-        logging.debug(reversed_rotation_matrix)
+        camera_to_marker = Transform.from_pose(rvecs[i], tvecs[i]).inverse
 
-        # Calculate the reversed tranlation vector
-        reversed_translation = np.matmul(reversed_rotation_matrix,
-                                         -np.transpose(tvecs[i]))
+        rrvecs.append(np.transpose(camera_to_marker.rvec))
+        rtvecs.append(camera_to_marker.translation.reshape(1, 3))
 
-        rod, d = cv2.Rodrigues(reversed_rotation_matrix)
-        rrvecs.append(np.transpose(rod))
-        rtvecs.append(np.transpose(reversed_translation))
+        # Normal and x axis unit vectors, the (0, 0, 1) and (1, 0, 0)
+        # directions of the camera in the marker coordinates system
+        axes = camera_to_marker.apply_vectors(np.identity(3))
 
-        xaxis = calc_3d_location_camera(rvecs[i], tvecs[i], (1, 0, 0))
-
-        xaxis -= reversed_translation
-
-        xvecs.append(xaxis)
+        nvecs.append(axes[2].reshape(3, 1))
+        xvecs.append(axes[0].reshape(3, 1))
 
     logging.debug("Marker Pose: ")
     logging.debug(" -> Rotation Vector: ")
@@ -224,22 +788,6 @@ def get_coordinates_system(input_image,
     logging.debug("Normal Vectors: ")
     logging.debug(nvecs)
 
-    if show_window or out_path is not None:
-        # Prepare the output image
-        output_image = aruco.drawDetectedMarkers(input_image, corners)
-        draw_marker_axis(input_image, intrinsics.mat(), distortion.mat(),
-                        rvecs,
-                        tvecs)
-
-    # Show the window
-    if show_window:
-        cv2.imshow('Window', output_image)
-        cv2.waitKey(0)
-
-    # Write the image to the output path
-    if out_path is not None:
-        cv2.imwrite(out_path, output_image)
-
     # Add data to JSON
     json_content = dict()
 
@@ -263,11 +811,7 @@ def get_coordinates_system(input_image,
 
     logging.debug(json.dumps(json_content))
 
-    if parameters_path:
-        with open(parameters_path, 'w') as outfile:
-            json.dump(json_content, outfile, indent=4)
-
-    return ids, corners, json_content
+    return json_content
 
 
 if __name__ == '__main__':
@@ -277,6 +821,8 @@ if __name__ == '__main__':
     params_path = None
     show_window = False
     marker_size = 0.071
+    cache = None
+    preset = 'default'
 
     if '-v' in myargs:
         logging.basicConfig(level=logging.debug)
@@ -310,9 +856,21 @@ if __name__ == '__main__':
     if '-m' in myargs:
         marker_size = myargs['-m']
 
+    if '-k' in myargs:
+        cache = DetectionCache(myargs['-k'])
+
+    if '--preset' in myargs:
+        preset = myargs['--preset']
+
+        if preset not in detector_presets:
+            logging.error('Unknown detector preset ' + preset)
+            exit(-1)
+
     get_coordinates(in_path,
                     camera,
                     out_path,
                     params_path,
                     show_window,
-                    float(marker_size))
+                    float(marker_size),
+                    cache,
+                    preset=preset)
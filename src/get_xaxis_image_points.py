@@ -11,30 +11,16 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from options import getopts
 from sys import argv
 import logging
 import cv2
 import numpy as np
 from get_shared_coord import get_coordinates_system
+from detection_cache import hash_image
 
 
-def getopts(argv):
-    opts = {}  # Empty dictionary to store key-value pairs.
-    while argv:  # While there are arguments left to parse...
-        if argv[0][0] is '-':  # Found a "-name value" pair.
-            if len(argv) > 1:
-                if argv[1][0] != '-':
-                    opts[argv[0]] = argv[1]
-                else:
-                    opts[argv[0]] = True
-            elif len(argv) == 1:
-                opts[argv[0]] = True
-
-        # Reduce the argument list by copying it starting from index 1.
-        argv = argv[1:]
-    return opts
-
-def get_id_list(input_image, camera, marker_size, out_path=None):
+def get_id_list(input_image, camera, marker_size, out_path=None, cache=None):
     """
     Perform marker recognition of the image and return the data
     for markers found.
@@ -45,6 +31,7 @@ def get_id_list(input_image, camera, marker_size, out_path=None):
     :param output_path: (optional) path to image file. If not None, 
         a copy of the input image with markers and coordinate 
         systems drawn into it will be written to this file
+    :param cache: (optional) DetectionCache to look the detection up in
     
     :return: upon failure, None, None, None will be returned. Upon
         success, the method returns three objects:
@@ -66,11 +53,19 @@ def get_id_list(input_image, camera, marker_size, out_path=None):
     logging.debug('Camera Distortion: ')
     logging.debug(distortion.mat())
 
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.get_key(hash_image(input_image),
+                                  cache.digest_file(camera),
+                                  marker_size)
+
     ids, _, json_content = get_coordinates_system(input_image,
                                                   intrinsics,
                                                   distortion,
                                                   marker_size=marker_size,
-                                                  out_path=out_path)
+                                                  out_path=out_path,
+                                                  cache=cache,
+                                                  cache_key=cache_key)
     if ids is None:
         return None, None, None
     return ids.tolist(), json_content, fs
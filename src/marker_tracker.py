@@ -0,0 +1,228 @@
+# Copyright 2018 Pedro Cuadra - pjcuadra@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import cv2
+import numpy as np
+import cv2.aruco as aruco
+from get_shared_coord import detect_markers, detect_markers_roi
+from get_shared_coord import get_marker_hint
+import tracing
+
+
+# Markers used by the shared coordinates system
+tracked_ids = [23, 66, 1]
+
+lk_params = dict(winSize=(21, 21),
+                 maxLevel=3,
+                 criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT,
+                           30,
+                           0.01))
+
+
+def get_marker_object_points(marker_size):
+    """Get the marker corners in the marker coordinates system"""
+    half = marker_size / 2
+    return np.array([[-half, half, 0],
+                     [half, half, 0],
+                     [half, -half, 0],
+                     [-half, -half, 0]], dtype=np.float32)
+
+
+def to_gray(input_image):
+    if len(input_image.shape) == 2:
+        return input_image
+    return cv2.cvtColor(input_image, cv2.COLOR_BGR2GRAY)
+
+
+class MarkerTracker(object):
+    """
+    Track the markers of an image sequence between keyframes
+
+    The Aruco detection runs on keyframes only. In between, the four corners
+    of each known marker are tracked with pyramidal Lucas-Kanade optical
+    flow. A new keyframe is forced once `keyframe_interval` frames were
+    tracked, when the forward-backward tracking error of any corner exceeds
+    `max_flow_error` pixels or when the mean reprojection residual of the
+    estimated pose exceeds `max_reprojection_error` pixels. Keyframes are
+    detected with the detector `preset`.
+
+    Keyframes forced by the interval always search the full image, so
+    markers entering the view are found. When tracking is lost the markers
+    are searched for around their last corners first.
+    """
+
+    def __init__(self, intrinsics, distortion, marker_size=0.071,
+                 keyframe_interval=10, max_flow_error=1.0,
+                 max_reprojection_error=2.0, ids=tracked_ids,
+                 preset='default'):
+        self.intrinsics = intrinsics
+        self.distortion = distortion
+        self.marker_size = marker_size
+        self.keyframe_interval = keyframe_interval
+        self.max_flow_error = max_flow_error
+        self.max_reprojection_error = max_reprojection_error
+        self.ids = ids
+        self.preset = preset
+        self.object_points = get_marker_object_points(marker_size)
+
+        self.prev_gray = None
+        self.prev_ids = None
+        self.prev_corners = None
+        self.tracked_frames = 0
+
+        self.keyframes = 0
+        self.frames = 0
+
+    def estimate_pose(self, corners):
+        with tracing.span('pose_estimation'):
+            rvecs, tvecs, n = aruco.estimatePoseSingleMarkers(
+                                    corners,
+                                    self.marker_size,
+                                    self.intrinsics.mat(),
+                                    self.distortion.mat())
+        return rvecs, tvecs
+
+    def reprojection_error(self, corners, rvecs, tvecs):
+        """Get the worst mean reprojection residual of all markers"""
+        error = 0
+
+        for marker_corners, rvec, tvec in zip(corners, rvecs, tvecs):
+            projected, _ = cv2.projectPoints(self.object_points,
+                                             rvec,
+                                             tvec,
+                                             self.intrinsics.mat(),
+                                             self.distortion.mat())
+            residual = projected.reshape(-1, 2) - marker_corners.reshape(-1, 2)
+            error = max(error, np.mean(np.linalg.norm(residual, axis=1)))
+
+        return error
+
+    def detect(self, gray, reacquire=False):
+        """
+        Run the detection on a keyframe
+
+        To `reacquire` the markers after tracking was lost they are searched
+        for around their last tracked corners first.
+        """
+        detection = None
+
+        if (reacquire and self.prev_corners is not None and
+                gray.shape == self.prev_gray.shape):
+            hint = get_marker_hint(self.prev_ids,
+                                   self.prev_corners.reshape(-1, 4, 2))
+            detection = detect_markers_roi(gray,
+                                           self.intrinsics,
+                                           self.distortion,
+                                           hint,
+                                           preset=self.preset)
+
+        if detection is None:
+            detection = detect_markers(gray,
+                                       self.intrinsics,
+                                       self.distortion,
+                                       self.preset)
+
+        corners, ids = detection
+
+        self.keyframes += 1
+        self.tracked_frames = 0
+        self.prev_gray = gray
+        self.prev_ids = None
+        self.prev_corners = None
+
+        if ids is None or len(corners) == 0:
+            return None, [], None, None
+
+        rvecs, tvecs = self.estimate_pose(corners)
+
+        # Remember the known markers to track them
+        known = [idx for idx, val in enumerate(ids.ravel())
+                 if val in self.ids]
+
+        if known:
+            self.prev_ids = ids[known]
+            self.prev_corners = np.concatenate([corners[idx].reshape(-1, 2)
+                                                for idx in known])
+
+        return ids, corners, rvecs, tvecs
+
+    def track(self, gray):
+        """
+        Track the known markers from the previous frame
+
+        Returns None if tracking failed and a keyframe is needed.
+        """
+        if self.prev_corners is None:
+            return None
+
+        if self.tracked_frames >= self.keyframe_interval:
+            return None
+
+        if gray.shape != self.prev_gray.shape:
+            return None
+
+        prev_points = self.prev_corners.reshape(-1, 1, 2).astype(np.float32)
+
+        points, status, _ = cv2.calcOpticalFlowPyrLK(self.prev_gray,
+                                                     gray,
+                                                     prev_points,
+                                                     None,
+                                                     **lk_params)
+        back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(gray,
+                                                               self.prev_gray,
+                                                               points,
+                                                               None,
+                                                               **lk_params)
+
+        flow_error = np.linalg.norm((prev_points - back_points).reshape(-1, 2),
+                                    axis=1)
+
+        if (not status.all() or not back_status.all() or
+                flow_error.max() > self.max_flow_error):
+            logging.debug('Tracking lost, flow error {}'.format(
+                flow_error.max()))
+            return None
+
+        corners = [marker_corners.reshape(1, 4, 2)
+                   for marker_corners in points.reshape(-1, 4, 2)]
+
+        rvecs, tvecs = self.estimate_pose(corners)
+
+        error = self.reprojection_error(corners, rvecs, tvecs)
+        if error > self.max_reprojection_error:
+            logging.debug('Tracking lost, reprojection error {}'.format(error))
+            return None
+
+        self.tracked_frames += 1
+        self.prev_gray = gray
+        self.prev_corners = points.reshape(-1, 2)
+
+        return self.prev_ids, corners, rvecs, tvecs
+
+    def process(self, input_image):
+        """
+        Get the markers of the next frame of the sequence
+
+        Returns ids, corners, rvecs and tvecs like detect_markers_pose.
+        """
+        gray = to_gray(input_image)
+        self.frames += 1
+
+        forced = self.tracked_frames >= self.keyframe_interval
+        detection = self.track(gray)
+
+        if detection is None:
+            detection = self.detect(gray, reacquire=not forced)
+
+        return detection
@@ -0,0 +1,33 @@
+# Copyright 2018 Pedro Cuadra - pjcuadra@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Command line options of the scripts of this directory. Only builtins are
+# used, so importing it adds nothing to the start up time of a command.
+
+
+def getopts(argv):
+    opts = {}  # Empty dictionary to store key-value pairs.
+    while argv:  # While there are arguments left to parse...
+        if argv[0][0] == '-':  # Found a "-name value" pair.
+            if len(argv) > 1:
+                if argv[1][0] != '-':
+                    opts[argv[0]] = argv[1]
+                else:
+                    opts[argv[0]] = True
+            elif len(argv) == 1:
+                opts[argv[0]] = True
+
+        # Reduce the argument list by copying it starting from index 1.
+        argv = argv[1:]
+    return opts
@@ -0,0 +1,481 @@
+# Copyright 2018 Pedro Cuadra - pjcuadra@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from dependency_tracker import get_input_info, get_local_modules
+from dependency_tracker import hash_files, load_stamp
+from options import getopts
+from sys import argv
+import calc_stats
+import compare_perspective_stats
+import hashlib
+import json
+import logging
+import os
+import process_data_set
+import process_log
+import sys
+import time
+import tracing
+
+# Runs the analysis of the README as a single process. Stages hand their
+# results over in memory; only the statistics and comparisons (and the
+# per-frame outputs of process_data_set.py, which keeps its own stamps) are
+# written, plus a checkpoint of every stage if asked for.
+#
+# The configuration is a JSON file;
+#
+#   {"out": "<output path>",
+#    "marker_size": 0.071,
+#    "data_sets": {"<name>": {"path": "<data set>",
+#                             "camera": "<camera calibration file>",
+#                             "log": "<log file>",
+#                             "separation": "<separation file>"}},
+#    "compare": [["<name>", "<name>"]]}
+#
+# `separation` and `compare` are optional. Relative paths are relative to
+# the configuration file.
+
+state_file = 'state.json'
+
+
+def to_json(value):
+    """Convert the NumPy values json doesn't know about"""
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+
+    raise TypeError('{} is not JSON serializable'.format(type(value)))
+
+
+def get_digest(value):
+    content = json.dumps(value, sort_keys=True, default=to_json)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def write_json(path, content):
+    path_dir = os.path.dirname(path)
+    if path_dir and not os.path.exists(path_dir):
+        os.makedirs(path_dir)
+
+    with open(path, 'w') as outfile:
+        json.dump(content, outfile, indent=4, default=to_json)
+
+    return path
+
+
+class Stage(object):
+
+    def __init__(self, name, func, deps=(), inputs=(), values=None,
+                 write=None, volatile=False, modules=()):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.inputs = [os.path.abspath(path) for path in inputs]
+        self.values = values if values is not None else dict()
+        self.write = write
+        self.volatile = volatile
+        self.modules = list(modules)
+
+    def get_version(self):
+        """Digest of the code the stage runs, imported modules included"""
+        paths = {os.path.abspath(sys.modules[__name__].__file__)}
+
+        for module in self.modules:
+            paths.update(get_local_modules(module.__file__))
+
+        return hash_files(sorted(paths))
+
+
+class Pipeline(object):
+    """
+    Directed acyclic graph of stages run in a single process
+
+    A stage is a function taking the results of the stages it depends on.
+    Its fingerprint covers its values, the contents of its input files, the
+    code of its modules and the digests of the results of its dependencies.
+    Stages whose fingerprint didn't change and whose outputs exist are
+    skipped; their result is only loaded from their checkpoint, or computed
+    again if there is none, when a stage depending on them has to run.
+    Volatile stages always run and are told apart by the digest of their
+    result, like process_data_set which tracks its own frames.
+    """
+
+    def __init__(self, work_path, checkpoints=False):
+        self.work_path = work_path
+        self.checkpoints = checkpoints
+        self.stages = dict()
+        self.results = dict()
+        self.state = dict()
+        self.ran = list()
+        self.skipped = list()
+
+    def add(self, name, func, deps=(), inputs=(), values=None, write=None,
+            volatile=False, modules=()):
+        if name in self.stages:
+            raise ValueError('Duplicated stage ' + name)
+
+        self.stages[name] = Stage(name, func, deps, inputs, values, write,
+                                  volatile, modules)
+
+    def get_order(self):
+        """Stages sorted so each one comes after its dependencies"""
+        order = list()
+        pending = {name: set(stage.deps)
+                   for name, stage in self.stages.items()}
+
+        for name, deps in pending.items():
+            for dep in deps:
+                if dep not in self.stages:
+                    raise ValueError('{} depends on unknown stage {}'.format(
+                        name, dep))
+
+        while pending:
+            ready = sorted(name for name, deps in pending.items()
+                           if not deps)
+            if not ready:
+                raise ValueError('Cycle between stages {}'.format(
+                    sorted(pending)))
+
+            for name in ready:
+                order.append(name)
+                del pending[name]
+
+            for deps in pending.values():
+                deps.difference_update(ready)
+
+        return order
+
+    def get_checkpoint_path(self, name):
+        return os.path.join(self.work_path, name + '.json')
+
+    def get_fingerprint(self, stage, prev):
+        inputs = dict()
+        for path in stage.inputs:
+            prev_info = None
+            if prev is not None:
+                prev_info = prev['inputs'].get(path)
+            inputs[path] = get_input_info(path, prev_info)
+
+        fingerprint = get_digest({
+            'values': stage.values,
+            'inputs': {path: info['digest'] if info else None
+                       for path, info in inputs.items()},
+            'deps': [self.state[dep]['digest'] for dep in stage.deps],
+            'version': stage.get_version()})
+
+        return fingerprint, inputs
+
+    def get_result(self, name):
+        """Get the result of a stage, loading or computing it if needed"""
+        if name in self.results:
+            return self.results[name]
+
+        checkpoint = self.get_checkpoint_path(name)
+        if os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                content = json.loads(f.read())
+
+            if content['digest'] == self.state[name]['digest']:
+                logging.info('{} loaded from checkpoint'.format(name))
+                self.results[name] = content['result']
+                return content['result']
+
+        self.execute(self.stages[name])
+
+        return self.results[name]
+
+    def execute(self, stage):
+        args = [self.get_result(dep) for dep in stage.deps]
+
+        start = time.perf_counter()
+        with tracing.span(stage.name):
+            result = stage.func(*args)
+        elapsed = time.perf_counter() - start
+
+        self.results[stage.name] = result
+        self.ran.append(stage.name)
+        logging.info('{} ran in {:.3f} s'.format(stage.name, elapsed))
+
+        digest = get_digest(result)
+
+        if self.checkpoints:
+            write_json(self.get_checkpoint_path(stage.name),
+                       {'digest': digest, 'result': result})
+
+        return digest
+
+    def run(self, force=False):
+        """Run the outdated stages, returns the number of stages run"""
+        order = self.get_order()
+
+        state_path = os.path.join(self.work_path, state_file)
+        prev_state = load_stamp(state_path) or dict()
+        self.state = dict()
+        self.results = dict()
+        self.ran = list()
+        self.skipped = list()
+
+        for name in order:
+            stage = self.stages[name]
+            prev = prev_state.get(name)
+            fingerprint, inputs = self.get_fingerprint(stage, prev)
+
+            if (not force and not stage.volatile and prev is not None and
+                    prev['fingerprint'] == fingerprint and
+                    all(os.path.exists(path) for path in prev['outputs'])):
+                logging.debug('{} is up to date'.format(name))
+                self.skipped.append(name)
+                self.state[name] = dict(prev, inputs=inputs)
+                continue
+
+            digest = self.execute(stage)
+
+            outputs = list()
+            if stage.write is not None:
+                outputs = stage.write(self.results[name])
+
+            self.state[name] = {'fingerprint': fingerprint,
+                                'digest': digest,
+                                'inputs': inputs,
+                                'outputs': outputs}
+
+            write_json(state_path, self.state)
+
+        write_json(state_path, self.state)
+
+        logging.info('Ran {} stages, {} up to date'.format(len(self.ran),
+                                                          len(self.skipped)))
+
+        return len(self.ran)
+
+
+def get_positions(records, log, separation=None):
+    """
+    Group the records of the frames of a data set by position
+
+    Without separation file all the frames, including the ones only found
+    in the log, make up a single position named ''. Each frame record gets
+    its `hl_rc` log data as well.
+    """
+    frames = dict()
+    for base, record in records.items():
+        frames[base] = dict(record, hl_rc=log['frames'].get(base))
+
+    if separation is None:
+        for base, data in log['frames'].items():
+            if base not in frames:
+                frames[base] = {'hl_dl': None,
+                                'marker_camera': None,
+                                'marker': None,
+                                'hl_rc': data}
+
+        return {'': {'frames': frames, 'shared': log['shared']}}
+
+    positions = dict()
+    for position, pics in separation.items():
+        bases = [os.path.splitext(pic)[0] for pic in pics]
+        positions[position] = {'frames': {base: frames[base]
+                                          for base in bases
+                                          if base in frames},
+                               'shared': log['shared']}
+
+    return positions
+
+
+def get_position_stats(positions):
+    """Get the statistics calc_stats.py writes for each position"""
+    stats = dict()
+
+    for position, content in positions.items():
+        records = [content['frames'][base]
+                   for base in sorted(content['frames'],
+                                      key=process_data_set.get_frame_order)]
+
+        stats[position] = {
+            'hl_rc': calc_stats.get_hl_rc_stats(
+                [r['hl_rc'] for r in records if r['hl_rc'] is not None]),
+            'hl_dl': calc_stats.get_hl_dl_stats(
+                [r['hl_dl'] for r in records if r['hl_dl'] is not None]),
+            'marker': calc_stats.get_marker_stats(
+                [r['marker'] for r in records if r['marker'] is not None])}
+
+    return stats
+
+
+def compare_stats(stats_0, stats_1):
+    """Compare the statistics of the positions of two data sets"""
+    comparison = dict()
+
+    for position in sorted(set(stats_0) & set(stats_1)):
+        comparison[position] = {
+            'marker': compare_perspective_stats.compare_marker_stats(
+                stats_0[position]['marker'], stats_1[position]['marker']),
+            'rc': compare_perspective_stats.compare_hl_rc_stats(
+                stats_0[position]['hl_rc'], stats_1[position]['hl_rc'])}
+
+    return comparison
+
+
+def write_stats(out_path, stats):
+    outputs = list()
+
+    for position, content in stats.items():
+        for key in ('hl_rc', 'hl_dl', 'marker'):
+            outputs.append(write_json(os.path.join(out_path, position,
+                                                   'stats', key + '.json'),
+                                      content[key]))
+
+    return outputs
+
+
+def write_comparison(out_path, comparison):
+    outputs = list()
+
+    for position, content in comparison.items():
+        for key in ('marker', 'rc'):
+            outputs.append(write_json(
+                os.path.join(out_path, position,
+                             'comparison_{}.json'.format(key)),
+                content[key]))
+
+    return outputs
+
+
+def load_config(config_path):
+    with open(config_path) as f:
+        config = json.loads(f.read())
+
+    base = os.path.dirname(os.path.abspath(config_path))
+
+    def resolve(path):
+        return os.path.join(base, path)
+
+    config['out'] = resolve(config.get('out', 'results'))
+
+    for data_set in config['data_sets'].values():
+        for key in ('path', 'camera', 'log', 'separation'):
+            if key in data_set:
+                data_set[key] = resolve(data_set[key])
+
+    return config
+
+
+def build_pipeline(config, checkpoints=False):
+    """Set up the stages of the analysis of the data sets of a config"""
+    pipeline = Pipeline(os.path.join(config['out'], 'pipeline'), checkpoints)
+    marker_size = config.get('marker_size', 0.071)
+
+    for name, data_set in sorted(config['data_sets'].items()):
+        def run_process_data_set(data_set=data_set):
+            records = dict()
+            process_data_set.process_data_set(data_set['path'],
+                                              data_set['camera'],
+                                              marker_size,
+                                              records=records)
+            return records
+
+        def run_process_log(data_set=data_set):
+            parsed = process_log.parse_log(data_set['log'])
+            if parsed is None:
+                raise ValueError('Empty log ' + data_set['log'])
+
+            frames, shared = parsed
+            return {'frames': frames, 'shared': shared}
+
+        def run_separate(records, log, data_set=data_set):
+            separation = None
+            if 'separation' in data_set:
+                with open(data_set['separation']) as f:
+                    separation = json.loads(f.read())
+
+            return get_positions(records, log, separation)
+
+        def run_write_stats(stats, name=name):
+            return write_stats(os.path.join(config['out'], name), stats)
+
+        pipeline.add(name + '/process_data_set',
+                     run_process_data_set,
+                     values={'path': data_set['path'],
+                             'camera': data_set['camera'],
+                             'marker_size': marker_size},
+                     volatile=True,
+                     modules=[process_data_set])
+        pipeline.add(name + '/process_log',
+                     run_process_log,
+                     inputs=[data_set['log']],
+                     modules=[process_log])
+        pipeline.add(name + '/separate_by_position',
+                     run_separate,
+                     deps=[name + '/process_data_set', name + '/process_log'],
+                     inputs=[data_set[key] for key in ('separation',)
+                             if key in data_set])
+        pipeline.add(name + '/calc_stats',
+                     get_position_stats,
+                     deps=[name + '/separate_by_position'],
+                     write=run_write_stats,
+                     modules=[calc_stats])
+
+    for name_0, name_1 in config.get('compare', list()):
+        name = 'compare/{}-{}'.format(name_0, name_1)
+
+        def run_write_comparison(comparison, name=name):
+            return write_comparison(os.path.join(config['out'], name),
+                                    comparison)
+
+        pipeline.add(name,
+                     compare_stats,
+                     deps=[name_0 + '/calc_stats', name_1 + '/calc_stats'],
+                     write=run_write_comparison,
+                     modules=[compare_perspective_stats])
+
+    return pipeline
+
+
+if __name__ == '__main__':
+    myargs = getopts(argv)
+    force = False
+    checkpoints = False
+
+    if '-v' in myargs:
+        logging.basicConfig(level=logging.INFO)
+
+    if '-c' in myargs:
+        config_path = myargs['-c']
+    else:
+        logging.error('No pipeline configuration provided')
+        exit(-1)
+
+    if '-f' in myargs:
+        force = True
+
+    if '--checkpoint' in myargs:
+        checkpoints = True
+
+    if '--trace' in myargs or '--timings' in myargs:
+        tracing.enable()
+
+    pipeline = build_pipeline(load_config(config_path), checkpoints)
+
+    start = time.perf_counter()
+    pipeline.run(force)
+
+    print('Ran {} of {} stages in {:.2f} s'.format(
+        len(pipeline.ran), len(pipeline.stages),
+        time.perf_counter() - start))
+
+    if '--trace' in myargs:
+        tracing.write_trace(myargs['--trace'])
+
+    if '--timings' in myargs:
+        tracing.print_timings()
+
+    exit(0)
@@ -0,0 +1,131 @@
+# Copyright 2018 Pedro Cuadra - pjcuadra@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from pose_protocol import default_socket, connect, send_message, recv_message
+from options import getopts
+from sys import argv
+import logging
+import os
+
+
+def request_coordinates(in_path,
+                        camera,
+                        out_path=None,
+                        parameters_path=None,
+                        marker_size=0.071,
+                        preset='default',
+                        socket_path=default_socket,
+                        send_image=False):
+    """
+    Get the coordinates system of the markers in an image from the daemon
+
+    Paths are made absolute since the daemon runs elsewhere. With
+    `send_image` the image bytes are sent instead of its path. Returns the
+    get_coordinates_system JSON content, None if no marker was found.
+    """
+    header = {'camera': os.path.abspath(camera),
+              'marker_size': marker_size,
+              'preset': preset}
+
+    if out_path is not None:
+        header['out'] = os.path.abspath(out_path)
+
+    if parameters_path is not None:
+        header['params'] = os.path.abspath(parameters_path)
+
+    payload = None
+    if send_image:
+        with open(in_path, 'rb') as f:
+            payload = f.read()
+    else:
+        header['image'] = os.path.abspath(in_path)
+
+    sock = connect(socket_path)
+
+    try:
+        send_message(sock, header, payload)
+        message = recv_message(sock)
+    finally:
+        sock.close()
+
+    if message is None:
+        raise IOError('Connection to the pose daemon closed')
+
+    response, _ = message
+
+    if 'error' in response:
+        raise RuntimeError(response['error'])
+
+    return response['coordinates']
+
+
+if __name__ == '__main__':
+    myargs = getopts(argv)
+    out_path = None
+    in_path = None
+    params_path = None
+    marker_size = 0.071
+    preset = 'default'
+    socket_path = default_socket
+    send_image = False
+
+    if '-v' in myargs:
+        logging.basicConfig(level=logging.DEBUG)
+
+    if '-i' in myargs:
+        in_path = myargs['-i']
+        logging.debug('Input image at ' + in_path)
+    else:
+        logging.error('No input image provided')
+        exit(-1)
+
+    if '-p' in myargs:
+        params_path = myargs['-p']
+        logging.debug('Parameters to be writte to ' + params_path)
+
+    if '-c' in myargs:
+        camera = myargs['-c']
+        logging.debug('Camera Distortion model at ' + camera)
+    else:
+        logging.error('No Camera Distortion model provided')
+        exit(-1)
+
+    if '-o' in myargs:
+        out_path = myargs['-o']
+    else:
+        logging.debug('No output image path provided')
+
+    if '-m' in myargs:
+        marker_size = float(myargs['-m'])
+
+    if '--preset' in myargs:
+        preset = myargs['--preset']
+
+    if '-S' in myargs:
+        socket_path = myargs['-S']
+
+    if '--send' in myargs:
+        send_image = True
+
+    try:
+        request_coordinates(in_path,
+                            camera,
+                            out_path,
+                            params_path,
+                            marker_size,
+                            preset,
+                            socket_path,
+                            send_image)
+    except (IOError, RuntimeError) as e:
+        logging.error(e)
+        exit(-1)
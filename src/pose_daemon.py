@@ -0,0 +1,252 @@
+# Copyright 2018 Pedro Cuadra - pjcuadra@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from get_shared_coord import get_coordinates_system, detector_presets
+from detection_cache import DetectionCache
+from pose_protocol import default_socket, connect, send_message
+from pose_protocol import recv_message
+from options import getopts
+from sys import argv
+import errno
+import hashlib
+import logging
+import os
+import signal
+import socketserver
+import stat
+import threading
+import cv2
+import numpy as np
+
+
+class CameraRegistry(object):
+    """
+    Camera calibrations loaded once and kept open
+
+    Cameras are identified by the path to their calibration file. A file is
+    parsed again only if it changed since it was loaded.
+    """
+
+    def __init__(self):
+        self.cameras = dict()
+        self.lock = threading.Lock()
+
+    def get(self, camera):
+        """Get the (stamp, file, intrinsics, distortion) of a camera"""
+        stat = os.stat(camera)
+        stamp = (stat.st_size, stat.st_mtime_ns)
+
+        with self.lock:
+            entry = self.cameras.get(camera)
+
+            if entry is None or entry[0] != stamp:
+                logging.info('Loading camera ' + camera)
+                # The nodes are only valid while the file is open
+                fs = cv2.FileStorage(camera, cv2.FILE_STORAGE_READ)
+                entry = (stamp,
+                         fs,
+                         fs.getNode("camera_matrix"),
+                         fs.getNode("distortion_coefficients"))
+                self.cameras[camera] = entry
+
+        return entry
+
+
+def remove_stale_socket(socket_path):
+    """
+    Remove the socket left behind by a daemon that is gone
+
+    Raises an OSError if a daemon still listens on it or if the path is
+    not a socket.
+    """
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+
+    if not stat.S_ISSOCK(mode):
+        raise OSError(errno.EEXIST, 'Not a socket', socket_path)
+
+    try:
+        connect(socket_path).close()
+    except (ConnectionRefusedError, FileNotFoundError):
+        logging.info('Removing stale socket ' + socket_path)
+        os.remove(socket_path)
+        return
+
+    raise OSError(errno.EADDRINUSE, 'A daemon listens already', socket_path)
+
+
+class PoseRequestHandler(socketserver.BaseRequestHandler):
+    """Answer the requests of a client until it disconnects"""
+
+    def handle(self):
+        while True:
+            message = recv_message(self.request)
+            if message is None:
+                return
+
+            header, payload = message
+
+            try:
+                response = self.server.get_pose(header, payload)
+            except Exception as e:
+                logging.exception('Request failed')
+                response = {'error': str(e)}
+
+            send_message(self.request, response)
+
+
+class PoseServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Long lived pose estimation server on a Unix domain socket
+
+    OpenCV, the camera calibrations, the detectors and the detection cache
+    stay warm between requests, so each request only pays the detection.
+    Requests name files that are read and written with the rights of the
+    daemon, so the socket is only for trusted clients; it is created
+    readable and writable by its owner only.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path=default_socket, cache=None):
+        remove_stale_socket(socket_path)
+
+        socketserver.UnixStreamServer.__init__(self,
+                                               socket_path,
+                                               PoseRequestHandler)
+        self.socket_path = socket_path
+        self.cache = cache
+        self.cameras = CameraRegistry()
+
+    def server_bind(self):
+        # No window where others could connect before a chmod
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+
+    def get_pose(self, header, payload=None):
+        """
+        Get the coordinates system of the markers of a requested image
+
+        The request holds the `image` path or is followed by the encoded
+        image, the `camera` calibration path and optionally the
+        `marker_size`, detector `preset`, output image path `out` and
+        parameters path `params`. The response holds the
+        get_coordinates_system JSON content as `coordinates`.
+        """
+        camera = header['camera']
+        marker_size = float(header.get('marker_size', 0.071))
+        preset = header.get('preset', 'default')
+        out_path = header.get('out')
+        params_path = header.get('params')
+
+        if preset not in detector_presets:
+            return {'error': 'Unknown detector preset ' + preset}
+
+        # Hold on to the file while its nodes are used
+        _, fs, intrinsics, distortion = self.cameras.get(camera)
+
+        cache_key = None
+        detection = None
+        if self.cache is not None:
+            if payload is not None:
+                image_digest = hashlib.sha1(payload).hexdigest()
+            else:
+                image_digest = self.cache.digest_file(header['image'])
+
+            cache_key = self.cache.get_key(image_digest,
+                                           self.cache.digest_file(camera),
+                                           marker_size,
+                                           preset)
+
+            # Looked up once, the entry may be evicted by another process
+            detection = self.cache.get(cache_key)
+
+        input_image = None
+        if out_path is not None or detection is None:
+            if payload is not None:
+                input_image = cv2.imdecode(np.frombuffer(payload, np.uint8),
+                                           cv2.IMREAD_COLOR)
+            else:
+                input_image = cv2.imread(header['image'])
+
+            if input_image is None:
+                return {'error': 'Image could not be decoded'}
+
+        ids, corners, json_content = get_coordinates_system(
+                                            input_image,
+                                            intrinsics,
+                                            distortion,
+                                            out_path,
+                                            params_path,
+                                            False,
+                                            marker_size,
+                                            self.cache,
+                                            cache_key,
+                                            preset=preset,
+                                            detection=detection)
+
+        return {'coordinates': json_content}
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def run_daemon(socket_path=default_socket, cache=None):
+    try:
+        server = PoseServer(socket_path, cache)
+    except OSError as e:
+        logging.error('Can\'t listen on {}: {}'.format(socket_path,
+                                                       e.strerror))
+        return -1
+
+    def stop(signum, frame):
+        # shutdown blocks until serve_forever returns
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    logging.info('Listening on ' + socket_path)
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    myargs = getopts(argv)
+    socket_path = default_socket
+    cache = None
+
+    if '-v' in myargs:
+        logging.basicConfig(level=logging.INFO)
+
+    if '-S' in myargs:
+        socket_path = myargs['-S']
+
+    if '-k' in myargs:
+        cache = DetectionCache(myargs['-k'])
+
+    ret = run_daemon(socket_path, cache)
+    exit(ret)
@@ -0,0 +1,210 @@
+# Copyright 2018 Pedro Cuadra - pjcuadra@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import math
+
+# Poses are (rotation, translation) tuples of a 3x3 nested list and a list
+# of 3 values so this module works without NumPy, process_log doesn't
+# depend on it.
+
+identity = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]
+
+
+def rvec_to_matrix(rvec):
+    """Convert a Rodrigues rotation vector to a rotation matrix"""
+    rx, ry, rz = [float(v) for v in rvec]
+    angle = math.sqrt(rx * rx + ry * ry + rz * rz)
+
+    if angle < 1e-12:
+        return [list(row) for row in identity]
+
+    x, y, z = rx / angle, ry / angle, rz / angle
+    c = math.cos(angle)
+    s = math.sin(angle)
+    t = 1 - c
+
+    return [[t * x * x + c, t * x * y - s * z, t * x * z + s * y],
+            [t * x * y + s * z, t * y * y + c, t * y * z - s * x],
+            [t * x * z - s * y, t * y * z + s * x, t * z * z + c]]
+
+
+def get_rotation_angle(rot_a, rot_b):
+    """Get the angle in degrees of the rotation between two rotations"""
+    # trace(A^T B)
+    trace = sum(rot_a[i][j] * rot_b[i][j] for i in range(3) for j in range(3))
+    cos = max(-1.0, min(1.0, (trace - 1) / 2))
+
+    return math.degrees(math.acos(cos))
+
+
+def get_translation_distance(trans_a, trans_b):
+    return math.sqrt(sum((a - b) ** 2 for a, b in zip(trans_a, trans_b)))
+
+
+def get_matrix_pose(matrix):
+    """
+    Get the pose of a 4x4 homogeneous matrix
+
+    Both the column (translation in the last column) and the row
+    (translation in the last row) layouts are accepted.
+    """
+    rotation = [[float(matrix[i][j]) for j in range(3)] for i in range(3)]
+    column = [float(matrix[i][3]) for i in range(3)]
+    row = [float(matrix[3][j]) for j in range(3)]
+
+    if any(row) and not any(column):
+        # Row vector layout, the rotation is transposed as well
+        rotation = [[rotation[j][i] for j in range(3)] for i in range(3)]
+        return rotation, row
+
+    return rotation, column
+
+
+class PoseChangeGate(object):
+    """
+    Tell when a pose moved enough to be published again
+
+    A static pose is published again once it moves more than
+    `translation_threshold` meters or `rotation_threshold` degrees from the
+    last published one. While moving, it is published on every change
+    larger than the thresholds scaled by `hysteresis` and it is considered
+    static again once a change stays below them. This avoids flickering
+    around the thresholds while still following a moving pose closely.
+    Callbacks added with `subscribe` are called with every published pose.
+    """
+
+    def __init__(self, translation_threshold=0.005, rotation_threshold=1.0,
+                 hysteresis=0.5):
+        self.translation_threshold = translation_threshold
+        self.rotation_threshold = rotation_threshold
+        self.hysteresis = hysteresis
+
+        self.published = None
+        self.moving = False
+        self.subscribers = list()
+
+        self.updates = 0
+        self.publications = 0
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def changed(self, rotation, translation):
+        """Check if a pose differs enough from the last published one"""
+        if self.published is None:
+            return True
+
+        scale = self.hysteresis if self.moving else 1.0
+
+        distance = get_translation_distance(translation, self.published[1])
+        angle = get_rotation_angle(rotation, self.published[0])
+
+        return (distance > self.translation_threshold * scale or
+                angle > self.rotation_threshold * scale)
+
+    def update(self, rotation, translation, data=None):
+        """
+        Feed a new pose, returns True if it was published
+
+        `data` is handed to the subscribers instead of the pose, if given.
+        """
+        self.updates += 1
+
+        if not self.changed(rotation, translation):
+            self.moving = False
+            return False
+
+        self.moving = self.published is not None
+        self.published = (rotation, list(translation))
+        self.publications += 1
+
+        for callback in self.subscribers:
+            callback(data if data is not None else self.published)
+
+        return True
+
+    def get_suppression_ratio(self):
+        """Get the ratio of updates that weren't published"""
+        return get_suppression_ratio(self.updates, self.publications)
+
+    def log_stats(self, name='Pose'):
+        logging.info('{} published {} of {} updates, {:.1%} suppressed'.format(
+            name, self.publications, self.updates,
+            self.get_suppression_ratio()))
+
+
+class MarkerPoseGates(object):
+    """
+    One PoseChangeGate per marker id
+
+    Markers seen for the first time are always published.
+    """
+
+    def __init__(self, translation_threshold=0.005, rotation_threshold=1.0,
+                 hysteresis=0.5):
+        self.translation_threshold = translation_threshold
+        self.rotation_threshold = rotation_threshold
+        self.hysteresis = hysteresis
+        self.gates = dict()
+
+    def get_gate(self, marker_id):
+        gate = self.gates.get(marker_id)
+
+        if gate is None:
+            gate = PoseChangeGate(self.translation_threshold,
+                                  self.rotation_threshold,
+                                  self.hysteresis)
+            self.gates[marker_id] = gate
+
+        return gate
+
+    def update(self, ids, rvecs, tvecs):
+        """Feed the poses of a frame, returns the ids that were published"""
+        changed = list()
+
+        for marker_id, rvec, tvec in zip(ids, rvecs, tvecs):
+            marker_id = int(marker_id[0] if hasattr(marker_id, '__len__')
+                            else marker_id)
+            rvec = [float(v) for v in flatten(rvec)]
+            tvec = [float(v) for v in flatten(tvec)]
+
+            if self.get_gate(marker_id).update(rvec_to_matrix(rvec), tvec):
+                changed.append(marker_id)
+
+        return changed
+
+    def get_counts(self):
+        updates = sum(gate.updates for gate in self.gates.values())
+        publications = sum(gate.publications for gate in self.gates.values())
+
+        return updates, publications
+
+
+def flatten(values):
+    """Flatten nested lists or arrays of values"""
+    if not hasattr(values, '__len__'):
+        return [values]
+
+    flat = list()
+    for value in values:
+        flat += flatten(value)
+
+    return flat
+
+
+def get_suppression_ratio(updates, publications):
+    if updates == 0:
+        return 0.0
+
+    return 1 - publications / float(updates)
@@ -0,0 +1,87 @@
+# Copyright 2018 Pedro Cuadra - pjcuadra@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import socket
+import struct
+
+
+# Messages exchanged with the pose daemon.
+#
+# Every message is a JSON header preceded by its length as a 4 bytes big
+# endian unsigned integer. A request carrying the encoded image instead of
+# its path sets `image_size` in the header and the image bytes follow it.
+# This module doesn't import OpenCV so clients start fast.
+
+default_socket = '/tmp/shared_coords.sock'
+
+header_format = '>I'
+header_size = struct.calcsize(header_format)
+
+
+def recv_exactly(sock, size):
+    """Receive `size` bytes, None if the connection was closed first"""
+    data = bytearray()
+
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+
+    return bytes(data)
+
+
+def send_message(sock, header, payload=None):
+    """Send a JSON header and, optionally, the bytes following it"""
+    if payload is not None:
+        header = dict(header)
+        header['image_size'] = len(payload)
+
+    data = json.dumps(header).encode()
+    sock.sendall(struct.pack(header_format, len(data)) + data)
+
+    if payload is not None:
+        sock.sendall(payload)
+
+
+def recv_message(sock):
+    """
+    Receive a message
+
+    Returns the header and the bytes following it, if any, or None if the
+    connection was closed.
+    """
+    size = recv_exactly(sock, header_size)
+    if size is None:
+        return None
+
+    data = recv_exactly(sock, struct.unpack(header_format, size)[0])
+    if data is None:
+        return None
+
+    header = json.loads(data.decode())
+    payload = None
+
+    if header.get('image_size') is not None:
+        payload = recv_exactly(sock, header['image_size'])
+        if payload is None:
+            return None
+
+    return header, payload
+
+
+def connect(socket_path=default_socket):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    return sock
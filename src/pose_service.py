@@ -0,0 +1,545 @@
+# Copyright 2018 Pedro Cuadra - pjcuadra@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from get_shared_coord import get_coordinates_system
+from get_shared_coord import detector_presets
+from pose_gate import MarkerPoseGates, get_suppression_ratio
+from transforms import Transform
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque, OrderedDict
+from options import getopts
+from sys import argv
+from urllib.parse import urlsplit, parse_qs
+import asyncio
+import json
+import logging
+import os
+import time
+import cv2
+import numpy as np
+
+
+# Largest accepted request body in bytes
+max_body_size = 32 * 1024 * 1024
+
+# Number of latencies kept per metric
+metrics_window = 4096
+
+status_reasons = {200: 'OK',
+                  400: 'Bad Request',
+                  404: 'Not Found',
+                  405: 'Method Not Allowed',
+                  413: 'Payload Too Large',
+                  500: 'Internal Server Error',
+                  503: 'Service Unavailable'}
+
+
+def get_percentiles(values, percentiles=(50, 95, 99)):
+    """Get the given percentiles of a list of values, in milliseconds"""
+    if len(values) == 0:
+        return dict()
+
+    points = np.percentile(np.array(values) * 1000, percentiles)
+
+    return {'p{}'.format(p): float(v) for p, v in zip(percentiles, points)}
+
+
+def get_shared_base(ids, rvecs, tvecs):
+    """
+    Get the transforms between the camera and each marker
+
+    `marker_to_camera` maps points in the marker coordinates system to the
+    camera one and `camera_to_marker` does the opposite.
+    """
+    shared_base = list()
+
+    for i in range(len(ids)):
+        marker_to_camera = Transform.from_pose(rvecs[i], tvecs[i])
+        camera_to_marker = marker_to_camera.inverse
+
+        shared_base.append({'id': int(np.ravel(ids[i])[0]),
+                            'marker_to_camera': marker_to_camera.tolist(),
+                            'camera_to_marker': camera_to_marker.tolist()})
+
+    return shared_base
+
+
+class QueueFull(Exception):
+    pass
+
+
+class FrameRequest(object):
+
+    def __init__(self, client, camera, data, marker_size, future):
+        self.client = client
+        self.camera = camera
+        self.data = data
+        self.marker_size = marker_size
+        self.future = future
+        self.enqueued = time.perf_counter()
+        self.started = None
+        self.finished = None
+
+
+class PoseService(object):
+    """
+    Asynchronous pose estimation for many headsets
+
+    Every client gets its own bounded queue so a fast headset can't starve
+    the others. A dispatcher takes frames from the queues round robin as
+    soon as one of the `workers` threads of the pool is free, so at most
+    `workers` frames are in flight. Each frame runs on its own thread and
+    the detection releases the GIL so frames run in parallel.
+
+    The `changed` ids of a response are the markers whose pose moved more
+    than `translation_threshold` meters or `rotation_threshold` degrees
+    since it was last reported as changed to the same client. The gates of
+    at most `max_clients` clients are kept, the least recently seen client
+    is forgotten first and gets all its markers reported as changed when it
+    comes back.
+    """
+
+    def __init__(self, cameras, workers=4, queue_depth=4, marker_size=0.071, preset='default',
+                 translation_threshold=0.005, rotation_threshold=1.0,
+                 max_clients=1024):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.marker_size = marker_size
+        self.preset = preset
+        self.translation_threshold = translation_threshold
+        self.rotation_threshold = rotation_threshold
+        self.max_clients = max_clients
+
+        # Pose change gates by client, least recently seen first
+        self.gates = OrderedDict()
+        self.forgotten_counts = (0, 0)
+
+        # The nodes are only valid while their file is open
+        self.cameras = dict()
+        for name, camera in cameras.items():
+            fs = cv2.FileStorage(camera, cv2.FILE_STORAGE_READ)
+            self.cameras[name] = (fs,
+                                  fs.getNode("camera_matrix"),
+                                  fs.getNode("distortion_coefficients"))
+
+        self.queues = OrderedDict()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.ready = None
+        self.slots = None
+        self.dispatcher = None
+
+        self.counters = {'frames': 0,
+                         'errors': 0,
+                         'rejected': 0}
+        self.latencies = {'queue': deque(maxlen=metrics_window),
+                          'process': deque(maxlen=metrics_window),
+                          'total': deque(maxlen=metrics_window)}
+        self.in_flight = 0
+        self.started = time.time()
+
+    def start(self):
+        self.ready = asyncio.Event()
+        self.slots = asyncio.Semaphore(self.workers)
+        self.dispatcher = asyncio.ensure_future(self.dispatch())
+
+    async def submit(self, client, camera, data, marker_size=None):
+        """Queue a frame of a client and wait for its pose"""
+        if camera not in self.cameras:
+            raise ValueError('Unknown camera ' + str(camera))
+
+        if marker_size is None:
+            marker_size = self.marker_size
+
+        queue = self.queues.get(client)
+        if queue is None:
+            queue = deque()
+            self.queues[client] = queue
+
+        if len(queue) >= self.queue_depth:
+            self.counters['rejected'] += 1
+            raise QueueFull(client)
+
+        future = asyncio.get_event_loop().create_future()
+        queue.append(FrameRequest(client, camera, data, marker_size, future))
+        self.ready.set()
+
+        return await future
+
+    def collect(self):
+        """Take the next frame from the client queues round robin"""
+        if not self.queues:
+            return None
+
+        client, queue = next(iter(self.queues.items()))
+        request = queue.popleft()
+
+        # The client is served again after all the others
+        if queue:
+            self.queues.move_to_end(client)
+        else:
+            del self.queues[client]
+
+        return request
+
+    async def dispatch(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            await self.ready.wait()
+
+            # Frames stay in their client queue until a worker is free
+            await self.slots.acquire()
+
+            request = self.collect()
+            if request is None:
+                self.slots.release()
+                self.ready.clear()
+                continue
+
+            self.in_flight += 1
+            task = loop.run_in_executor(self.executor,
+                                        self.run_frame,
+                                        request)
+            task.add_done_callback(
+                lambda task, request=request: self.finish_frame(task,
+                                                                request))
+
+    def process_frame(self, request):
+        """Get the pose of the markers of a single frame"""
+        fs, intrinsics, distortion = self.cameras[request.camera]
+
+        input_image = cv2.imdecode(np.frombuffer(request.data, np.uint8),
+                                   cv2.IMREAD_COLOR)
+        if input_image is None:
+            raise ValueError('Image could not be decoded')
+
+        ids, corners, json_content = get_coordinates_system(
+                                            input_image,
+                                            intrinsics,
+                                            distortion,
+                                            marker_size=request.marker_size,
+                                            preset=self.preset)
+
+        shared_base = list()
+        if json_content is not None:
+            shared_base = get_shared_base(ids,
+                                          json_content['rvecs'],
+                                          json_content['tvecs'])
+
+        return {'coordinates': json_content, 'shared_base': shared_base}
+
+    def run_frame(self, request):
+        """Process a frame and time it, runs on the executor"""
+        request.started = time.perf_counter()
+
+        try:
+            return self.process_frame(request)
+        except Exception:
+            logging.exception('Frame of {} failed'.format(request.client))
+            raise
+        finally:
+            request.finished = time.perf_counter()
+
+    def finish_frame(self, task, request):
+        self.in_flight -= 1
+        self.slots.release()
+
+        error = task.exception()
+        if request.future.cancelled():
+            return
+
+        if error is not None:
+            self.counters['errors'] += 1
+            request.future.set_exception(error)
+            return
+
+        result = task.result()
+
+        self.counters['frames'] += 1
+        self.latencies['queue'].append(request.started - request.enqueued)
+        self.latencies['process'].append(request.finished - request.started)
+        self.latencies['total'].append(request.finished - request.enqueued)
+
+        result['changed'] = self.get_changed(request.client,
+                                             result['coordinates'])
+        result['latency_ms'] = 1000 * (request.finished - request.enqueued)
+        request.future.set_result(result)
+
+    def get_changed(self, client, json_content):
+        """Get the ids of the markers that moved for a client"""
+        if json_content is None:
+            return list()
+
+        gates = self.gates.get(client)
+        if gates is None:
+            gates = MarkerPoseGates(self.translation_threshold,
+                                    self.rotation_threshold)
+            self.gates[client] = gates
+        else:
+            self.gates.move_to_end(client)
+
+        while len(self.gates) > self.max_clients:
+            client, forgotten = self.gates.popitem(last=False)
+            counts = forgotten.get_counts()
+            self.forgotten_counts = (self.forgotten_counts[0] + counts[0],
+                                     self.forgotten_counts[1] + counts[1])
+            logging.info('Forgot the pose gates of ' + str(client))
+
+        return gates.update(json_content['ids'],
+                            json_content['rvecs'],
+                            json_content['tvecs'])
+
+    def get_metrics(self):
+        metrics = dict(self.counters)
+        metrics['uptime'] = time.time() - self.started
+        metrics['clients_queued'] = {client: len(queue)
+                                     for client, queue in self.queues.items()}
+        metrics['in_flight'] = self.in_flight
+        metrics['latency_ms'] = {name: get_percentiles(values)
+                                 for name, values in self.latencies.items()}
+
+        metrics['clients_tracked'] = len(self.gates)
+
+        counts = [gates.get_counts() for gates in self.gates.values()]
+        counts.append(self.forgotten_counts)
+        updates = sum(count[0] for count in counts)
+        publications = sum(count[1] for count in counts)
+        metrics['pose_updates'] = updates
+        metrics['pose_changes'] = publications
+        metrics['suppression_ratio'] = get_suppression_ratio(updates,
+                                                             publications)
+        return metrics
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message=None):
+        Exception.__init__(self, message)
+        self.status = status
+        self.message = message or status_reasons.get(status, '')
+
+
+class PoseHTTPServer(object):
+    """
+    Minimal HTTP/1.1 front end of a PoseService
+
+    * POST /pose: The body is a JPEG frame. The client is identified by the
+      `client` query parameter or the X-Client-Id header, and the camera
+      calibration by the `camera` query parameter. `marker_size` may be
+      given as query parameter as well. `changed` lists the ids of the
+      markers that moved since the last response to the client.
+    * GET /metrics: Counters, queue depths, latency percentiles and the
+      ratio of marker poses reported as unchanged
+    """
+
+    def __init__(self, service):
+        self.service = service
+
+    async def read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+
+        parts = request_line.decode('latin-1').split()
+        if len(parts) != 3:
+            raise HTTPError(400)
+
+        method, target, version = parts
+        headers = dict()
+
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+        length = headers.get('content-length', '0')
+        if not (length.isascii() and length.isdigit()):
+            raise HTTPError(400, 'Invalid Content-Length ' + length)
+
+        size = int(length)
+        if size > max_body_size:
+            raise HTTPError(413)
+
+        body = await reader.readexactly(size)
+
+        return method, target, version, headers, body
+
+    async def route(self, method, target, headers, body):
+        url = urlsplit(target)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if url.path == '/metrics':
+            if method != 'GET':
+                raise HTTPError(405)
+            return self.service.get_metrics()
+
+        if url.path == '/pose':
+            if method != 'POST':
+                raise HTTPError(405)
+
+            client = query.get('client', headers.get('x-client-id', 'default'))
+            camera = query.get('camera', 'default')
+            marker_size = None
+
+            try:
+                if 'marker_size' in query:
+                    marker_size = float(query['marker_size'])
+
+                return await self.service.submit(client,
+                                                 camera,
+                                                 body,
+                                                 marker_size)
+            except QueueFull:
+                raise HTTPError(503, 'Queue of {} is full'.format(client))
+            except ValueError as e:
+                raise HTTPError(400, str(e))
+
+        raise HTTPError(404)
+
+    def write_response(self, writer, status, content, close=False):
+        body = json.dumps(content).encode()
+        head = ['HTTP/1.1 {} {}'.format(status, status_reasons[status]),
+                'Content-Type: application/json',
+                'Content-Length: {}'.format(len(body))]
+
+        if close:
+            head.append('Connection: close')
+
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + body)
+
+    async def handle(self, reader, writer):
+        """Serve the requests of a connection until it is closed"""
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                except HTTPError as e:
+                    self.write_response(writer, e.status,
+                                        {'error': e.message}, True)
+                    break
+
+                if request is None:
+                    break
+
+                method, target, version, headers, body = request
+                close = (headers.get('connection', '').lower() == 'close' or
+                         version == 'HTTP/1.0')
+
+                try:
+                    status, content = 200, await self.route(method,
+                                                            target,
+                                                            headers,
+                                                            body)
+                except HTTPError as e:
+                    status, content = e.status, {'error': e.message}
+                except Exception as e:
+                    status, content = 500, {'error': str(e)}
+
+                self.write_response(writer, status, content, close)
+                await writer.drain()
+
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def parse_cameras(value):
+    """Parse `name=path[,name=path...]`, a single path is named default"""
+    cameras = dict()
+
+    for item in value.split(','):
+        name, _, path = item.rpartition('=')
+        cameras[name or 'default'] = path
+
+    return cameras
+
+
+async def serve(service, host='127.0.0.1', port=8080):
+    service.start()
+    http = PoseHTTPServer(service)
+
+    server = await asyncio.start_server(http.handle, host, port)
+    logging.info('Listening on {}:{}'.format(host, port))
+
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    myargs = getopts(argv)
+    host = '127.0.0.1'
+    port = 8080
+    workers = os.cpu_count() or 1
+    queue_depth = 4
+    marker_size = 0.071
+    preset = 'default'
+    translation_threshold = 0.005
+    rotation_threshold = 1.0
+    max_clients = 1024
+
+    if '-v' in myargs:
+        logging.basicConfig(level=logging.INFO)
+
+    if '-c' in myargs:
+        cameras = parse_cameras(myargs['-c'])
+    else:
+        logging.error('No Camera Distortion model provided')
+        exit(-1)
+
+    if '-H' in myargs:
+        host = myargs['-H']
+
+    if '-P' in myargs:
+        port = int(myargs['-P'])
+
+    if '-j' in myargs:
+        workers = int(myargs['-j'])
+
+    if '-q' in myargs:
+        queue_depth = int(myargs['-q'])
+
+    if '-m' in myargs:
+        marker_size = float(myargs['-m'])
+
+    if '--preset' in myargs:
+        preset = myargs['--preset']
+
+        if preset not in detector_presets:
+            logging.error('Unknown detector preset ' + preset)
+            exit(-1)
+
+    if '-t' in myargs:
+        translation_threshold = float(myargs['-t'])
+
+    if '-a' in myargs:
+        rotation_threshold = float(myargs['-a'])
+
+    if '--max-clients' in myargs:
+        max_clients = int(myargs['--max-clients'])
+
+    service = PoseService(cameras, workers, queue_depth, marker_size, preset,
+                          translation_threshold, rotation_threshold,
+                          max_clients)
+
+    try:
+        asyncio.run(serve(service, host, port))
+    except KeyboardInterrupt:
+        pass
+
+    exit(0)
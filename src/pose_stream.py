@@ -0,0 +1,572 @@
+# Copyright 2018 Pedro Cuadra - pjcuadra@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from get_shared_coord import get_pose_json
+from options import getopts
+from sys import argv
+import glob
+import json
+import logging
+import os
+import struct
+import numpy as np
+
+# Binary stream of marker poses.
+#
+# A frame starts with a flags byte and the number of markers as varint.
+# Each marker starts with a varint holding its id shifted left by one, the
+# lowest bit tells if the marker is delta encoded. Then follow its rotation
+# as quaternion (w, x, y, z), its translation (x, y, z) and its pixel center
+# (x, y);
+#
+#  * float32: 9 little endian float32 values
+#  * fixed point: 9 zigzag varints of the values scaled by `fixed_scales`
+#  * delta: 9 zigzag varints of the difference of the fixed point values to
+#    the ones of the same marker on the previous frame
+#
+# Keyframes have no delta encoded markers so a receiver can start decoding
+# from them. Float32 streams are never delta encoded. Everything else in the
+# coordinates JSON content is derived from the pose on the receiver.
+
+flag_keyframe = 0x01
+flag_float32 = 0x02
+
+# Units of the fixed point values; quaternion, meters and pixels
+fixed_scales = np.array([2 ** 16] * 4 + [10 ** 5] * 3 + [16] * 2)
+
+float32_format = struct.Struct('<9f')
+
+
+def write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, offset):
+    value = 0
+    shift = 0
+
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+
+        if byte < 0x80:
+            return value, offset
+
+        shift += 7
+
+
+def zigzag(value):
+    if value >= 0:
+        return value << 1
+    return ((-value) << 1) - 1
+
+
+def unzigzag(value):
+    if value & 1:
+        return -((value + 1) >> 1)
+    return value >> 1
+
+
+def rvec_to_quaternion(rvec):
+    """Convert a Rodrigues rotation vector to a (w, x, y, z) quaternion"""
+    rvec = np.ravel(rvec).astype(np.float64)
+    angle = np.linalg.norm(rvec)
+
+    if angle < 1e-12:
+        return np.array([1.0, 0, 0, 0])
+
+    axis = rvec / angle
+
+    return np.concatenate([[np.cos(angle / 2)], axis * np.sin(angle / 2)])
+
+
+def quaternion_to_rvec(quaternion):
+    """Convert a (w, x, y, z) quaternion to a Rodrigues rotation vector"""
+    quaternion = np.asarray(quaternion, dtype=np.float64)
+    quaternion = quaternion / np.linalg.norm(quaternion)
+
+    w = quaternion[0]
+    vector = quaternion[1:]
+    norm = np.linalg.norm(vector)
+
+    if norm < 1e-12:
+        return np.zeros(3)
+
+    angle = 2 * np.arctan2(norm, w)
+
+    return vector / norm * angle
+
+
+def get_marker_keys(ids):
+    """Key markers by id and occurrence, ids may repeat on a frame"""
+    seen = dict()
+    keys = list()
+
+    for marker_id in ids:
+        seen[marker_id] = seen.get(marker_id, -1) + 1
+        keys.append((marker_id, seen[marker_id]))
+
+    return keys
+
+
+class PoseStreamEncoder(object):
+    """
+    Encode the marker poses of consecutive frames
+
+    A keyframe is written every `keyframe_interval` frames, the ones in
+    between are delta encoded unless `float32` is set.
+    """
+
+    def __init__(self, keyframe_interval=30, float32=False):
+        self.keyframe_interval = keyframe_interval
+        self.float32 = float32
+        self.frames = 0
+        self.previous = dict()
+
+    def encode(self, ids, rvecs, tvecs, centers):
+        """Encode the markers of a frame"""
+        keyframe = (self.float32 or self.keyframe_interval <= 1 or
+                    self.frames % self.keyframe_interval == 0)
+        self.frames += 1
+
+        flags = 0
+        if keyframe:
+            flags |= flag_keyframe
+        if self.float32:
+            flags |= flag_float32
+
+        ids = [int(marker_id) for marker_id in np.ravel(ids)]
+
+        out = bytearray([flags])
+        write_varint(out, len(ids))
+
+        current = dict()
+
+        for key, rvec, tvec, center in zip(get_marker_keys(ids),
+                                           rvecs,
+                                           tvecs,
+                                           centers):
+            quaternion = rvec_to_quaternion(rvec)
+            prev = self.previous.get(key)
+
+            # q and -q are the same rotation, keep the deltas small
+            if prev is not None and np.dot(quaternion, prev[:4]) < 0:
+                quaternion = -quaternion
+
+            values = np.concatenate([quaternion,
+                                     np.ravel(tvec),
+                                     np.ravel(center)])
+
+            if self.float32:
+                write_varint(out, key[0] << 1)
+                out += float32_format.pack(*values)
+                continue
+
+            fixed = np.round(values * fixed_scales).astype(np.int64)
+            current[key] = fixed
+
+            if keyframe or prev is None:
+                write_varint(out, key[0] << 1)
+                for value in fixed:
+                    write_varint(out, zigzag(int(value)))
+                continue
+
+            write_varint(out, (key[0] << 1) | 1)
+            for value in fixed - prev:
+                write_varint(out, zigzag(int(value)))
+
+        if not self.float32:
+            self.previous = current
+
+        return bytes(out)
+
+
+class PoseStreamDecoder(object):
+    """Decode the frames written by a PoseStreamEncoder"""
+
+    def __init__(self):
+        self.previous = dict()
+
+    def decode(self, data, offset=0):
+        """
+        Decode the frame starting at `offset`
+
+        Returns the ids, rvecs, tvecs and centers of its markers and the
+        offset of the next frame.
+        """
+        flags = data[offset]
+        offset += 1
+        count, offset = read_varint(data, offset)
+
+        ids = list()
+        values = list()
+        current = dict()
+
+        for i in range(count):
+            header, offset = read_varint(data, offset)
+            ids.append(header >> 1)
+
+            if flags & flag_float32:
+                values.append(np.array(float32_format.unpack_from(data,
+                                                                  offset)))
+                offset += float32_format.size
+                continue
+
+            fixed = list()
+            for j in range(len(fixed_scales)):
+                value, offset = read_varint(data, offset)
+                fixed.append(unzigzag(value))
+            fixed = np.array(fixed, dtype=np.int64)
+
+            key = get_marker_keys(ids)[-1]
+
+            if header & 1:
+                if key not in self.previous:
+                    raise ValueError('Delta of {} without reference'.format(
+                        key))
+                fixed += self.previous[key]
+
+            current[key] = fixed
+            values.append(fixed / fixed_scales)
+
+        if not flags & flag_float32:
+            self.previous = current
+
+        rvecs = [quaternion_to_rvec(value[:4]) for value in values]
+        tvecs = [value[4:7] for value in values]
+        centers = [value[7:9] for value in values]
+
+        return ids, rvecs, tvecs, centers, offset
+
+
+def get_stream_json(ids, rvecs, tvecs, centers):
+    """Rebuild the coordinates JSON content of a decoded frame"""
+    if len(ids) == 0:
+        return None
+
+    return get_pose_json(np.array(ids, dtype=np.int32).reshape(-1, 1),
+                         [np.ravel(center).tolist() for center in centers],
+                         np.array(rvecs).reshape(-1, 1, 3),
+                         np.array(tvecs).reshape(-1, 1, 3))
+
+
+def load_coordinates(in_path):
+    """Load the *_camera.json files of a directory in frame order"""
+    files = glob.glob(os.path.join(in_path, '*_camera.json'))
+
+    def frame_order(path):
+        base = os.path.basename(path).split('_')[0]
+        if base.isdigit():
+            return 0, int(base), base
+        return 1, 0, base
+
+    frames = list()
+    for path in sorted(files, key=frame_order):
+        with open(path) as f:
+            frames.append(json.loads(f.read()))
+
+    return frames
+
+
+def benchmark_stream(frames, keyframe_interval=30, float32=False,
+                     max_translation=1e-4, max_rotation=1e-3):
+    """
+    Encode and decode frames and compare the size with the JSON content
+
+    Returns 0 if every pose survived the round trip within `max_translation`
+    meters and `max_rotation` radians.
+    """
+    encoder = PoseStreamEncoder(keyframe_interval, float32)
+    decoder = PoseStreamDecoder()
+
+    stream = bytearray()
+    json_size = 0
+    compact_size = 0
+    failed = 0
+
+    for content in frames:
+        ids = np.ravel(content['ids'])
+        rvecs = np.array(content['rvecs']).reshape(-1, 3)
+        tvecs = np.array(content['tvecs']).reshape(-1, 3)
+
+        stream += encoder.encode(ids, rvecs, tvecs, content['m_c'])
+        json_size += len(json.dumps(content, indent=4))
+        compact_size += len(json.dumps(content, separators=(',', ':')))
+
+    offset = 0
+    for content in frames:
+        ids, rvecs, tvecs, centers, offset = decoder.decode(stream, offset)
+
+        if list(ids) != [int(i) for i in np.ravel(content['ids'])]:
+            logging.error('Ids differ {} {}'.format(ids, content['ids']))
+            failed += 1
+            continue
+
+        decoded = get_stream_json(ids, rvecs, tvecs, centers)
+
+        for key, tolerance in (('tvecs', max_translation),
+                               ('m_c_3d', max_translation),
+                               ('n_vector', max_rotation),
+                               ('xaxis_vector', max_rotation)):
+            error = np.max(np.abs(np.array(decoded[key]).ravel() -
+                                  np.array(content[key]).ravel()))
+            if error > tolerance:
+                logging.error('{} error {}'.format(key, error))
+                failed += 1
+
+    if offset != len(stream):
+        logging.error('Trailing bytes in stream')
+        failed += 1
+
+    n = max(1, len(frames))
+    print('{} frames'.format(len(frames)))
+    print('JSON (indented) {:8.1f} bytes/frame'.format(json_size / float(n)))
+    print('JSON (compact)  {:8.1f} bytes/frame'.format(compact_size /
+                                                       float(n)))
+    print('Pose stream     {:8.1f} bytes/frame'.format(len(stream) /
+                                                       float(n)))
+    print('Round trip {}'.format('failed' if failed else 'ok'))
+
+    if failed:
+        return 1
+
+    return 0
+
+
+def generate_poses(count, seed=0):
+    """
+    Generate the marker poses of `count` consecutive frames
+
+    Markers walk randomly and appear and disappear between frames. The set
+    includes ids that need several varint bytes, a marker rotating through
+    180 degrees, frames without markers and frames with repeated ids.
+    """
+    random = np.random.RandomState(seed)
+    marker_ids = [0, 1, 42, 127, 128, 1000, 2 ** 20]
+    poses = dict()
+
+    for marker_id in marker_ids:
+        poses[marker_id] = [random.uniform(-np.pi / 2, np.pi / 2, 3),
+                            random.uniform(-2, 2, 3) + [0, 0, 3],
+                            random.uniform(-100, 4000, 2)]
+
+    # Rotation angle around pi, where q and -q swap on the encoder
+    poses[42][0] = np.array([0, 0, np.pi - 0.05])
+
+    frames = list()
+    for frame in range(count):
+        ids = list()
+        rvecs = list()
+        tvecs = list()
+        centers = list()
+
+        for marker_id in marker_ids:
+            rvec, tvec, center = poses[marker_id]
+            rvec += random.normal(0, 0.02, 3)
+            tvec += random.normal(0, 0.01, 3)
+            center += random.normal(0, 5, 2)
+
+            if marker_id == 42:
+                rvec[2] += 0.03
+
+            if frame % 11 == 5 or random.uniform() < 0.3:
+                continue
+
+            ids.append(marker_id)
+            rvecs.append(rvec.copy())
+            tvecs.append(tvec.copy())
+            centers.append(center.copy())
+
+        if frame % 7 == 3 and ids:
+            ids.append(ids[0])
+            rvecs.append(rvecs[0] + 0.1)
+            tvecs.append(tvecs[0] + 0.1)
+            centers.append(centers[0] + 10)
+
+        frames.append((ids, rvecs, tvecs, centers))
+
+    return frames
+
+
+def get_rotation_error(rvec, expected):
+    """Angle in radians between the rotations of two rotation vectors"""
+    quaternion = rvec_to_quaternion(rvec)
+    expected = rvec_to_quaternion(expected)
+
+    if np.dot(quaternion, expected) < 0:
+        quaternion = -quaternion
+
+    chord = min(1.0, np.linalg.norm(quaternion - expected) / 2)
+
+    return 4 * np.arcsin(chord)
+
+
+def check_varints():
+    """Round trip the varint and zigzag encoding of edge values"""
+    failed = 0
+
+    for value in (0, 1, 127, 128, 16383, 16384, 2 ** 32 - 1, 2 ** 32,
+                  2 ** 63 - 1, 2 ** 64):
+        out = bytearray([0xff])
+        write_varint(out, value)
+        out.append(0xff)
+        decoded, offset = read_varint(out, 1)
+        size = max(1, (value.bit_length() + 6) // 7)
+
+        if decoded != value or offset != len(out) - 1 or \
+                offset - 1 != size:
+            logging.error('Varint {} decoded as {} in {} bytes'.format(
+                value, decoded, offset - 1))
+            failed += 1
+
+    for value, expected in ((0, 0), (-1, 1), (1, 2), (-64, 127), (63, 126),
+                            (64, 128), (-65, 129), (2 ** 31 - 1, 2 ** 32 - 2),
+                            (-2 ** 31, 2 ** 32 - 1), (2 ** 63 - 1, 2 ** 64 - 2),
+                            (-2 ** 63, 2 ** 64 - 1)):
+        if zigzag(value) != expected or unzigzag(expected) != value:
+            logging.error('Zigzag {} encoded as {}'.format(value,
+                                                           zigzag(value)))
+            failed += 1
+
+    return failed
+
+
+def check_frame(decoded, frame, float32):
+    """Compare a decoded frame with the poses it was encoded from"""
+    ids, rvecs, tvecs, centers = decoded[:4]
+
+    if list(ids) != list(frame[0]):
+        logging.error('Ids differ {} {}'.format(ids, frame[0]))
+        return 1
+
+    if float32:
+        # Half a unit in the last place of the float32 values
+        translation_bound = 2 ** -24 * np.max(np.abs(frame[2]), initial=0)
+        center_bound = 2 ** -24 * np.max(np.abs(frame[3]), initial=0)
+        rotation_bound = 4 * np.arcsin(2 ** -24)
+    else:
+        # Half a unit of the fixed point values, the quaternion error is
+        # at most 1 / scale long before normalization
+        translation_bound = 0.5 / fixed_scales[4]
+        center_bound = 0.5 / fixed_scales[7]
+        rotation_bound = 2 * np.arcsin(1.0 / fixed_scales[0])
+
+    failed = 0
+    for rvec, tvec, center, expected_rvec, expected_tvec, \
+            expected_center in zip(rvecs, tvecs, centers, *frame[1:]):
+        for name, error, bound in (
+                ('rotation', get_rotation_error(rvec, expected_rvec),
+                 rotation_bound),
+                ('translation', np.max(np.abs(tvec - expected_tvec)),
+                 translation_bound),
+                ('center', np.max(np.abs(center - expected_center)),
+                 center_bound)):
+            if error > bound * (1 + 1e-6) + 1e-12:
+                logging.error('{} error {} above {}'.format(name, error,
+                                                             bound))
+                failed += 1
+
+    return failed
+
+
+def check_stream(frames=200, seed=0):
+    """
+    Round trip generated poses through the pose stream
+
+    Checks varint and zigzag edge values, that keyframes decode on their own
+    and the frames in between do not, markers appearing and disappearing and
+    that the decoding error stays within the quantization bound on every
+    frame. Returns the number of failures.
+    """
+    poses = generate_poses(frames, seed)
+    failed = check_varints()
+
+    for keyframe_interval, float32 in ((1, False), (2, False), (5, False),
+                                       (30, False), (frames + 1, False),
+                                       (5, True)):
+        encoder = PoseStreamEncoder(keyframe_interval, float32)
+        decoder = PoseStreamDecoder()
+        previous = list()
+
+        for i, frame in enumerate(poses):
+            data = encoder.encode(*frame)
+            decoded = decoder.decode(data)
+
+            if decoded[4] != len(data):
+                logging.error('Frame {} has trailing bytes'.format(i))
+                failed += 1
+
+            failed += check_frame(decoded, frame, float32)
+
+            keyframe = float32 or i % keyframe_interval == 0
+            if bool(data[0] & flag_keyframe) != keyframe:
+                logging.error('Frame {} keyframe flag is wrong'.format(i))
+                failed += 1
+
+            # A receiver joining the stream can start on any keyframe, but
+            # not on a frame with markers delta encoded to the previous one
+            try:
+                PoseStreamDecoder().decode(data)
+                joined = True
+            except ValueError:
+                joined = False
+
+            if joined != (keyframe or not set(frame[0]) & set(previous)):
+                logging.error('Frame {} decodes on its own: {}'.format(
+                    i, joined))
+                failed += 1
+
+            previous = frame[0]
+
+        logging.info('Keyframe interval {}{} checked'.format(
+            keyframe_interval, ' float32' if float32 else ''))
+
+    return failed
+
+
+if __name__ == '__main__':
+    myargs = getopts(argv)
+    keyframe_interval = 30
+    float32 = False
+
+    if '-v' in myargs:
+        logging.basicConfig(level=logging.INFO)
+
+    if '--check' in myargs:
+        failed = check_stream()
+        print('Self check {}'.format('failed' if failed else 'ok'))
+        exit(1 if failed else 0)
+
+    if '-i' in myargs:
+        in_path = myargs['-i']
+    else:
+        logging.error('No input path provided')
+        exit(-1)
+
+    if '-k' in myargs:
+        keyframe_interval = int(myargs['-k'])
+
+    if '--float' in myargs:
+        float32 = True
+
+    frames = load_coordinates(in_path)
+    if not frames:
+        logging.error('No coordinates files found at ' + in_path)
+        exit(-1)
+
+    ret = benchmark_stream(frames, keyframe_interval, float32)
+    exit(ret)
@@ -11,15 +11,24 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from options import getopts
 from sys import argv
 import logging
 import cv2
 import numpy as np
 import json
 import cv2.aruco as aruco
-import imghdr
 import os
 from get_shared_coord import get_coordinates, calc_3d_location_camera
+from get_shared_coord import detect_markers_pose, detector_presets
+from detection_cache import DetectionCache
+from frame_source import FrameSource
+from shared_frames import map_frames
+from marker_tracker import MarkerTracker
+from dataset_manifest import create_img_list, get_image_size
+from dependency_tracker import get_local_modules, hash_files
+from dependency_tracker import is_up_to_date, write_stamp
+import tracing
 import math
 
 detected_obj = dict()
@@ -36,30 +45,41 @@ llevel_mapping = {'info': logging.INFO,
                   'error': logging.ERROR}
 
 
-def getopts(argv):
-    opts = {}  # Empty dictionary to store key-value pairs.
-    while argv:  # While there are arguments left to parse...
-        if argv[0][0] is '-':  # Found a "-name value" pair.
-            if len(argv) > 1:
-                if argv[1][0] != '-':
-                    opts[argv[0]] = argv[1]
-                else:
-                    opts[argv[0]] = True
-            elif len(argv) == 1:
-                opts[argv[0]] = True
+def get_frame_size(in_path, img_file, fs, input_image=None):
+    """
+    Get the width and height of a frame without decoding it
 
-        # Reduce the argument list by copying it starting from index 1.
-        argv = argv[1:]
-    return opts
+    The size is taken from the decoded image if there is one, then from the
+    image file header and finally from the camera calibration file.
+    """
+    if input_image is not None:
+        height, width = input_image.shape[:2]
+        return width, height
+
+    width, height = get_image_size(in_path, img_file)
+
+    if width is not None:
+        return width, height
+
+    logging.debug('Using calibration image size for ' + img_file)
+
+    return (int(fs.getNode("image_width").real()),
+            int(fs.getNode("image_height").real()))
 
 
 def get_obj_locations_marker_sys(in_path, img_file, camera, params,
-                                 corners, ids, marker_size=0.071):
+                                 corners, ids, marker_size=0.071,
+                                 input_image=None):
+    """
+    Locate the detected objects with respect to the marker system
+
+    Only the marker corners and the detection boxes are used, the image
+    itself is never decoded. Returns the written locations.
+    """
     marker_pixel_size = 150
     pixels_per_cm = marker_pixel_size / (marker_size * 100)
     pixels_per_m = pixels_per_cm * 100
     detection_data = get_detection_data(in_path, img_file)
-    img_path = os.path.join(in_path, img_file)
     marker_json_file = get_base_file(img_file) + "_marker.json"
     obj_detect_coords_path = os.path.join(in_path,
                                           "coords",
@@ -79,9 +99,7 @@ def get_obj_locations_marker_sys(in_path, img_file, camera, params,
     intrinsics = fs.getNode("camera_matrix")
     distortion = fs.getNode("distortion_coefficients")
 
-    input_image = cv2.imread(img_path)
-
-    height, width, channels = input_image.shape
+    width, height = get_frame_size(in_path, img_file, fs, input_image)
 
     center_x = int((out_img_scale * width)/2)
     center_y = int((out_img_scale * height)/2)
@@ -108,9 +126,10 @@ def get_obj_locations_marker_sys(in_path, img_file, camera, params,
                                                     distortion.mat(),
                                                     P=newCamMatrix)
 
-    H_plane, _ = cv2.findHomography(undistortedMarkersCorners,
-                                    rectified_marker_corners,
-                                    cv2.RANSAC)
+    with tracing.span('homography'):
+        H_plane, _ = cv2.findHomography(undistortedMarkersCorners,
+                                        rectified_marker_corners,
+                                        cv2.RANSAC)
 
     logging.debug('Homography Plane -> {}'.format(H_plane))
 
@@ -152,9 +171,10 @@ def get_obj_locations_marker_sys(in_path, img_file, camera, params,
                                   distortion.mat(),
                                   P=newCamMatrix)
 
-    H_marker, _ = cv2.findHomography(undistortedMarkersCorners,
-                                     rectified_marker_corners,
-                                     cv2.RANSAC)
+    with tracing.span('homography'):
+        H_marker, _ = cv2.findHomography(undistortedMarkersCorners,
+                                         rectified_marker_corners,
+                                         cv2.RANSAC)
 
     logging.debug('Homography Marker-> {}'.format(H_marker))
 
@@ -171,9 +191,10 @@ def get_obj_locations_marker_sys(in_path, img_file, camera, params,
                                  distortion.mat(),
                                  P=newCamMatrix)
 
-    H_lettuce, _ = cv2.findHomography(undistortedMarkersCorners,
-                                      rectified_marker_corners,
-                                      cv2.RANSAC)
+    with tracing.span('homography'):
+        H_lettuce, _ = cv2.findHomography(undistortedMarkersCorners,
+                                          rectified_marker_corners,
+                                          cv2.RANSAC)
 
     logging.debug('Homography Marker-> {}'.format(H_marker))
 
@@ -198,7 +219,8 @@ def get_obj_locations_marker_sys(in_path, img_file, camera, params,
         logging.debug('Center {}'.format(obj_center))
 
         # Obtain the 2D location with respect to the marker
-        location_2d = cv2.perspectiveTransform(obj_center, H_marker)
+        with tracing.span('perspective_transform'):
+            location_2d = cv2.perspectiveTransform(obj_center, H_marker)
         location_2d -= np.array([[center_x, center_y]])
         location_2d = location_2d / pixels_per_m
 
@@ -209,11 +231,10 @@ def get_obj_locations_marker_sys(in_path, img_file, camera, params,
         data["lettuce_maker"] = dict()
         data["lettuce_maker"]["marker_location"] = location_3d.tolist()
 
-    with open(obj_detect_coords_path, 'w') as outfile:
-        json.dump(data, outfile, indent=4)
+    tracing.write_json(obj_detect_coords_path, data)
 
     if not detection_data:
-        return
+        return data
 
     for box in detection_data:
         obj_center = np.array([[(box[0] + box[2])/2,
@@ -223,7 +244,8 @@ def get_obj_locations_marker_sys(in_path, img_file, camera, params,
         # logging.debug('Center {}'.format(obj_center))
 
         # Obtain the 2D location with respect to the marker
-        location_2d = cv2.perspectiveTransform(obj_center, H_lettuce)
+        with tracing.span('perspective_transform'):
+            location_2d = cv2.perspectiveTransform(obj_center, H_lettuce)
         location_2d -= np.array([[center_x, center_y]])
         location_2d = location_2d / pixels_per_m
 
@@ -243,11 +265,13 @@ def get_obj_locations_marker_sys(in_path, img_file, camera, params,
 
         data[obj_name]["camera_location"] = point_3d.reshape((1, 3)).tolist()
 
-    with open(obj_detect_coords_path, 'w') as outfile:
-        json.dump(data, outfile, indent=4)
+    tracing.write_json(obj_detect_coords_path, data)
 
+    return data
 
-def create_augmented_img(in_path, img_file, camera, marker_size=0.071):
+
+def create_augmented_img(in_path, img_file, camera, marker_size=0.071,
+                         detection=None, input_image=None):
 
     img_path = os.path.join(in_path, img_file)
     out_img_file = os.path.join(in_path,
@@ -268,21 +292,30 @@ def create_augmented_img(in_path, img_file, camera, marker_size=0.071):
     if not detection_data:
         return
 
-    output_image = cv2.imread(img_path)
-    output_image = draw_bounding_boxes(output_image, detection_data)
-    output_image = draw_marker_coord_sys(output_image, camera, marker_size)
+    if input_image is None:
+        with tracing.span('decode', path=img_path):
+            output_image = cv2.imread(img_path)
+    else:
+        output_image = input_image.copy()
+
+    with tracing.span('render'):
+        output_image = draw_bounding_boxes(output_image, detection_data)
+        output_image = draw_marker_coord_sys(output_image, camera,
+                                             marker_size, detection)
 
-    data = draw_objs_sys(output_image, answer_data, camera)
+        data = draw_objs_sys(output_image, answer_data, camera)
 
     file_path = os.path.join(in_path,
                              "coords",
                              "hl_dl",
                              get_base_file(img_file) + "_camera.json")
 
-    with open(file_path, 'w') as outfile:
-        json.dump(data, outfile, indent=4)
+    tracing.write_json(file_path, data)
 
-    cv2.imwrite(out_img_file, output_image)
+    with tracing.span('write', path=out_img_file):
+        cv2.imwrite(out_img_file, output_image)
+
+    return data
 
 
 def draw_bounding_boxes(in_img, detection_data):
@@ -322,32 +355,29 @@ def draw_marker_coord_sys_axis(in_img, intrinsics, distortion, rvecs, tvecs):
                        0.1)
 
 
-def draw_marker_coord_sys(in_img, camera, marker_size=0.071):
+def draw_marker_coord_sys(in_img, camera, marker_size=0.071, detection=None):
+    """
+    Draw the detected markers and their axis
+
+    `detection` holds the ids, corners, rvecs and tvecs of the markers if
+    they were already detected.
+    """
 
     fs = cv2.FileStorage(camera, cv2.FILE_STORAGE_READ)
 
     intrinsics = fs.getNode("camera_matrix")
     distortion = fs.getNode("distortion_coefficients")
 
-    aruco_dict = aruco.Dictionary_get(aruco.DICT_6X6_250)
-    parameters = aruco.DetectorParameters_create()
-    parameters.cornerRefinementMethod = aruco.CORNER_REFINE_SUBPIX
+    if detection is None:
+        detection = detect_markers_pose(in_img,
+                                        intrinsics,
+                                        distortion,
+                                        marker_size)
 
-    corners, ids, rejectedImgPoints = aruco.detectMarkers(in_img,
-                                                          aruco_dict,
-                                                          intrinsics.mat(),
-                                                          distortion.mat(),
-                                                          parameters=parameters
-                                                          )
+    ids, corners, rvecs, tvecs = detection
 
     if len(corners) == 0:
         return in_img
-
-    # Detect the camera pose
-    rvecs, tvecs, n = aruco.estimatePoseSingleMarkers(corners,
-                                                      marker_size,
-                                                      intrinsics.mat(),
-                                                      distortion.mat())
     logging.debug(rvecs)
     logging.debug(tvecs)
     # Prepare the output image
@@ -390,6 +420,9 @@ def get_camera_hom_cord(u, v, depth, intrinsics):
 
 all_detected_obj_data = dict()
 
+# Detection caches opened by this (worker) process
+worker_caches = dict()
+
 
 def draw_objs_sys(in_img, answer_data, camera):
     # logging.debug("Answer Data:")
@@ -444,20 +477,6 @@ def draw_objs_sys(in_img, answer_data, camera):
     return detected_obj_data
 
 
-def create_img_list(in_path):
-    img_list = list()
-    for filename in os.listdir(in_path):
-        full_path = os.path.join(in_path, filename)
-        if os.path.isdir(full_path):
-            continue
-
-        im_type = imghdr.what(full_path)
-        if im_type in supported_img:
-            img_list.append(filename)
-
-    return img_list
-
-
 def get_base_file(img_file):
     base = os.path.splitext(img_file)[0]
     return base
@@ -508,12 +527,309 @@ def get_marker_sys_corners(ids, corners):
     return corners[0], 23, 0
 
 
+def get_frame_outputs(in_path, img_file):
+    """Get the paths of all the files generated for a frame"""
+    base = get_base_file(img_file)
+
+    return [os.path.join(in_path, "augmented", get_augmented_file(img_file)),
+            os.path.join(in_path, "coords", "hl_dl", base + "_camera.json"),
+            os.path.join(in_path, "coords", "marker", base + "_camera.json"),
+            os.path.join(in_path, "coords", "marker", base + "_marker.json")]
+
+
+def load_frame_record(in_path, img_file):
+    """
+    Load the coordinates written for a frame
+
+    Returns the same record as process_img, with None for the files that
+    weren't written.
+    """
+    record = dict()
+
+    for key, path in zip(('hl_dl', 'marker_camera', 'marker'),
+                         get_frame_outputs(in_path, img_file)[1:]):
+        record[key] = None
+        if os.path.exists(path):
+            with open(path) as f:
+                record[key] = json.loads(f.read())
+
+    return record
+
+
+def get_frame_inputs(in_path, img_file, camera):
+    """Get the paths of all the files a frame's outputs depend on"""
+    return [os.path.join(in_path, img_file),
+            os.path.join(in_path, get_detection_file(img_file)),
+            os.path.join(in_path, get_answer_file(img_file)),
+            os.path.abspath(camera)]
+
+
+def get_stamp_file(in_path, img_file):
+    return os.path.join(in_path,
+                        "coords",
+                        "deps",
+                        get_base_file(img_file) + ".json")
+
+
+def get_code_version():
+    """
+    Get a digest of the code the outputs are generated with
+
+    All the local modules this one imports, directly or not, are hashed;
+    the detector presets, the tracker, the transforms and the manifest
+    among them.
+    """
+    return hash_files(get_local_modules(__file__))
+
+
+def process_img(in_path, img, camera, marker_size=0.071, cache=None,
+                input_image=None, tracker=None, preset='default'):
+    """
+    Generate all the outputs of a single frame
+
+    The image is decoded here unless it was already decoded and given as
+    `input_image`. Frames of a sequence can be followed by a `tracker`.
+    `preset` names the marker detector settings. Returns the coordinates
+    written as a record of the `hl_dl`, `marker_camera` and `marker`
+    contents, None for the ones not written.
+    """
+    record = {'hl_dl': None, 'marker_camera': None, 'marker': None}
+
+    logging.debug(img)
+    full_in_img_path = os.path.join(in_path, img)
+
+    file_path = os.path.join(in_path,
+                             "coords",
+                             "marker",
+                             get_base_file(img) + "_camera.json")
+
+    # Get the coordinates reference frame of marker
+    id, corners, params = get_coordinates(full_in_img_path,
+                                          camera,
+                                          parameters_path=file_path,
+                                          marker_size=marker_size,
+                                          cache=cache,
+                                          input_image=input_image,
+                                          tracker=tracker,
+                                          preset=preset)
+
+    # Reuse the detection to draw the augmented image
+    detection = (None, [], None, None)
+    if id is not None:
+        detection = (id,
+                     corners,
+                     np.array(params['rvecs']),
+                     np.array(params['tvecs']))
+
+    record['marker_camera'] = params
+    record['hl_dl'] = create_augmented_img(in_path, img, camera, marker_size,
+                                           detection, input_image)
+
+    if id is None:
+        return record
+
+    if len(id) == 0:
+        logging.warning("No marker found in image " + img)
+        return record
+
+    if not check_marker_sys(id):
+        return record
+
+    record['marker'] = get_obj_locations_marker_sys(in_path,
+                                                    img,
+                                                    camera,
+                                                    params,
+                                                    corners,
+                                                    id,
+                                                    marker_size,
+                                                    input_image)
+
+    logging.debug("Distance to object from camera")
+    logging.debug(np.linalg.norm(params['m_c_3d'][0][0]))
+
+    return record
+
+
+def process_img_frame(input_image, img_path, camera, marker_size=0.071,
+                      cache_path=None, preset='default', trace=False):
+    """
+    Process a frame handed over to a worker process by map_frames
+
+    If `trace` is set the frame is traced and the events recorded by the
+    worker are returned, see tracing.
+    """
+    cache = None
+
+    if trace:
+        tracing.enable()
+
+    if cache_path is not None:
+        if cache_path not in worker_caches:
+            worker_caches[cache_path] = DetectionCache(cache_path)
+        cache = worker_caches[cache_path]
+
+    in_path, img = os.path.split(img_path)
+
+    with tracing.span('frame', frame=img):
+        process_img(in_path, img, camera, marker_size, cache, input_image,
+                    preset=preset)
+
+    if trace:
+        return tracing.pop_events()
+
+
+def get_frame_order(img_file):
+    """Sort key putting frames named after their number in sequence order"""
+    base = get_base_file(img_file)
+
+    if base.isdigit():
+        return 0, int(base), base
+
+    return 1, 0, base
+
+
+def process_data_set(in_path, camera, marker_size=0.071, force=False,
+                     cache=None, prefetch=4, decoders=2, workers=1,
+                     track=0, preset='default', records=None):
+    """
+    Process all the frames of a data set
+
+    Frames whose outputs are up to date with respect to their image,
+    detection file, answer file, camera file, marker size and the code
+    version are skipped unless `force` is set. Marker detections are looked
+    up in `cache` first, if given. Up to `prefetch` images are decoded ahead
+    by `decoders` threads while the current one is processed. With more than
+    one worker the frames are processed by a pool of `workers` processes.
+
+    If `track` is set the frames are processed as a sequence where the full
+    marker detection only runs every `track` frames and the markers are
+    tracked in between. Tracking needs the frames in order so it runs in a
+    single process and doesn't use the cache.
+
+    `preset` names the marker detector settings, see
+    get_shared_coord.detector_presets.
+
+    If a `records` dictionary is given it's filled with the record of every
+    frame by base file name, see process_img. Records of frames processed
+    here are kept from memory, the others are loaded from their files.
+    """
+    img_list = create_img_list(in_path)
+
+    augmented_path = os.path.join(in_path, "augmented")
+    if not os.path.exists(augmented_path):
+        os.makedirs(augmented_path)
+
+    obj_detect_coords_path = os.path.join(in_path, "coords")
+    if not os.path.exists(obj_detect_coords_path):
+        os.makedirs(obj_detect_coords_path)
+
+    obj_detect_coords_path = os.path.join(in_path, "coords", "marker")
+    if not os.path.exists(obj_detect_coords_path):
+        os.makedirs(obj_detect_coords_path)
+
+    obj_detect_coords_path = os.path.join(in_path, "coords", "hl_dl")
+    if not os.path.exists(obj_detect_coords_path):
+        os.makedirs(obj_detect_coords_path)
+
+    values = {'marker_size': marker_size,
+              'version': get_code_version()}
+
+    # Tracked poses differ slightly from detected ones
+    if track:
+        values['track'] = track
+
+    if preset != 'default':
+        values['preset'] = preset
+
+    outdated = list()
+
+    for img in img_list:
+        stamp_path = get_stamp_file(in_path, img)
+        inputs = get_frame_inputs(in_path, img, camera)
+
+        if not force and is_up_to_date(stamp_path, inputs, values):
+            logging.debug('{} is up to date'.format(img))
+            continue
+
+        outdated.append(img)
+
+    tracker = None
+
+    if track:
+        outdated.sort(key=get_frame_order)
+        # The calibration nodes are only valid while the file is open
+        camera_fs = cv2.FileStorage(camera, cv2.FILE_STORAGE_READ)
+        tracker = MarkerTracker(camera_fs.getNode("camera_matrix"),
+                                camera_fs.getNode("distortion_coefficients"),
+                                marker_size,
+                                track,
+                                preset=preset)
+        workers = 1
+        cache = None
+
+    img_paths = [os.path.join(in_path, img) for img in outdated]
+
+    if workers > 1:
+        cache_path = None
+        if cache is not None:
+            cache_path = cache.cache_path
+
+        frames = map_frames(process_img_frame,
+                            img_paths,
+                            (camera, marker_size, cache_path, preset,
+                             tracing.is_enabled()),
+                            workers,
+                            prefetch=prefetch,
+                            decoders=decoders)
+    else:
+        frames = FrameSource(img_paths, prefetch, decoders)
+
+    for img, (_, result) in zip(outdated, frames):
+        if workers > 1:
+            # The worker's trace events
+            tracing.add_events(result)
+        else:
+            with tracing.span('frame', frame=img):
+                record = process_img(in_path, img, camera, marker_size,
+                                     cache, result, tracker, preset)
+            if records is not None:
+                records[get_base_file(img)] = record
+
+        with tracing.span('write_stamp'):
+            write_stamp(get_stamp_file(in_path, img),
+                        get_frame_inputs(in_path, img, camera),
+                        values,
+                        get_frame_outputs(in_path, img))
+
+    logging.info('Processed {} images, {} up to date'.format(
+        len(outdated), len(img_list) - len(outdated)))
+
+    if records is not None:
+        for img in img_list:
+            if get_base_file(img) not in records:
+                records[get_base_file(img)] = load_frame_record(in_path, img)
+
+    if tracker is not None:
+        logging.info('Full detection ran on {} of {} frames'.format(
+            tracker.keyframes, tracker.frames))
+
+    return 0
+
+
 if __name__ == '__main__':
     myargs = getopts(argv)
     out_path = None
     in_path = None
     params_path = None
     marker_size = 0.068
+    force = False
+    cache = None
+    prefetch = 4
+    decoders = 2
+    workers = 1
+    track = 0
+    preset = 'default'
+    trace_path = None
 
     if '-l' in myargs:
         logging.basicConfig(level=llevel_mapping[myargs['-l']])
@@ -539,57 +855,45 @@ if __name__ == '__main__':
     else:
         marker_size = 0.071
 
-    img_list = create_img_list(in_path)
+    if '-f' in myargs:
+        force = True
 
-    augmented_path = os.path.join(in_path, "augmented")
-    if not os.path.exists(augmented_path):
-        os.makedirs(augmented_path)
+    if '-k' in myargs:
+        cache = DetectionCache(myargs['-k'])
 
-    obj_detect_coords_path = os.path.join(in_path, "coords")
-    if not os.path.exists(obj_detect_coords_path):
-        os.makedirs(obj_detect_coords_path)
+    if '--prefetch' in myargs:
+        prefetch = int(myargs['--prefetch'])
 
-    obj_detect_coords_path = os.path.join(in_path, "coords", "marker")
-    if not os.path.exists(obj_detect_coords_path):
-        os.makedirs(obj_detect_coords_path)
+    if '--decoders' in myargs:
+        decoders = int(myargs['--decoders'])
 
-    obj_detect_coords_path = os.path.join(in_path, "coords", "hl_dl")
-    if not os.path.exists(obj_detect_coords_path):
-        os.makedirs(obj_detect_coords_path)
+    if '-j' in myargs:
+        workers = int(myargs['-j'])
 
-    for img in img_list:
-        logging.debug(img)
-        full_in_img_path = os.path.join(in_path, img)
-        create_augmented_img(in_path, img, camera, marker_size)
-
-        file_path = os.path.join(in_path,
-                                 "coords",
-                                 "marker",
-                                 get_base_file(img) + "_camera.json")
-
-        # Get the coordinates reference frame of marker
-        id, corners, params = get_coordinates(full_in_img_path,
-                                              camera,
-                                              parameters_path=file_path,
-                                              marker_size=marker_size)
-
-        if id is None:
-            continue
+    if '--track' in myargs:
+        track = int(myargs['--track'])
 
-        if len(id) == 0:
-            logging.warning("No marker found in image " + img)
-            continue
+    if '--preset' in myargs:
+        preset = myargs['--preset']
 
-        if not check_marker_sys(id):
-            continue
+        if preset not in detector_presets:
+            logging.error('Unknown detector preset ' + preset)
+            exit(-1)
+
+    if '--trace' in myargs:
+        trace_path = myargs['--trace']
+        tracing.enable()
+
+    if '--timings' in myargs:
+        tracing.enable()
+
+    ret = process_data_set(in_path, camera, marker_size, force, cache,
+                           prefetch, decoders, workers, track, preset)
+
+    if trace_path is not None:
+        tracing.write_trace(trace_path)
 
-        get_obj_locations_marker_sys(in_path,
-                                     img,
-                                     camera,
-                                     params,
-                                     corners,
-                                     id,
-                                     marker_size)
+    if '--timings' in myargs:
+        tracing.print_timings()
 
-        logging.debug("Distance to object from camera")
-        logging.debug(np.linalg.norm(params['m_c_3d'][0][0]))
+    exit(ret)
@@ -11,11 +11,15 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from pose_gate import PoseChangeGate, get_matrix_pose, identity
+from options import getopts
 from sys import argv
+import gzip
 import logging
 import json
 import os
 import re
+import tracing
 
 
 detected_obj = dict()
@@ -42,23 +46,6 @@ data_shared_coord_keywords_matrix = ["Shared base",
                                      "Inverted shared base"]
 
 
-def getopts(argv):
-    opts = {}  # Empty dictionary to store key-value pairs.
-    while argv:  # While there are arguments left to parse...
-        if argv[0][0] is '-':  # Found a "-name value" pair.
-            if len(argv) > 1:
-                if argv[1][0] != '-':
-                    opts[argv[0]] = argv[1]
-                else:
-                    opts[argv[0]] = True
-            elif len(argv) == 1:
-                opts[argv[0]] = True
-
-        # Reduce the argument list by copying it starting from index 1.
-        argv = argv[1:]
-    return opts
-
-
 def check_frame_start(line):
     """Verify if the line is actually a frame start line"""
     return '{"status": "success", "engine_id": "Sandwich"' in line
@@ -121,7 +108,7 @@ def get_json_data(line, json_data):
 
     if (len(line_s) == 2):
         # For the case were the data comes like - key: (a, b, c)
-        if re.match("\(.*\)", line_s[1].strip()):
+        if re.match(r"\(.*\)", line_s[1].strip()):
             get_frame_data_coords_parentesis(line_s[1].strip(),
                                              json_data[line_s[0]])
             return
@@ -195,6 +182,24 @@ def get_shared_coords(content):
     return json_data
 
 
+def get_shared_pose(shared):
+    """
+    Get the pose of the shared coordinates system
+
+    Taken from the shared base matrix, or from the origin point if the log
+    has no matrix. Returns None if neither is there.
+    """
+    matrix = shared.get("Shared base")
+    if matrix and len(matrix) == 4 and all(len(row) == 4 for row in matrix):
+        return get_matrix_pose(matrix)
+
+    origin = shared.get("Origin point for shared coordinate system")
+    if isinstance(origin, dict) and all(k in origin for k in 'xyz'):
+        return identity, [origin['x'], origin['y'], origin['z']]
+
+    return None
+
+
 def get_frame_data_info(content):
     """Get data of a single frame"""
 
@@ -218,26 +223,24 @@ def get_frame_data_info(content):
     return json_data, shared
 
 
-def process_log(log_path, out_path=None):
-    """Process an entire log file"""
-    content = None
-    out_path_full = None
+def read_log(log_path):
+    """Read the stripped lines of a log, gzip compressed if it ends with .gz"""
+    with tracing.span('read', path=log_path):
+        if log_path.endswith('.gz'):
+            f = gzip.open(log_path, 'rt')
+        else:
+            f = open(log_path)
 
-    with open(log_path) as f:
-        content = f.readlines()
-        content = [x.strip() for x in content]
+        with f:
+            content = f.readlines()
+            return [x.strip() for x in content]
 
-    if not content:
-        return -1
 
+def get_frames(content):
+    """Split the lines of a log, yields the id and lines of each frame"""
     frame_data_idx = get_next_frame_info(content, 0)
     prev_frame_data_idx = 0
 
-    if out_path:
-        out_path_full = os.path.join(out_path, 'coords', 'hl_rc')
-        if not os.path.exists(out_path_full):
-            os.makedirs(out_path_full)
-
     # Get the data of each image
     while(frame_data_idx + 1 < len(content)):
         prev_frame_data_idx = frame_data_idx
@@ -249,21 +252,82 @@ def process_log(log_path, out_path=None):
         logging.debug("   from line " + str(prev_frame_data_idx))
         logging.debug("   to line " + str(frame_data_idx))
 
-        sub_content = content[prev_frame_data_idx:frame_data_idx]
+        yield id, content[prev_frame_data_idx:frame_data_idx]
+
+
+def parse_log(log_path, translation_threshold=0.005, rotation_threshold=1.0,
+              on_frame=None):
+    """
+    Parse the frames of a log file
+
+    Returns the data of each frame by frame id and the last published
+    shared coordinates, None if the log is empty. The shared coordinates
+    are only published again when the shared base moved more than
+    `translation_threshold` meters or `rotation_threshold` degrees, see
+    pose_gate.PoseChangeGate. `on_frame` is called with the id, the data
+    and the newly published shared coordinates (or None) of each frame.
+    Logs ending with .gz are read gzip compressed.
+    """
+    gate = PoseChangeGate(translation_threshold, rotation_threshold)
+    frames = dict()
+    published = None
+
+    content = read_log(log_path)
+    if not content:
+        return None
+
+    for id, sub_content in get_frames(content):
+        with tracing.span('parse_frame', frame=id):
+            data, shared = get_frame_data_info(sub_content)
+        frames[str(id)] = data
+
+        if shared:
+            pose = get_shared_pose(shared)
+            if pose is not None and not gate.update(*pose):
+                logging.debug("Shared base unchanged")
+                shared = None
+            else:
+                published = shared
 
-        data, shared = get_frame_data_info(sub_content)
+        if on_frame is not None:
+            on_frame(id, data, shared)
 
+    gate.log_stats('Shared base')
+
+    return frames, published
+
+
+def process_log(log_path, out_path=None, translation_threshold=0.005,
+                rotation_threshold=1.0):
+    """
+    Process an entire log file
+
+    The shared coordinates file is only written again when the shared base
+    moved, see parse_log.
+    """
+    out_path_full = None
+
+    if out_path:
+        out_path_full = os.path.join(out_path, 'coords', 'hl_rc')
+        if not os.path.exists(out_path_full):
+            os.makedirs(out_path_full)
+
+    def write_frame(id, data, shared):
         if not out_path:
-            continue
+            return
 
         file_path = os.path.join(out_path_full, str(id) + "_dl_coords.json")
-        with open(file_path, 'w') as outfile:
-            json.dump(data, outfile, indent=4)
+        tracing.write_json(file_path, data)
 
-        if shared:
-            file_path = os.path.join(out_path_full, "shared_coords.json")
-            with open(file_path, 'w') as outfile:
-                json.dump(shared, outfile, indent=4)
+        if not shared:
+            return
+
+        file_path = os.path.join(out_path_full, "shared_coords.json")
+        tracing.write_json(file_path, shared)
+
+    if parse_log(log_path, translation_threshold, rotation_threshold,
+                 write_frame) is None:
+        return -1
 
     return 0
 
@@ -272,6 +336,9 @@ if __name__ == '__main__':
     myargs = getopts(argv)
     out_path = None
     in_path = None
+    translation_threshold = 0.005
+    rotation_threshold = 1.0
+    trace_path = None
 
     if '-v' in myargs:
         logging.basicConfig(level=logging.DEBUG)
@@ -286,5 +353,26 @@ if __name__ == '__main__':
     if '-o' in myargs:
         out_path = myargs['-o']
 
-    ret = process_log(in_path, out_path)
+    if '-t' in myargs:
+        translation_threshold = float(myargs['-t'])
+
+    if '-a' in myargs:
+        rotation_threshold = float(myargs['-a'])
+
+    if '--trace' in myargs:
+        trace_path = myargs['--trace']
+        tracing.enable()
+
+    if '--timings' in myargs:
+        tracing.enable()
+
+    ret = process_log(in_path, out_path, translation_threshold,
+                      rotation_threshold)
+
+    if trace_path is not None:
+        tracing.write_trace(trace_path)
+
+    if '--timings' in myargs:
+        tracing.print_timings()
+
     exit(ret)
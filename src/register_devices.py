@@ -0,0 +1,546 @@
+# Copyright 2018 Pedro Cuadra - pjcuadra@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from pose_gate import get_matrix_pose
+from process_log import get_frame_data_info, get_frames, read_log
+from transforms import Transform
+from options import getopts
+from sys import argv
+import json
+import logging
+import time
+import numpy as np
+
+# Registration of the world coordinates systems of two devices looking at
+# the same marker, e.g. hololens1 and hololens2. Each device logs the
+# "Shared base", the transform of the marker to its world, on the frames it
+# saw the marker. The frames of both logs taken at the same time are paired
+# by a sync file and each pair gives the marker center and corners in both
+# world systems as correspondences. The worlds stay put while the devices
+# move, frames where a device misplaced the marker are outliers.
+
+# Maximum number of hypothesis x correspondence residuals evaluated at once
+ransac_block_size = 2 ** 22
+
+# Hypotheses scored before checking if enough of them were tried
+ransac_min_block = 16
+
+
+def get_marker_points(marker_size=0.071):
+    """Center and corners of a marker in its own coordinates system"""
+    half = marker_size / 2.0
+
+    return np.array([[0, 0, 0],
+                     [-half, half, 0],
+                     [half, half, 0],
+                     [half, -half, 0],
+                     [-half, -half, 0]])
+
+
+def load_shared_bases(log_path):
+    """
+    Load the shared base logged on each frame of a HoloLens log
+
+    Returns a dict of frame id to the marker to world Transform, for the
+    frames with a "Shared base" matrix. The matrix layout is the one of
+    pose_gate.get_matrix_pose.
+    """
+    bases = dict()
+
+    for frame, content in get_frames(read_log(log_path)):
+        data, shared = get_frame_data_info(content)
+        matrix = shared.get("Shared base") if shared else None
+
+        if not matrix or len(matrix) != 4 or \
+                any(len(row) != 4 for row in matrix):
+            continue
+
+        bases[str(frame)] = Transform.from_rotation(*get_matrix_pose(matrix))
+
+    return bases
+
+
+def load_sync(sync_path):
+    """
+    Load the frame pairs of a sync file
+
+    The sync file is a JSON list of [frame of a, frame of b] pairs of the
+    frames both devices took at the same time.
+    """
+    with open(sync_path) as f:
+        pairs = json.loads(f.read())
+
+    return [(str(frame_a), str(frame_b)) for frame_a, frame_b in pairs]
+
+
+def get_correspondences(bases_a, bases_b, pairs, marker_size=0.071):
+    """
+    Get the marker points in the world systems of both devices
+
+    Returns the pairs of frames with a shared base on both devices and two
+    (N, 3) arrays of points, the points of each pair are consecutive.
+    """
+    pairs = [(frame_a, frame_b) for frame_a, frame_b in pairs
+             if frame_a in bases_a and frame_b in bases_b]
+    points = get_marker_points(marker_size)
+
+    src = np.empty((len(pairs) * len(points), 3))
+    dst = np.empty((len(pairs) * len(points), 3))
+
+    for i, (frame_a, frame_b) in enumerate(pairs):
+        rows = slice(i * len(points), (i + 1) * len(points))
+        src[rows] = bases_a[frame_a].apply(points)
+        dst[rows] = bases_b[frame_b].apply(points)
+
+    return pairs, src, dst
+
+
+def solve_rigid(count, sum_src, sum_dst, sum_cross, sum_sq_src=None):
+    """
+    Solve the Umeyama alignment from the sums of the correspondences
+
+    `sum_cross` is the sum of the outer products src dst^T. The arguments
+    may be stacked along a first axis to solve many alignments at once.
+    With `sum_sq_src`, the sum of the squared norms of src, a scale is
+    estimated as well. Returns the rotations, translations and scales.
+    """
+    count = np.asarray(count, dtype=np.float64)[..., None]
+    mean_src = sum_src / count
+    mean_dst = sum_dst / count
+
+    # Cross covariance of the centered points
+    cov = (sum_cross / count[..., None] -
+           mean_src[..., :, None] * mean_dst[..., None, :])
+
+    u, s, vt = np.linalg.svd(cov)
+
+    # Avoid reflections; flipping the axis of the smallest singular value
+    # alone turns U V^T into the closest proper rotation
+    d = np.where(np.linalg.det(np.matmul(u, vt)) < 0, -1.0, 1.0)
+    s[..., 2] *= d
+    vt[..., 2, :] *= d[..., None]
+
+    rotation = np.matmul(u, vt).swapaxes(-1, -2)
+
+    if np.any(np.linalg.det(rotation) <= 0):
+        raise ValueError('Alignment is not a proper rotation')
+
+    scale = np.ones(count.shape[:-1])
+    if sum_sq_src is not None:
+        var_src = (sum_sq_src / count[..., 0] -
+                   np.sum(mean_src * mean_src, axis=-1))
+        scale = np.sum(s, axis=-1) / var_src
+
+    translation = mean_dst - scale[..., None] * np.einsum('...ij,...j->...i',
+                                                         rotation,
+                                                         mean_src)
+
+    return rotation, translation, scale
+
+
+def get_sums(src, dst):
+    """Sums of a set of correspondences, as used by solve_rigid"""
+    return (src.shape[-2],
+            np.sum(src, axis=-2),
+            np.sum(dst, axis=-2),
+            np.matmul(src.swapaxes(-1, -2), dst),
+            np.sum(src * src, axis=(-2, -1)))
+
+
+def fit_rigid(src, dst, with_scale=False):
+    """Least squares rigid (or similarity) transform mapping src to dst"""
+    count, sum_src, sum_dst, sum_cross, sum_sq = get_sums(src, dst)
+
+    rotation, translation, scale = solve_rigid(
+        count, sum_src, sum_dst, sum_cross, sum_sq if with_scale else None)
+
+    return rotation * scale[..., None, None], translation
+
+
+def get_residuals(rotation, translation, src, dst):
+    """Distances between the transformed src and dst points"""
+    return np.linalg.norm(np.matmul(src, rotation.swapaxes(-1, -2)) +
+                          translation[..., None, :] - dst, axis=-1)
+
+
+def get_inliers(rotations, translations, src, dst, threshold, group):
+    """
+    Inlier groups of many hypotheses, as (hypotheses, groups) mask
+
+    All hypotheses are applied with a single matrix product of the points
+    and the rotations side by side.
+    """
+    count = len(rotations)
+    stacked = rotations.swapaxes(1, 2).transpose(1, 0, 2).reshape(3, -1)
+
+    diff = np.matmul(src, stacked).reshape(len(src), count, 3)
+    diff += translations
+    diff -= dst[:, None, :]
+
+    outliers = np.einsum('nki,nki->kn', diff, diff) >= threshold ** 2
+
+    return ~np.any(outliers.reshape(count, -1, group), axis=2)
+
+
+def ransac_rigid(src, dst, threshold=0.01, iterations=256, group=1,
+                 with_scale=False, seed=0, confidence=0.999):
+    """
+    Fit a rigid transform robust to outliers
+
+    Hypotheses are fit to random minimal samples all at once, with stacked
+    SVDs, and scored in blocks against every correspondence. `group`
+    consecutive correspondences (e.g. the points of one frame) are kept or
+    dropped together, a group is an inlier if all its residuals are below
+    `threshold` meters. Scoring stops once a sample free of outliers was
+    drawn with the given `confidence`, at most `iterations` hypotheses are
+    tried. The best hypothesis is refit on its inliers, twice so the
+    inliers of the first refit are picked up as well. Returns the rotation, translation and the inlier mask of the groups.
+    """
+    groups = len(src) // group
+    if groups == 0:
+        raise ValueError('No correspondences')
+
+    rng = np.random.default_rng(seed)
+
+    # At least 3 points, from 2 groups to get some spread between them
+    sample_size = min(max(2, int(np.ceil(3.0 / group))), groups)
+
+    samples = rng.integers(0, groups, (iterations, sample_size))
+    points = (samples[:, :, None] * group +
+              np.arange(group)).reshape(iterations, -1)
+
+    rotations, translations = fit_rigid(src[points], dst[points], with_scale)
+
+    block = max(1, min(ransac_min_block, ransac_block_size // len(src)))
+    best = None
+    best_count = -1
+    needed = iterations
+
+    for start in range(0, iterations, block):
+        if start >= needed:
+            break
+
+        inliers = get_inliers(rotations[start:start + block],
+                              translations[start:start + block],
+                              src, dst, threshold, group)
+        counts = np.sum(inliers, axis=1)
+
+        i = int(np.argmax(counts))
+        if counts[i] > best_count:
+            best_count = counts[i]
+            best = inliers[i]
+
+            # Probability of a sample without outliers
+            clean = (best_count / float(groups)) ** sample_size
+            if clean >= 1:
+                needed = 0
+            elif clean > 0:
+                needed = np.log(1 - confidence) / np.log(1 - clean)
+
+    if best_count < sample_size:
+        best = np.ones(groups, dtype=bool)
+
+    for i in range(2):
+        mask = np.repeat(best, group)
+        rotation, translation = fit_rigid(src[mask], dst[mask], with_scale)
+
+        residuals = get_residuals(rotation, translation, src, dst)
+        inliers = np.all(residuals.reshape(groups, group) < threshold, axis=1)
+        if np.sum(inliers) < sample_size:
+            break
+        best = inliers
+
+    return rotation, translation, best
+
+
+class IncrementalRegistration(object):
+    """
+    Registration updated as frames stream in
+
+    The first `warmup` frames are buffered and registered with RANSAC, after
+    that every frame whose points are within `threshold` of the current
+    estimate is added to running sums, from which the alignment is solved
+    again in constant time.
+    """
+
+    def __init__(self, marker_size=0.071, threshold=0.01, warmup=10,
+                 iterations=256, with_scale=False):
+        self.points = get_marker_points(marker_size)
+        self.threshold = threshold
+        self.warmup = warmup
+        self.iterations = iterations
+        self.with_scale = with_scale
+
+        self.buffer = list()
+        self.sums = None
+        self.transform = None
+        self.frames = 0
+        self.inliers = 0
+
+    def add_points(self, src, dst):
+        """Add the correspondences of a frame, returns True if inlier"""
+        self.frames += 1
+
+        if self.transform is None:
+            self.buffer.append((src, dst))
+            if len(self.buffer) >= self.warmup:
+                self.initialize()
+            return True
+
+        residuals = get_residuals(self.transform.rotation,
+                                  self.transform.translation,
+                                  src, dst)
+        if np.any(residuals >= self.threshold):
+            return False
+
+        self.inliers += 1
+        self.sums = [a + b for a, b in zip(self.sums, get_sums(src, dst))]
+        self.solve()
+
+        return True
+
+    def add_frame(self, base_a, base_b):
+        """Add a pair of frames given the shared base of each device"""
+        return self.add_points(base_a.apply(self.points),
+                               base_b.apply(self.points))
+
+    def initialize(self):
+        src = np.concatenate([src for src, dst in self.buffer])
+        dst = np.concatenate([dst for src, dst in self.buffer])
+        group = len(self.buffer[0][0])
+
+        rotation, translation, inliers = ransac_rigid(src, dst,
+                                                      self.threshold,
+                                                      self.iterations,
+                                                      group,
+                                                      self.with_scale)
+        mask = np.repeat(inliers, group)
+
+        self.inliers = int(np.sum(inliers))
+        self.sums = list(get_sums(src[mask], dst[mask]))
+        self.buffer = list()
+        self.solve()
+
+    def solve(self):
+        count, sum_src, sum_dst, sum_cross, sum_sq = self.sums
+
+        rotation, translation, scale = solve_rigid(
+            count, sum_src, sum_dst, sum_cross,
+            sum_sq if self.with_scale else None)
+
+        self.transform = Transform.from_rotation(rotation * scale[..., None,
+                                                                  None],
+                                                 translation)
+        self.transform.rigid = not self.with_scale
+
+    def finish(self):
+        """Register the buffered frames if there were fewer than warmup"""
+        if self.transform is None and self.buffer:
+            self.initialize()
+
+        return self.transform
+
+
+def get_frame_order(frame):
+    if frame.isdigit():
+        return 0, int(frame), frame
+    return 1, 0, frame
+
+
+def register_devices(log_a, log_b, sync_path, marker_size=0.071,
+                     threshold=0.01, iterations=256, out_path=None,
+                     stream=False):
+    """
+    Register the world coordinates systems of two devices from their logs
+
+    The frames are paired by the sync file, see load_sync. With `stream` the
+    pairs are fed in the frame order of the first device to an
+    IncrementalRegistration instead of registering them all at once.
+    Returns the JSON content holding the transform mapping points of the
+    first device world system to the second one, None if no pair of frames
+    has a shared base on both devices.
+    """
+    bases_a = load_shared_bases(log_a)
+    bases_b = load_shared_bases(log_b)
+
+    frames, src, dst = get_correspondences(bases_a, bases_b,
+                                           load_sync(sync_path), marker_size)
+
+    logging.info('{} pairs of frames with a shared base, {} '
+                 'correspondences'.format(len(frames), len(src)))
+
+    if not frames:
+        return None
+
+    group = len(get_marker_points())
+    start = time.perf_counter()
+
+    if stream:
+        registration = IncrementalRegistration(marker_size, threshold,
+                                               iterations=iterations)
+        for frame_a, frame_b in sorted(frames,
+                                       key=lambda pair: get_frame_order(
+                                           pair[0])):
+            registration.add_frame(bases_a[frame_a], bases_b[frame_b])
+        transform = registration.finish()
+        rotation = transform.rotation
+        translation = transform.translation
+    else:
+        rotation, translation, inliers = ransac_rigid(src, dst, threshold,
+                                                      iterations, group)
+        transform = Transform.from_rotation(rotation, translation)
+
+    elapsed = time.perf_counter() - start
+
+    residuals = get_residuals(rotation, translation, src, dst)
+    inliers = np.all(residuals.reshape(-1, group) < threshold, axis=1)
+    residuals = residuals[np.repeat(inliers, group)]
+
+    json_content = {'a_to_b': transform.tolist(),
+                    'b_to_a': transform.inverse.tolist(),
+                    'frames': len(frames),
+                    'inlier_frames': [list(frame) for frame, inlier
+                                      in zip(frames, inliers) if inlier],
+                    'rms_error': (float(np.sqrt(np.mean(residuals ** 2)))
+                                  if len(residuals) else None)}
+
+    logging.info('{} of {} frames inliers, RMS error {} m in {:.1f} ms'
+                 .format(int(np.sum(inliers)), len(frames),
+                         json_content['rms_error'], elapsed * 1000))
+
+    if out_path:
+        with open(out_path, 'w') as outfile:
+            json.dump(json_content, outfile, indent=4)
+
+    return json_content
+
+
+def benchmark_registration(count=50000, outliers=0.3, noise=0.002, seed=0):
+    """
+    Register synthetic correspondences with a known transform
+
+    Returns 0 if both the batch and the incremental registration recover
+    the transform.
+    """
+    rng = np.random.default_rng(seed)
+
+    rvec = rng.normal(size=3)
+    truth = Transform.from_pose(rvec, rng.normal(size=3))
+
+    group = len(get_marker_points())
+    frames = count // group
+
+    # Marker poses around the first device
+    points = get_marker_points()
+    src = np.concatenate([
+        Transform.from_pose(rng.normal(size=3),
+                            rng.uniform(-1, 1, 3) + [0, 0, 2]).apply(points)
+        for i in range(frames)])
+    dst = truth.apply(src) + rng.normal(scale=noise, size=src.shape)
+
+    bad = rng.random(frames) < outliers
+    dst[np.repeat(bad, group)] += rng.normal(scale=0.5,
+                                             size=(np.sum(bad) * group, 3))
+
+    start = time.perf_counter()
+    rotation, translation, inliers = ransac_rigid(src, dst, 5 * noise,
+                                                  group=group)
+    batch_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    registration = IncrementalRegistration(threshold=5 * noise)
+    for i in range(frames):
+        rows = slice(i * group, (i + 1) * group)
+        registration.add_points(src[rows], dst[rows])
+    incremental = registration.finish()
+    incremental_time = time.perf_counter() - start
+
+    failed = 0
+    for name, rot, trans, elapsed in (
+            ('Batch', rotation, translation, batch_time),
+            ('Incremental', incremental.rotation, incremental.translation,
+             incremental_time)):
+        angle = np.degrees(np.arccos(np.clip(
+            (np.trace(np.matmul(rot.T, truth.rotation)) - 1) / 2, -1, 1)))
+        distance = np.linalg.norm(trans - truth.translation)
+
+        print('{:12} {} correspondences in {:7.1f} ms, error {:.5f} m '
+              '{:.4f} deg'.format(name, frames * group, elapsed * 1000,
+                                  distance, angle))
+
+        if distance > noise or angle > 0.1:
+            failed += 1
+
+    missed = np.sum(inliers & bad) + np.sum(~inliers & ~bad)
+    print('Outlier frames {} of {}, misclassified {}'.format(
+        np.sum(bad), frames, missed))
+
+    if failed:
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    myargs = getopts(argv)
+    marker_size = 0.071
+    threshold = 0.01
+    iterations = 256
+    out_path = None
+    stream = False
+
+    if '-v' in myargs:
+        logging.basicConfig(level=logging.INFO)
+
+    if '--benchmark' in myargs:
+        count = 50000
+        if myargs['--benchmark'] is not True:
+            count = int(myargs['--benchmark'])
+        exit(benchmark_registration(count))
+
+    if '-a' in myargs and '-b' in myargs:
+        log_a = myargs['-a']
+        log_b = myargs['-b']
+    else:
+        logging.error('The logs of two devices are needed')
+        exit(-1)
+
+    if '-s' in myargs:
+        sync_path = myargs['-s']
+    else:
+        logging.error('No sync file provided')
+        exit(-1)
+
+    if '-m' in myargs:
+        marker_size = float(myargs['-m'])
+
+    if '-t' in myargs:
+        threshold = float(myargs['-t'])
+
+    if '-n' in myargs:
+        iterations = int(myargs['-n'])
+
+    if '-o' in myargs:
+        out_path = myargs['-o']
+
+    if '--stream' in myargs:
+        stream = True
+
+    json_content = register_devices(log_a, log_b, sync_path, marker_size,
+                                    threshold, iterations, out_path, stream)
+    if json_content is None:
+        logging.error('No synced frames with a shared base on both devices')
+        exit(-1)
+
+    print(json.dumps(json_content['a_to_b']))
+    exit(0)
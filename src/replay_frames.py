@@ -0,0 +1,171 @@
+# Copyright 2018 Pedro Cuadra - pjcuadra@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from dataset_manifest import refresh_manifest, supported_img
+from pose_service import get_percentiles
+from options import getopts
+from sys import argv
+import asyncio
+import json
+import logging
+import os
+import time
+
+
+def load_frames(in_path):
+    """Read the encoded images of a data set, sorted by name"""
+    manifest = refresh_manifest(in_path, save=False)
+    frames = list()
+
+    for filename in sorted(manifest):
+        if manifest[filename]['type'] not in supported_img:
+            continue
+
+        with open(os.path.join(in_path, filename), 'rb') as f:
+            frames.append(f.read())
+
+    return frames
+
+
+async def http_request(reader, writer, method, target, body=b''):
+    """Send a request on a keep alive connection, get (status, content)"""
+    head = '{} {} HTTP/1.1\r\nHost: shared-coords\r\n' \
+           'Content-Length: {}\r\n\r\n'.format(method, target, len(body))
+    writer.write(head.encode() + body)
+    await writer.drain()
+
+    status_line = await reader.readline()
+    status = int(status_line.split()[1])
+    size = 0
+
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+
+        key, _, value = line.decode('latin-1').partition(':')
+        if key.strip().lower() == 'content-length':
+            size = int(value)
+
+    content = json.loads((await reader.readexactly(size)).decode())
+
+    return status, content
+
+
+async def replay_client(host, port, client, camera, frames, count, rate,
+                        stats):
+    """Send `count` frames as one headset, at most `rate` frames/s"""
+    reader, writer = await asyncio.open_connection(host, port)
+    target = '/pose?client={}&camera={}'.format(client, camera)
+    interval = 1.0 / rate if rate else 0
+
+    try:
+        for i in range(count):
+            start = time.perf_counter()
+            status, content = await http_request(reader,
+                                                 writer,
+                                                 'POST',
+                                                 target,
+                                                 frames[i % len(frames)])
+            elapsed = time.perf_counter() - start
+
+            if status == 200:
+                stats['latencies'].append(elapsed)
+            elif status == 503:
+                stats['rejected'] += 1
+            else:
+                stats['errors'] += 1
+                logging.warning('{}: {} {}'.format(client, status, content))
+
+            if interval > elapsed:
+                await asyncio.sleep(interval - elapsed)
+    finally:
+        writer.close()
+
+
+async def replay(host, port, frames, clients=4, count=100, rate=0,
+                 camera='default'):
+    stats = {'latencies': list(), 'rejected': 0, 'errors': 0}
+
+    start = time.perf_counter()
+    await asyncio.gather(*[replay_client(host,
+                                         port,
+                                         'headset{}'.format(i),
+                                         camera,
+                                         frames,
+                                         count,
+                                         rate,
+                                         stats)
+                           for i in range(clients)])
+    elapsed = time.perf_counter() - start
+
+    reader, writer = await asyncio.open_connection(host, port)
+    _, metrics = await http_request(reader, writer, 'GET', '/metrics')
+    writer.close()
+
+    return stats, elapsed, metrics
+
+
+if __name__ == '__main__':
+    myargs = getopts(argv)
+    host = '127.0.0.1'
+    port = 8080
+    clients = 4
+    count = 100
+    rate = 0
+    camera = 'default'
+
+    if '-v' in myargs:
+        logging.basicConfig(level=logging.INFO)
+
+    if '-i' in myargs:
+        in_path = myargs['-i']
+    else:
+        logging.error('No input path provided')
+        exit(-1)
+
+    if '-H' in myargs:
+        host = myargs['-H']
+
+    if '-P' in myargs:
+        port = int(myargs['-P'])
+
+    if '-n' in myargs:
+        clients = int(myargs['-n'])
+
+    if '-f' in myargs:
+        count = int(myargs['-f'])
+
+    if '-r' in myargs:
+        rate = float(myargs['-r'])
+
+    if '-c' in myargs:
+        camera = myargs['-c']
+
+    frames = load_frames(in_path)
+    if not frames:
+        logging.error('No images found at ' + in_path)
+        exit(-1)
+
+    stats, elapsed, metrics = asyncio.run(replay(host, port, frames, clients,
+                                                 count, rate, camera))
+
+    done = len(stats['latencies'])
+    print('{} clients, {} frames in {:.2f} s, {:.1f} frames/s'.format(
+        clients, done, elapsed, done / elapsed))
+    print('{} rejected, {} errors'.format(stats['rejected'], stats['errors']))
+    print('Client latency {}'.format(json.dumps(
+        get_percentiles(stats['latencies']))))
+    print('Server metrics {}'.format(json.dumps(metrics, indent=4)))
+
+    exit(0)
@@ -11,8 +11,9 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from options import getopts
 from sys import argv
-from shutil import copyfile
+from file_mover import FileMover, link_modes
 import logging
 import json
 import os
@@ -23,26 +24,10 @@ detected_obj = dict()
 
 supported_img = ["jpeg", "png"]
 
+manifest_file = "manifest.json"
 
-def getopts(argv):
-    """Parse the command line options"""
-    opts = {}  # Empty dictionary to store key-value pairs.
-    while argv:  # While there are arguments left to parse...
-        if argv[0][0] is '-':  # Found a "-name value" pair.
-            if len(argv) > 1:
-                if argv[1][0] != '-':
-                    opts[argv[0]] = argv[1]
-                else:
-                    opts[argv[0]] = True
-            elif len(argv) == 1:
-                opts[argv[0]] = True
 
-        # Reduce the argument list by copying it starting from index 1.
-        argv = argv[1:]
-    return opts
-
-
-def copy_augmented_images(pic_name, in_path, position_path):
+def copy_augmented_images(pic_name, in_path, position_path, mover):
     """Copy Augmented Images to destination path"""
     new_filename, _ = os.path.splitext(pic_name)
     new_filename += "_augmented.jpg"
@@ -50,91 +35,117 @@ def copy_augmented_images(pic_name, in_path, position_path):
     src_aug_path_full = os.path.join(in_path, 'augmented', new_filename)
     dst_aug_path_full = os.path.join(aug_path, new_filename)
 
-    if not os.path.exists(aug_path):
-        os.makedirs(aug_path)
-
-    copyfile(src_aug_path_full, dst_aug_path_full)
+    mover.add(src_aug_path_full, dst_aug_path_full)
 
 
 def copy_sub_coords_files(pic_name, in_path, position_path, sub_dir,
-                          file_append):
+                          file_append, mover):
     new_filename, _ = os.path.splitext(pic_name)
     new_filename += file_append
     coords_path = os.path.join(position_path, sub_dir)
     src_coords_path_full = os.path.join(in_path, sub_dir, new_filename)
     dst_coords_path_full = os.path.join(coords_path, new_filename)
 
-    if not os.path.exists(coords_path):
-        os.makedirs(coords_path)
-
-    copyfile(src_coords_path_full, dst_coords_path_full)
+    mover.add(src_coords_path_full, dst_coords_path_full)
 
 
-def copy_hl_coords_files(pic_name, in_path, position_path):
+def copy_hl_coords_files(pic_name, in_path, position_path, mover):
     copy_sub_coords_files(pic_name,
                           in_path,
                           position_path,
                           'hl_dl',
-                          '_camera.json')
+                          '_camera.json',
+                          mover)
 
 
-def copy_hl_rc_coords_files(pic_name, in_path, position_path):
+def copy_hl_rc_coords_files(pic_name, in_path, position_path, mover):
     copy_sub_coords_files(pic_name,
                           in_path,
                           position_path,
                           'hl_rc',
-                          '_dl_coords.json')
+                          '_dl_coords.json',
+                          mover)
+
+
+def copy_shared_coords_file(in_path, position_path, mover):
+    """Copy the shared coordinates file once per position"""
     src_coords_path_full = os.path.join(in_path,
+                                        'coords',
                                         'hl_rc',
                                         'shared_coords.json')
     dst_coords_path_full = os.path.join(position_path,
+                                        'coords',
                                         'hl_rc',
                                         'shared_coords.json')
-    copyfile(src_coords_path_full, dst_coords_path_full)
+
+    mover.add(src_coords_path_full, dst_coords_path_full)
 
 
-def copy_marker_coords_files(pic_name, in_path, position_path):
+def copy_marker_coords_files(pic_name, in_path, position_path, mover):
     copy_sub_coords_files(pic_name,
                           in_path,
                           position_path,
                           'marker',
-                          '_camera.json')
+                          '_camera.json',
+                          mover)
     copy_sub_coords_files(pic_name,
                           in_path,
                           position_path,
                           'marker',
-                          '_marker.json')
+                          '_marker.json',
+                          mover)
 
 
-def copy_coords_files(pic_name, in_path, position_path):
+def copy_coords_files(pic_name, in_path, position_path, mover):
 
-    coords_path = os.path.join(position_path, 'coords')
     src_coords_path_full = os.path.join(in_path, 'coords')
-    dst_coords_path_full = os.path.join(coords_path)
-
-    if not os.path.exists(coords_path):
-        os.makedirs(coords_path)
+    dst_coords_path_full = os.path.join(position_path, 'coords')
 
     copy_hl_coords_files(pic_name,
                          src_coords_path_full,
-                         dst_coords_path_full)
+                         dst_coords_path_full,
+                         mover)
     copy_hl_rc_coords_files(pic_name,
                             src_coords_path_full,
-                            dst_coords_path_full)
+                            dst_coords_path_full,
+                            mover)
     copy_marker_coords_files(pic_name,
                              src_coords_path_full,
-                             dst_coords_path_full)
+                             dst_coords_path_full,
+                             mover)
+
 
+def write_manifest(pics, in_path, position_path):
+    """
+    Write a manifest describing the position instead of copying its data
 
-def separate_by_position(json_info, in_path, out_path):
+    The manifest points back to the input data set so that `calc_stats.py`
+    can read the coordinates files of the position in place.
+    """
+    manifest = dict()
+    manifest['source'] = os.path.abspath(in_path)
+    manifest['pictures'] = pics
+
+    file_path = os.path.join(position_path, manifest_file)
+    with open(file_path, 'w') as outfile:
+        json.dump(manifest, outfile, indent=4)
+
+
+def separate_by_position(json_info, in_path, out_path, link=None,
+                         manifest=False, workers=8):
     """
     Go thru the JSON separation file and separates the data as specified
+
+    Files are copied unless `link` is one of `link_modes`. If `manifest` is
+    set only a manifest file is written for each position. The files are
+    placed by `workers` concurrent threads.
     """
 
     with open(json_info) as f:
         json_data = f.read()
 
     data = json.loads(json_data)
+    mover = FileMover(link, workers)
 
     for key, value in data.items():
 
@@ -143,39 +154,30 @@ def separate_by_position(json_info, in_path, out_path):
         if not os.path.exists(out_path_full):
             os.makedirs(out_path_full)
 
+        if manifest:
+            write_manifest(value, in_path, out_path_full)
+            continue
+
         for pic in value:
 
             filename, _ = os.path.splitext(pic)
 
-            # Copy the image
-            src_path_full = os.path.join(in_path, pic)
-            dst_path_full = os.path.join(out_path_full, pic)
-            copyfile(src_path_full, dst_path_full)
-
-            # Copy detection file
-            tmp_filename = filename + "_detection.txt"
-
-            src_path_full = os.path.join(in_path, tmp_filename)
-            dst_path_full = os.path.join(out_path_full, tmp_filename)
-            copyfile(src_path_full, dst_path_full)
-
-            # Copy json file
-            tmp_filename = filename + ".json"
+            # Copy the image, detection, json and answer json files
+            for tmp_filename in [pic,
+                                 filename + "_detection.txt",
+                                 filename + ".json",
+                                 filename + "_answer.json"]:
+                src_path_full = os.path.join(in_path, tmp_filename)
+                dst_path_full = os.path.join(out_path_full, tmp_filename)
+                mover.add(src_path_full, dst_path_full)
 
-            src_path_full = os.path.join(in_path, tmp_filename)
-            dst_path_full = os.path.join(out_path_full, tmp_filename)
-            copyfile(src_path_full, dst_path_full)
-
-            # Copy answer json file
-            tmp_filename = filename + "_answer.json"
+            # Augmented images
+            copy_augmented_images(pic, in_path, out_path_full, mover)
+            copy_coords_files(pic, in_path, out_path_full, mover)
 
-            src_path_full = os.path.join(in_path, tmp_filename)
-            dst_path_full = os.path.join(out_path_full, tmp_filename)
-            copyfile(src_path_full, dst_path_full)
+        copy_shared_coords_file(in_path, out_path_full, mover)
 
-            # Augmented images
-            copy_augmented_images(pic, in_path, out_path_full)
-            copy_coords_files(pic, in_path, out_path_full)
+    mover.run()
 
     return 0
 
@@ -185,6 +187,9 @@ if __name__ == '__main__':
     out_path = None
     in_path = None
     separate_file = None
+    link = None
+    manifest = False
+    workers = 8
 
     if '-v' in myargs:
         logging.basicConfig(level=logging.DEBUG)
@@ -209,5 +214,18 @@ if __name__ == '__main__':
         logging.error('No output directory provided')
         exit(-1)
 
-    ret = separate_by_position(separate_file, in_path, out_path)
+    if '--link' in myargs:
+        link = myargs['--link']
+        if link not in link_modes:
+            logging.error('Unknown link mode ' + str(link))
+            exit(-1)
+
+    if '--manifest' in myargs:
+        manifest = True
+
+    if '-j' in myargs:
+        workers = int(myargs['-j'])
+
+    ret = separate_by_position(separate_file, in_path, out_path, link,
+                               manifest, workers)
     exit(ret)
@@ -0,0 +1,188 @@
+# Copyright 2018 Pedro Cuadra - pjcuadra@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from sys import argv
+import runpy
+import sys
+
+# Single entry point to the scripts of this directory;
+#
+#   python shared_coords.py <command> [options of the command]
+#
+# Only the module of the command is imported, and it's run as if it was
+# called directly, so OpenCV and NumPy are only loaded by the commands that
+# use them. Keep the imports of this module to the few standard library
+# modules above, they add to the start up time of every command.
+
+commands = {
+    'calc_stats': 'Calculate the statistics of a data set',
+    'circles_distance': 'Measure the distance between two circles',
+    'compare_perspective_stats': 'Compare the statistics of two data sets',
+    'create_marker': 'Create a marker image',
+    'create_separation_file': 'Create the separation file of a data set',
+    'dataset_manifest': 'Refresh the manifest of a data set',
+    'detect_circles': 'Detect the circles of an image',
+    'evaluate_presets': 'Evaluate the detector presets',
+    'get_shared_coord': 'Get the shared coordinates of an image',
+    'get_xaxis_image_points': 'Get the x axis image points of an image',
+    'pipeline': 'Run the analysis of one or more data sets',
+    'pose_client': 'Send images to the pose daemon',
+    'pose_daemon': 'Serve marker poses over a UNIX socket',
+    'pose_service': 'Serve marker poses over HTTP',
+    'pose_stream': 'Encode or decode a pose stream',
+    'process_data_set': 'Process the images of a data set',
+    'process_log': 'Process a HoloLens log',
+    'register_devices': 'Register the worlds of two devices from their logs',
+    'replay_frames': 'Replay a data set against the pose service',
+    'separate_by_position': 'Separate a data set by position',
+    'synthetic_log': 'Generate a synthetic HoloLens log',
+    'synthetic_scenes': 'Generate a synthetic marker data set',
+}
+
+importtime_prefix = 'import time:'
+
+
+def print_usage():
+    print('Usage: python shared_coords.py [--importtime [<count>]] '
+          '<command> [options]\n')
+    print('Commands:')
+    for name in sorted(commands):
+        print('  {:<28}{}'.format(name, commands[name]))
+
+
+def get_command(name):
+    """Get the module of a command, dashes are accepted for underscores"""
+    name = name.replace('-', '_')
+
+    if name not in commands:
+        return None
+
+    return name
+
+
+def run_command(name, args):
+    """Run the module of a command as __main__ with the given arguments"""
+    sys.argv = [name + '.py'] + list(args)
+
+    runpy.run_module(name, run_name='__main__', alter_sys=True)
+
+    return 0
+
+
+def parse_importtime(lines):
+    """
+    Parse the output of `python -X importtime`
+
+    Returns a list of (module, self, cumulative, depth) tuples, times in
+    microseconds.
+    """
+    imports = list()
+
+    for line in lines:
+        if not line.startswith(importtime_prefix):
+            continue
+
+        fields = line[len(importtime_prefix):].split('|')
+
+        try:
+            self_us = int(fields[0])
+            cumulative_us = int(fields[1])
+        except ValueError:
+            # Header line
+            continue
+
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+
+        imports.append((name.strip(), self_us, cumulative_us, depth))
+
+    return imports
+
+
+def print_importtime(imports, count=10):
+    """Print the total import time and the slowest top level imports"""
+    top_level = [i for i in imports if i[3] == 0]
+    total = sum(i[2] for i in top_level)
+
+    print('Imported {} modules in {:.1f} ms'.format(len(imports),
+                                                    total / 1000.0),
+          file=sys.stderr)
+
+    print('{:>10} | {:>10} | module'.format('self [ms]', 'cumul [ms]'),
+          file=sys.stderr)
+
+    for name, self_us, cumulative_us, _ in sorted(top_level,
+                                                  key=lambda i: -i[2])[:count]:
+        print('{:>10.1f} | {:>10.1f} | {}'.format(self_us / 1000.0,
+                                                  cumulative_us / 1000.0,
+                                                  name),
+              file=sys.stderr)
+
+
+def run_importtime(name, args, count=10):
+    """
+    Run a command with `-X importtime` and summarize its imports
+
+    The import times are taken from a child interpreter so that the imports
+    of the interpreter start up are accounted too. The rest of the error
+    output of the command is passed through.
+    """
+    # Only imported here, it takes longer to import than the whole module
+    import subprocess
+
+    process = subprocess.Popen([sys.executable, '-X', 'importtime',
+                                __file__, name] + list(args),
+                               stderr=subprocess.PIPE,
+                               universal_newlines=True)
+
+    lines = list()
+    for line in process.stderr:
+        if line.startswith(importtime_prefix):
+            lines.append(line)
+        else:
+            sys.stderr.write(line)
+
+    ret = process.wait()
+
+    print_importtime(parse_importtime(lines), count)
+
+    return ret
+
+
+if __name__ == '__main__':
+    args = argv[1:]
+    importtime = None
+
+    if args and args[0] == '--importtime':
+        importtime = 10
+        args = args[1:]
+
+        if args and args[0].isdigit():
+            importtime = int(args[0])
+            args = args[1:]
+
+    if not args or args[0] in ('-h', '--help'):
+        print_usage()
+        exit(0)
+
+    name = get_command(args[0])
+
+    if name is None:
+        print('Unknown command ' + args[0], file=sys.stderr)
+        print_usage()
+        exit(-1)
+
+    if importtime is not None:
+        exit(run_importtime(name, args[1:], importtime))
+
+    exit(run_command(name, args[1:]))
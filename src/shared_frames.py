@@ -0,0 +1,166 @@
+# Copyright 2018 Pedro Cuadra - pjcuadra@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from multiprocessing import shared_memory
+import logging
+import queue
+import numpy as np
+from frame_source import FrameSource
+
+
+# Shared memory blocks attached by this (worker) process
+attached_blocks = dict()
+
+
+def attach_block(name):
+    """Attach to a shared memory block once per process"""
+    if name in attached_blocks:
+        return attached_blocks[name]
+
+    try:
+        block = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching registers the block again with the
+        # resource tracker, which the pool shares with the owner so it is
+        # harmless as long as it isn't unregistered here
+        block = shared_memory.SharedMemory(name=name)
+
+    attached_blocks[name] = block
+
+    return block
+
+
+def get_frame(frame):
+    """
+    Get the image of a frame handed over by a SharedFrameRing
+
+    The image is a NumPy view on the shared memory, no data is copied.
+    Frames that didn't fit into a slot are handed over as the image itself.
+    """
+    if isinstance(frame, np.ndarray):
+        return frame
+
+    name, offset, shape, dtype = frame
+    block = attach_block(name)
+
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset)
+
+
+class SharedFrameRing(object):
+    """
+    Ring of shared memory slots to hand decoded frames over to processes
+
+    Frames are written once into a free slot and only a small reference to
+    the slot crosses the process boundary. `acquire` blocks while all slots
+    are in use.
+    """
+
+    def __init__(self, slots, slot_size):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.block = shared_memory.SharedMemory(create=True,
+                                                size=slots * slot_size)
+        self.free = queue.Queue()
+
+        for slot in range(slots):
+            self.free.put(slot)
+
+    def acquire(self):
+        return self.free.get()
+
+    def release(self, slot):
+        self.free.put(slot)
+
+    def write(self, slot, image):
+        """Write an image into a slot and get the frame reference to it"""
+        if image.nbytes > self.slot_size:
+            return None
+
+        offset = slot * self.slot_size
+        view = np.ndarray(image.shape,
+                          dtype=image.dtype,
+                          buffer=self.block.buf,
+                          offset=offset)
+        view[...] = image
+
+        return (self.block.name, offset, image.shape, image.dtype.str)
+
+    def close(self):
+        self.block.close()
+        self.block.unlink()
+
+
+def run_frame(worker, frame, path, args):
+    return worker(get_frame(frame), path, *args)
+
+
+def map_frames(worker, paths, args=(), workers=4, slots=None, prefetch=4,
+               decoders=2):
+    """
+    Run `worker(image, path, *args)` for every image in a process pool
+
+    Images are decoded by a FrameSource in this process and handed over to
+    the workers through a SharedFrameRing sized after the first image.
+    Results are yielded in the order of `paths` as (path, result) tuples.
+    `worker` must be a module level function so it can be pickled.
+    """
+    if slots is None:
+        slots = 2 * workers
+
+    ring = None
+    pending = deque()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        try:
+            for path, image in FrameSource(paths, prefetch, decoders):
+                frame = image
+                slot = None
+
+                if image is not None:
+                    if ring is None:
+                        ring = SharedFrameRing(slots, image.nbytes)
+
+                    slot = ring.acquire()
+                    frame = ring.write(slot, image)
+
+                    if frame is None:
+                        logging.debug('{} does not fit a slot'.format(path))
+                        ring.release(slot)
+                        slot = None
+                        frame = image
+
+                future = executor.submit(run_frame, worker, frame, path, args)
+
+                if slot is not None:
+                    future.add_done_callback(
+                        lambda f, slot=slot: ring.release(slot))
+
+                pending.append((path, future))
+
+                while pending and pending[0][1].done():
+                    path, future = pending.popleft()
+                    yield path, future.result()
+
+            while pending:
+                path, future = pending.popleft()
+                yield path, future.result()
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+            executor.shutdown(wait=True)
+
+            if ring is not None:
+                ring.close()
@@ -0,0 +1,532 @@
+# Copyright 2018 Pedro Cuadra - pjcuadra@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from pose_gate import PoseChangeGate, get_matrix_pose, rvec_to_matrix
+from options import getopts
+from sys import argv
+import gzip
+import json
+import logging
+import math
+import time
+import numpy as np
+
+# Synthetic HoloLens logs in the grammar process_log.py parses
+#
+# Every frame starts with the JSON line of the engine and is followed by the
+# data lines of the frame;
+#
+#   {"status": "success", "engine_id": "Sandwich", "frame_id": 1}
+#   _guidancePosReady: True
+#   gazeDirection: (0.1234, -0.5678, 0.8123)
+#   _lettucePos: (0.1234, 0.5678, 1.2345)
+#   lettuceNormal: (0.0000, 1.0000, 0.0000)
+#   New lettuce position: x: 0.1234, y: 0.5678, z: 1.2345
+#   canContinue: True
+#
+# Frames that can continue also hold the shared coordinates; the positions
+# of the ham and bread, the camera and the origin, the shared base and its
+# inverse as rows of space separated values ended by an empty line and the
+# axes of the new coordinate system. The shared base is a Unity matrix, the
+# translation is in the last row. It jitters around an anchor that jumps to
+# a new pose from time to time.
+#
+# Malformed lines, the parser has to skip, can be put between the lines of
+# the frames; empty lines, Unity file name lines, exceptions, errors of the
+# engine, truncated frame starts and garbage.
+#
+# The log only depends on the seed and the settings. The expected output of
+# process_log.parse_log can be written along with it as JSON lines, one per
+# frame in the order they are passed to `on_frame`;
+#
+#   {"frame_id": 1, "data": {...}, "shared": {...}}
+#
+# where "shared" is null unless the shared coordinates are published by the
+# frame. Logs and expected outputs are written gzip compressed if their path
+# ends with `.gz`. The frames are written in batches, so the size of the
+# logs isn't bound by the memory.
+
+frame_start = ('{{"status": "success", "engine_id": "Sandwich", '
+               '"frame_id": {}}}')
+
+default_settings = {'frames': 1000,
+                    'size': None,
+                    'seed': 0,
+                    'first': 1,
+                    'shared': 0.2,
+                    'jump': 0.05,
+                    'jitter': 0.0005,
+                    'noise': 0.0,
+                    'dropped': 0.02}
+
+# Ratio of the frames with each optional data line
+data_line_ratios = {'_guidancePosReady': 0.9,
+                    '_lettucePos': 0.9,
+                    'lettuceNormal': 0.8,
+                    'New lettuce position': 0.5}
+
+malformed_lines = ['',
+                   '(Filename: C:\\buildslave\\unity\\build\\Runtime/Export/'
+                   'Debug.bindings.h Line: 35)',
+                   'NullReferenceException: Object reference not set to an '
+                   'instance of an object',
+                   '{"status": "error", "engine_id": "Sandwich", '
+                   '"message": "timeout"}']
+
+vector_decimals = 4
+matrix_decimals = 5
+
+# Frames generated at a time
+batch_size = 1024
+
+# Random values drawn for each frame and for its shared coordinates
+frame_values = 24
+shared_values = 48
+
+
+def open_text(path, mode='r'):
+    """Open a text file, gzip compressed if its name ends with .gz"""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', compresslevel=6)
+
+    return open(path, mode)
+
+
+def parse_size(size):
+    """Parse a size in bytes with an optional K, M or G suffix"""
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    size = size.strip().upper().rstrip('B')
+
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+
+    return int(size)
+
+
+def format_values(values, decimals=vector_decimals):
+    return ['{:.{}f}'.format(v, decimals) for v in values]
+
+
+def get_vector(values, scale=1.0, unit=False):
+    """Map random values in [0, 1) to a vector in [-scale, scale)"""
+    vector = [(2 * v - 1) * scale for v in values]
+
+    if unit:
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        vector = [v / norm for v in vector]
+
+    return vector
+
+
+def vector_line(key, values, expected):
+    """Get a line in the key: (a, b, c) format and its parsed value"""
+    text = format_values(values)
+    expected[key] = {'x': float(text[0]),
+                     'y': float(text[1]),
+                     'z': float(text[2])}
+
+    return '{}: ({})'.format(key, ', '.join(text))
+
+
+def coords_line(key, values, expected):
+    """Get a line in the key: x: a, y: b, z: c format and its parsed value"""
+    text = format_values(values)
+    expected[key] = {'x': float(text[0]),
+                     'y': float(text[1]),
+                     'z': float(text[2])}
+
+    return '{}: x: {}, y: {}, z: {}'.format(key, *text)
+
+
+def value_line(key, value, expected):
+    expected[key] = value
+
+    return '{}: {}'.format(key, value)
+
+
+def matrix_lines(key, matrix, expected):
+    """Get the lines of a matrix, ended by an empty line, and its value"""
+    rows = [format_values(row, matrix_decimals) for row in matrix]
+    expected[key] = [[float(v) for v in row] for row in rows]
+
+    return [key] + [' '.join(row) for row in rows] + ['']
+
+
+def get_unity_matrix(rotation, translation):
+    """Get the 4x4 matrix of a pose with the translation in the last row"""
+    matrix = np.zeros((4, 4))
+    matrix[:3, :3] = np.transpose(rotation)
+    matrix[3, :3] = translation
+    matrix[3, 3] = 1
+
+    return matrix.tolist()
+
+
+class SharedBase(object):
+    """Pose of the shared coordinates system, an anchor with some jitter"""
+
+    def __init__(self):
+        self.rotation = None
+        self.translation = None
+
+    def jump(self, values):
+        self.rotation = np.array(rvec_to_matrix(get_vector(values[:3],
+                                                           math.pi)))
+        self.translation = np.array(get_vector(values[3:6], 2.0))
+
+    def get_pose(self, values, jitter):
+        """Get the anchor pose moved by up to `jitter` meters"""
+        angle = jitter * 100
+        rotation = np.matmul(self.rotation,
+                             rvec_to_matrix(get_vector(values[:3],
+                                                       math.radians(angle))))
+        translation = self.translation + get_vector(values[3:6], jitter)
+
+        return rotation, translation
+
+
+def get_shared_records(values, shared_base, settings, expected):
+    """
+    Get the shared coordinates lines of a frame
+
+    Lines are grouped in records, nothing may come between the lines of a
+    record.
+    """
+    if shared_base.rotation is None or values[0] < settings['jump']:
+        shared_base.jump(values[1:7])
+
+    rotation, translation = shared_base.get_pose(values[7:13],
+                                                 settings['jitter'])
+
+    records = [[vector_line('_hamPos', get_vector(values[13:16], 2.0),
+                            expected)],
+               [vector_line('hamNormal', get_vector(values[16:19], unit=True),
+                            expected)],
+               [vector_line('_breadPos', get_vector(values[19:22], 2.0),
+                            expected)],
+               [coords_line('Position of ham', get_vector(values[22:25], 2.0),
+                            expected)],
+               [coords_line('Position of bread',
+                            get_vector(values[25:28], 2.0),
+                            expected)],
+               [vector_line('Camera position when taking image',
+                            get_vector(values[28:31], 2.0), expected)],
+               [coords_line('Origin point for shared coordinate system',
+                            translation, expected)]]
+
+    records.append(matrix_lines('Shared base',
+                                get_unity_matrix(rotation, translation),
+                                expected))
+    records.append(matrix_lines('Inverted shared base',
+                                get_unity_matrix(
+                                    np.transpose(rotation),
+                                    -np.matmul(np.transpose(rotation),
+                                               translation)),
+                                expected))
+
+    axes = dict()
+    text = list()
+    for i, axis in enumerate('XYZ'):
+        values = format_values(rotation[:, i])
+        axes[axis] = {'x': float(values[0]),
+                      'y': float(values[1]),
+                      'z': float(values[2])}
+        text.append('{}: ({})'.format(axis, ', '.join(values)))
+
+    expected['New coordinate system'] = axes
+    records.append(['New coordinate system: ' + ', '.join(text)])
+
+    return records
+
+
+def get_malformed_line(values):
+    """Get a line the parser has to skip"""
+    kind = int(values[0] * (len(malformed_lines) + 2))
+
+    if kind < len(malformed_lines):
+        return malformed_lines[kind]
+
+    if kind == len(malformed_lines):
+        # Frame start cut before it can be told apart
+        start = frame_start.format(0)
+        return start[:int(values[1] * len(start) * 0.6)]
+
+    # Hex digits can't spell any keyword
+    length = 1 + int(values[1] * 60)
+    return ('{:013x}'.format(int(values[2] * 2 ** 52)) * 5)[:length]
+
+
+def get_frame_lines(frame_id, values, shared_values, shared_base, settings):
+    """
+    Get the lines of a frame
+
+    Returns the lines along with the data and shared coordinates
+    process_log parses from them.
+    """
+    data = dict()
+    shared = None
+
+    records = [[frame_start.format(frame_id)]]
+
+    if values[1] < data_line_ratios['_guidancePosReady']:
+        records.append([value_line('_guidancePosReady',
+                                   'True' if values[2] < 0.8 else 'False',
+                                   data)])
+
+    records.append([vector_line('gazeDirection',
+                                get_vector(values[3:6], unit=True),
+                                data)])
+
+    if values[6] < data_line_ratios['_lettucePos']:
+        records.append([vector_line('_lettucePos',
+                                    get_vector(values[7:10], 2.0),
+                                    data)])
+
+    if values[10] < data_line_ratios['lettuceNormal']:
+        records.append([vector_line('lettuceNormal',
+                                    get_vector(values[11:14], unit=True),
+                                    data)])
+
+    if values[14] < data_line_ratios['New lettuce position']:
+        records.append([coords_line('New lettuce position',
+                                    get_vector(values[15:18], 2.0),
+                                    data)])
+
+    if shared_values is not None:
+        shared = dict()
+        records.append([value_line('canContinue', 'True', shared)])
+        records += get_shared_records(shared_values, shared_base, settings,
+                                      shared)
+    else:
+        records.append(['canContinue: False'])
+
+    if values[19] < settings['noise']:
+        position = 1 + int(values[20] * len(records))
+        records.insert(position, [get_malformed_line(values[21:24])])
+
+    lines = [line for record in records for line in record]
+
+    return lines, data, shared
+
+
+def generate_log(out_path, settings=None, expected_path=None,
+                 translation_threshold=0.005, rotation_threshold=1.0):
+    """
+    Generate a synthetic log
+
+    The log holds `frames` frames, or as many as make it `size` bytes long
+    if given. The expected output of process_log.parse_log, with the given
+    shared base thresholds, is written to `expected_path` if given. Returns
+    the number of frames and the bytes of the log, uncompressed.
+    """
+    log_settings = dict(default_settings)
+    log_settings.update(settings or dict())
+    settings = log_settings
+
+    rng = np.random.default_rng(settings['seed'])
+    shared_base = SharedBase()
+    gate = PoseChangeGate(translation_threshold, rotation_threshold)
+
+    frame_id = settings['first']
+    frames = 0
+    size = 0
+    start = time.perf_counter()
+
+    log = open_text(out_path, 'w')
+    expected = open_text(expected_path, 'w') if expected_path else None
+
+    # Nothing before the first frame start is parsed
+    header = 'Initialize engine version: 2017.4.1f1 (synthetic log)\n'
+    log.write(header)
+    size += len(header)
+
+    while True:
+        if settings['size'] is None:
+            count = min(batch_size, settings['frames'] - frames)
+        else:
+            count = batch_size if size < settings['size'] else 0
+
+        if count <= 0:
+            break
+
+        values = rng.random((count, frame_values)).tolist()
+        batch_shared = rng.random((count, shared_values)).tolist()
+
+        text = list()
+        for i in range(count):
+            if values[i][0] < settings['dropped']:
+                frame_id += 1
+
+            shared_frame = values[i][18] < settings['shared']
+            lines, data, shared = get_frame_lines(
+                frame_id,
+                values[i],
+                batch_shared[i] if shared_frame else None,
+                shared_base,
+                settings)
+
+            text.append('\n'.join(lines))
+
+            if expected is not None:
+                if shared and not gate.update(*get_matrix_pose(
+                        shared['Shared base'])):
+                    shared = None
+
+                expected.write(json.dumps({'frame_id': frame_id,
+                                           'data': data,
+                                           'shared': shared}) + '\n')
+
+            frame_id += 1
+            frames += 1
+
+            if settings['size'] is not None:
+                size += len(text[-1]) + 1
+                if size >= settings['size']:
+                    break
+
+        text = '\n'.join(text) + '\n'
+        log.write(text)
+
+        if settings['size'] is None:
+            size += len(text)
+
+    # The last line of a log isn't parsed either
+    footer = 'Setting up 1 worker threads for Enlighten.\n'
+    log.write(footer)
+    size += len(footer)
+
+    log.close()
+    if expected is not None:
+        expected.close()
+
+    elapsed = time.perf_counter() - start
+    logging.info('Generated {} frames, {:.1f} MB in {:.2f} s, '
+                 '{:.1f} MB/s'.format(frames, size / 1e6, elapsed,
+                                      size / 1e6 / elapsed))
+
+    return frames, size
+
+
+def check_log(log_path, expected_path, translation_threshold=0.005,
+              rotation_threshold=1.0):
+    """
+    Parse a log and compare it against its expected output
+
+    Returns the number of frames parsed, the frames that differ and the
+    parse time in seconds, None if the log is empty.
+    """
+    import process_log
+
+    expected = open_text(expected_path)
+    result = {'frames': 0, 'mismatches': 0}
+
+    def check_frame(frame_id, data, shared):
+        line = expected.readline()
+        reference = json.loads(line) if line else None
+
+        if (reference is None or reference['frame_id'] != frame_id or
+                reference['data'] != data or reference['shared'] != shared):
+            if result['mismatches'] < 10:
+                logging.error('Frame {} differs from {}'.format(
+                    frame_id, reference and reference['frame_id']))
+            result['mismatches'] += 1
+
+        result['frames'] += 1
+
+    start = time.perf_counter()
+    parsed = process_log.parse_log(log_path, translation_threshold,
+                                   rotation_threshold, check_frame)
+    elapsed = time.perf_counter() - start
+
+    # Frames the parser missed
+    result['mismatches'] += sum(1 for line in expected if line.strip())
+    expected.close()
+
+    if parsed is None:
+        return None
+
+    return result['frames'], result['mismatches'], elapsed
+
+
+if __name__ == '__main__':
+    myargs = getopts(argv)
+    settings = dict()
+    expected_path = None
+    translation_threshold = 0.005
+    rotation_threshold = 1.0
+
+    if '-v' in myargs:
+        logging.basicConfig(level=logging.INFO)
+
+    if '-o' in myargs:
+        out_path = myargs['-o']
+    else:
+        logging.error('No output log provided')
+        exit(-1)
+
+    if '-n' in myargs:
+        settings['frames'] = int(myargs['-n'])
+
+    if '--size' in myargs:
+        settings['size'] = parse_size(myargs['--size'])
+
+    if '-s' in myargs:
+        settings['seed'] = int(myargs['-s'])
+
+    if '--first' in myargs:
+        settings['first'] = int(myargs['--first'])
+
+    if '--shared' in myargs:
+        settings['shared'] = float(myargs['--shared'])
+
+    if '--jump' in myargs:
+        settings['jump'] = float(myargs['--jump'])
+
+    if '--noise' in myargs:
+        settings['noise'] = float(myargs['--noise'])
+
+    if '-e' in myargs:
+        expected_path = myargs['-e']
+
+    if '-t' in myargs:
+        translation_threshold = float(myargs['-t'])
+
+    if '-a' in myargs:
+        rotation_threshold = float(myargs['-a'])
+
+    if '--check' in myargs and expected_path is None:
+        logging.error('No expected output provided')
+        exit(-1)
+
+    if '--check' not in myargs or '-n' in myargs or '--size' in myargs:
+        generate_log(out_path, settings, expected_path,
+                     translation_threshold, rotation_threshold)
+
+    if '--check' in myargs:
+        checked = check_log(out_path, expected_path, translation_threshold,
+                            rotation_threshold)
+
+        if checked is None:
+            logging.error('Empty log ' + out_path)
+            exit(-1)
+
+        frames, mismatches, elapsed = checked
+
+        print('{} frames parsed in {:.2f} s, {:.0f} frames/s, '
+              '{} differ'.format(frames, elapsed, frames / elapsed,
+                                 mismatches))
+
+        if mismatches:
+            exit(-1)
+
+    exit(0)
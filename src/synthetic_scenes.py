@@ -0,0 +1,631 @@
+# Copyright 2018 Pedro Cuadra - pjcuadra@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from concurrent.futures import ProcessPoolExecutor
+from options import getopts
+from sys import argv
+import json
+import logging
+import math
+import os
+import time
+import cv2
+import cv2.aruco as aruco
+import numpy as np
+
+# Synthetic data sets of markers at known poses
+#
+# The markers 23, 66 and 1 lie on a board next to the objects the detection
+# files report. The board coordinates system is the one of marker 23; x to
+# the right, y up and z out of the board. Every frame is seen by the camera
+# of a calibration file from a random pose and rendered with its lens
+# distortion, then blurred, noised and JPEG compressed by random amounts.
+#
+# Each frame is rendered with a single remap; the rays of the distorted
+# pixels, undistorted once per calibration, are intersected with the board.
+# Frames are generated from the seed and their number only, so data sets
+# can be generated in parallel and any frame can be generated again.
+#
+# For every frame `<n>.jpg` the files process_data_set.py reads are written,
+# `<n>_detection.txt` and `<n>_answer.json`, along with the ground truth at
+# `<n>_truth.json`;
+#
+#   {"camera": {"rvec": [...], "tvec": [...]},
+#    "markers": {"23": {"rvec": [...], "tvec": [...], "corners": [...]}},
+#    "objects": {"lettuce": {"board": [...], "camera": [...],
+#                            "pixel": [...], "depth": ...}},
+#    "degradation": {"blur": ..., "noise": ..., "quality": ..., "gain": ...}}
+#
+# where the marker poses map the marker coordinates system to the camera
+# one as aruco.estimatePoseSingleMarkers does. The settings of the data set
+# are written to `scene.json`.
+
+# Marker centers on the board in meters
+marker_positions = {23: (0.0, 0.0),
+                    66: (0.16, 0.0),
+                    1: (-0.16, 0.0)}
+
+# Object centers on the board in meters and their detection class
+object_positions = {'lettuce': (0.0, 0.12),
+                    'ham': (0.12, -0.12),
+                    'bread': (-0.12, -0.12)}
+
+object_classes = {'ham': 3.0,
+                  'lettuce': 4.0,
+                  'bread': 8.0}
+
+object_colors = {'lettuce': (60, 170, 60),
+                 'ham': (120, 120, 220),
+                 'bread': (90, 180, 220)}
+
+object_radius = 0.03
+
+# Board size in meters and its texture resolution in pixels per meter
+board_size = (0.5, 0.4)
+board_resolution = 3000
+
+background = 90
+
+default_settings = {'frames': 100,
+                    'seed': 0,
+                    'marker_size': 0.071,
+                    'distance': (0.45, 0.9),
+                    'tilt': 50.0,
+                    'blur': 1.5,
+                    'noise': 4.0,
+                    'quality': (60, 95),
+                    'gain': (0.7, 1.2),
+                    'distortion': True}
+
+# Tries to find a pose that shows all markers and objects
+max_pose_tries = 100
+
+# Margin in pixels everything must be within the image
+image_margin = 8
+
+# Textures and pixel rays built by this (worker) process
+textures = dict()
+rays = dict()
+
+
+def load_camera(camera):
+    """Get the intrinsics, distortion and image size of a calibration"""
+    fs = cv2.FileStorage(camera, cv2.FILE_STORAGE_READ)
+
+    return (fs.getNode("camera_matrix").mat(),
+            fs.getNode("distortion_coefficients").mat(),
+            (int(fs.getNode("image_width").real()),
+             int(fs.getNode("image_height").real())))
+
+
+def get_board_matrix():
+    """Get the matrix mapping board points to texture pixels"""
+    return np.array([[board_resolution, 0,
+                      board_size[0] * board_resolution / 2],
+                     [0, -board_resolution,
+                      board_size[1] * board_resolution / 2],
+                     [0, 0, 1]])
+
+
+def get_marker_corners(marker_size, position=(0.0, 0.0)):
+    """Get the corners of a marker on the board, in detection order"""
+    half = marker_size / 2
+    x, y = position
+
+    return np.array([[x - half, y + half, 0],
+                     [x + half, y + half, 0],
+                     [x + half, y - half, 0],
+                     [x - half, y - half, 0]])
+
+
+def get_texture(marker_size):
+    """Draw the markers and objects on the board texture"""
+    if marker_size in textures:
+        return textures[marker_size]
+
+    board = get_board_matrix()
+    width = int(round(board_size[0] * board_resolution))
+    height = int(round(board_size[1] * board_resolution))
+    texture = np.full((height, width, 3), 235, np.uint8)
+
+    aruco_dict = aruco.Dictionary_get(aruco.DICT_6X6_250)
+    side = int(round(marker_size * board_resolution))
+    # White border around the markers so they can be told apart from the
+    # objects
+    border = side // 6
+
+    for marker_id, position in marker_positions.items():
+        marker = cv2.aruco.drawMarker(aruco_dict, marker_id, side, 1)
+        x, y = np.matmul(board, (position[0] - marker_size / 2,
+                                 position[1] + marker_size / 2, 1))[:2]
+        x = int(round(x))
+        y = int(round(y))
+
+        texture[y - border:y + side + border,
+                x - border:x + side + border] = 255
+        texture[y:y + side, x:x + side] = marker[:, :, None]
+
+    for name, position in object_positions.items():
+        x, y = np.matmul(board, (position[0], position[1], 1))[:2]
+        cv2.circle(texture,
+                   (int(round(x)), int(round(y))),
+                   int(round(object_radius * board_resolution)),
+                   object_colors[name],
+                   -1,
+                   cv2.LINE_AA)
+
+    textures[marker_size] = texture
+
+    return texture
+
+
+def get_rays(camera, distortion=True):
+    """
+    Get the ray of every pixel of a camera in normalized coordinates
+
+    Returns a 3xN array, the pixels of the distorted image in row order.
+    """
+    key = (camera, distortion)
+
+    if key in rays:
+        return rays[key]
+
+    intrinsics, coefficients, (width, height) = load_camera(camera)
+
+    u, v = np.meshgrid(np.arange(width, dtype=np.float64),
+                       np.arange(height, dtype=np.float64))
+    pixels = np.stack([u.ravel(), v.ravel()], axis=1)
+
+    if not distortion:
+        coefficients = None
+
+    points = cv2.undistortPoints(pixels.reshape(-1, 1, 2),
+                                 intrinsics,
+                                 coefficients).reshape(-1, 2)
+
+    rays[key] = np.vstack([points.T, np.ones(len(points))])
+
+    return rays[key]
+
+
+def look_at(position, target, roll):
+    """Get the board to camera rotation of a camera looking at a point"""
+    forward = target - position
+    forward /= np.linalg.norm(forward)
+
+    # Image rows go down the board y axis when looking straight down
+    down = np.array([0.0, -1.0, 0.0])
+    down -= forward * np.dot(down, forward)
+
+    if np.linalg.norm(down) < 1e-6:
+        # Looking along the board y axis
+        down = np.array([-1.0, 0.0, 0.0])
+        down -= forward * np.dot(down, forward)
+    down /= np.linalg.norm(down)
+
+    right = np.cross(down, forward)
+
+    rotation = np.array([right, down, forward])
+
+    roll_rotation, _ = cv2.Rodrigues(np.array([0.0, 0.0, roll]))
+
+    return np.matmul(roll_rotation, rotation)
+
+
+def sample_pose(rng, settings):
+    """Sample a camera pose looking at the board"""
+    distance = rng.uniform(*settings['distance'])
+    tilt = math.radians(rng.uniform(0, settings['tilt']))
+    azimuth = rng.uniform(0, 2 * math.pi)
+    roll = math.radians(rng.uniform(-20, 20))
+
+    target = np.array([rng.uniform(-0.05, 0.05),
+                       rng.uniform(-0.05, 0.05),
+                       0.0])
+    direction = np.array([math.sin(tilt) * math.cos(azimuth),
+                          math.sin(tilt) * math.sin(azimuth),
+                          math.cos(tilt)])
+    position = target + distance * direction
+
+    rotation = look_at(position, target, roll)
+    translation = -np.matmul(rotation, position)
+
+    return rotation, translation
+
+
+def project(points, rotation, translation, intrinsics, coefficients):
+    rvec, _ = cv2.Rodrigues(rotation)
+    projected, _ = cv2.projectPoints(np.asarray(points, dtype=np.float64),
+                                     rvec,
+                                     translation,
+                                     intrinsics,
+                                     coefficients)
+
+    return projected.reshape(-1, 2)
+
+
+def get_object_outline(position, points=16):
+    angles = np.linspace(0, 2 * math.pi, points, endpoint=False)
+
+    return np.stack([position[0] + object_radius * np.cos(angles),
+                     position[1] + object_radius * np.sin(angles),
+                     np.zeros(points)], axis=1)
+
+
+def get_truth(rotation, translation, intrinsics, coefficients, size,
+              marker_size):
+    """
+    Get the ground truth of a camera pose
+
+    Returns None if any marker or object isn't fully within the image.
+    """
+    width, height = size
+    truth = {'camera': {'rvec': cv2.Rodrigues(rotation)[0].ravel().tolist(),
+                        'tvec': translation.tolist()},
+             'markers': dict(),
+             'objects': dict()}
+
+    def inside(points):
+        return (np.all(points >= image_margin) and
+                np.all(points[:, 0] < width - image_margin) and
+                np.all(points[:, 1] < height - image_margin))
+
+    for marker_id, position in marker_positions.items():
+        corners = project(get_marker_corners(marker_size, position),
+                          rotation, translation, intrinsics, coefficients)
+
+        if not inside(corners):
+            return None
+
+        marker_translation = translation + np.matmul(rotation,
+                                                     (position[0],
+                                                      position[1],
+                                                      0))
+
+        truth['markers'][str(marker_id)] = {
+            'rvec': truth['camera']['rvec'],
+            'tvec': marker_translation.tolist(),
+            'corners': corners.tolist()}
+
+    for name, position in object_positions.items():
+        outline = project(get_object_outline(position),
+                          rotation, translation, intrinsics, coefficients)
+
+        if not inside(outline):
+            return None
+
+        point = np.array([position[0], position[1], 0.0])
+        camera_point = translation + np.matmul(rotation, point)
+        center = project([point], rotation, translation, intrinsics,
+                         coefficients)[0]
+
+        truth['objects'][name] = {
+            'board': point.tolist(),
+            'camera': camera_point.tolist(),
+            'pixel': center.tolist(),
+            'depth': float(np.linalg.norm(camera_point)),
+            'box': outline.min(axis=0).tolist() + outline.max(axis=0).tolist()}
+
+    return truth
+
+
+def render(texture, pixel_rays, size, rotation, translation):
+    """Render the board as seen from a camera pose"""
+    width, height = size
+
+    # The board points along the rays, in texture pixels
+    plane = np.column_stack([rotation[:, 0], rotation[:, 1], translation])
+    mapping = np.matmul(get_board_matrix(), np.linalg.inv(plane))
+    points = np.matmul(mapping, pixel_rays)
+
+    # Rays going away from the board
+    behind = np.matmul(np.linalg.inv(plane), pixel_rays)[2] <= 0
+
+    map_x = (points[0] / points[2]).astype(np.float32)
+    map_y = (points[1] / points[2]).astype(np.float32)
+    map_x[behind] = -1
+    map_y[behind] = -1
+
+    return cv2.remap(texture,
+                     map_x.reshape(height, width),
+                     map_y.reshape(height, width),
+                     cv2.INTER_LINEAR,
+                     borderMode=cv2.BORDER_CONSTANT,
+                     borderValue=(background, background, background))
+
+
+def degrade(image, rng, settings):
+    """Blur, light and noise an image by random amounts"""
+    degradation = {'blur': rng.uniform(0, settings['blur']),
+                   'noise': rng.uniform(0, settings['noise']),
+                   'quality': int(rng.integers(settings['quality'][0],
+                                               settings['quality'][1] + 1)),
+                   'gain': rng.uniform(*settings['gain'])}
+
+    if degradation['blur'] > 0.1:
+        image = cv2.GaussianBlur(image, (0, 0), degradation['blur'])
+
+    image = image.astype(np.float32) * degradation['gain']
+
+    if degradation['noise'] > 0:
+        image += (rng.standard_normal(image.shape, dtype=np.float32) *
+                  degradation['noise'])
+
+    return np.clip(image, 0, 255).astype(np.uint8), degradation
+
+
+def get_frame_rng(seed, index):
+    return np.random.default_rng([seed, index])
+
+
+def generate_frame(index, camera, out_path, settings):
+    """Generate frame `index` of a data set, returns its ground truth"""
+    rng = get_frame_rng(settings['seed'], index)
+    intrinsics, coefficients, size = load_camera(camera)
+
+    if not settings['distortion']:
+        coefficients = np.zeros(5)
+
+    truth = None
+    for i in range(max_pose_tries):
+        rotation, translation = sample_pose(rng, settings)
+        truth = get_truth(rotation, translation, intrinsics, coefficients,
+                          size, settings['marker_size'])
+
+        if truth is not None:
+            break
+
+    if truth is None:
+        logging.warning('No pose showing the whole board for frame {}'.format(
+            index))
+        return None
+
+    image = render(get_texture(settings['marker_size']),
+                   get_rays(camera, settings['distortion']),
+                   size,
+                   rotation,
+                   translation)
+
+    image, truth['degradation'] = degrade(image, rng, settings)
+
+    base = os.path.join(out_path, str(index))
+
+    cv2.imwrite(base + '.jpg', image,
+                [cv2.IMWRITE_JPEG_QUALITY, truth['degradation']['quality']])
+
+    detection = list()
+    answer = {'all_objects': dict()}
+
+    for name, obj in truth['objects'].items():
+        detection.append([int(round(v)) for v in obj['box']] +
+                         [0.9, object_classes[name]])
+        answer['all_objects'][name] = {'x': int(round(obj['pixel'][0])),
+                                       'y': int(round(obj['pixel'][1])),
+                                       'depth': obj['depth']}
+
+    with open(base + '_detection.txt', 'w') as f:
+        json.dump(detection, f)
+
+    with open(base + '_answer.json', 'w') as f:
+        json.dump(answer, f)
+
+    with open(base + '_truth.json', 'w') as f:
+        json.dump(truth, f, indent=4)
+
+    return truth
+
+
+def generate_frames(indices, camera, out_path, settings):
+    """Generate a chunk of frames in a worker process"""
+    return sum(generate_frame(index, camera, out_path, settings) is not None
+               for index in indices)
+
+
+def get_chunks(first, last, size):
+    return [range(start, min(start + size, last + 1))
+            for start in range(first, last + 1, size)]
+
+
+def generate_scenes(camera, out_path, settings=None, workers=1, first=1):
+    """
+    Generate a synthetic data set
+
+    Frames `first` to `first + frames - 1` are generated, by a pool of
+    `workers` processes if more than one. Returns the number of frames
+    written.
+    """
+    scene_settings = dict(default_settings)
+    scene_settings.update(settings or dict())
+    settings = scene_settings
+
+    if not os.path.exists(out_path):
+        os.makedirs(out_path)
+
+    with open(os.path.join(out_path, 'scene.json'), 'w') as f:
+        json.dump({'camera': os.path.abspath(camera),
+                   'first': first,
+                   'settings': settings,
+                   'marker_positions': marker_positions,
+                   'object_positions': object_positions,
+                   'object_radius': object_radius}, f, indent=4)
+
+    last = first + settings['frames'] - 1
+    start = time.perf_counter()
+
+    if workers > 1:
+        chunks = get_chunks(first, last, 32)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            written = sum(executor.map(generate_frames,
+                                       chunks,
+                                       [camera] * len(chunks),
+                                       [out_path] * len(chunks),
+                                       [settings] * len(chunks)))
+    else:
+        written = generate_frames(range(first, last + 1), camera, out_path,
+                                  settings)
+
+    elapsed = time.perf_counter() - start
+    logging.info('Generated {} frames in {:.2f} s, {:.1f} frames/s'.format(
+        written, elapsed, written / elapsed))
+
+    return written
+
+
+class Matrix(object):
+    """Stand in for a calibration file node"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def mat(self):
+        return self.value
+
+
+def check_scenes(in_path, camera, preset='default'):
+    """
+    Detect the markers of a synthetic data set and compare them to the truth
+
+    Returns the number of markers in the truth, the missed ones and the
+    translation and rotation errors of the found ones.
+    """
+    from get_shared_coord import detect_markers_pose
+    from evaluate_presets import get_pose_errors
+
+    fs = cv2.FileStorage(camera, cv2.FILE_STORAGE_READ)
+    intrinsics = fs.getNode("camera_matrix")
+    distortion = fs.getNode("distortion_coefficients")
+
+    with open(os.path.join(in_path, 'scene.json')) as f:
+        settings = json.loads(f.read())['settings']
+
+    marker_size = settings['marker_size']
+
+    if not settings['distortion']:
+        distortion = Matrix(np.zeros((1, 5)))
+
+    total = 0
+    missed = 0
+    translations = list()
+    rotations = list()
+
+    for filename in sorted(os.listdir(in_path)):
+        if not filename.endswith('_truth.json'):
+            continue
+
+        with open(os.path.join(in_path, filename)) as f:
+            truth = json.loads(f.read())
+
+        ids = sorted(truth['markers'])
+        reference = (np.array([[int(i)] for i in ids]),
+                     None,
+                     np.array([[truth['markers'][i]['rvec']] for i in ids]),
+                     np.array([[truth['markers'][i]['tvec']] for i in ids]))
+
+        img_path = os.path.join(in_path,
+                                filename[:-len('_truth.json')] + '.jpg')
+        detection = detect_markers_pose(cv2.imread(img_path),
+                                        intrinsics,
+                                        distortion,
+                                        marker_size,
+                                        preset=preset)
+
+        errors, missed_ids = get_pose_errors(reference, detection)
+
+        total += len(ids)
+        missed += len(missed_ids)
+
+        for _, translation, rotation in errors:
+            translations.append(translation)
+            rotations.append(rotation)
+
+    return total, missed, translations, rotations
+
+
+def parse_range(value, cast=float):
+    low, high = value.split(',')
+    return cast(low), cast(high)
+
+
+if __name__ == '__main__':
+    myargs = getopts(argv)
+    settings = dict()
+    workers = 1
+    first = 1
+
+    if '-v' in myargs:
+        logging.basicConfig(level=logging.INFO)
+
+    if '-c' in myargs:
+        camera = myargs['-c']
+    else:
+        logging.error('No Camera Distortion model provided')
+        exit(-1)
+
+    if '-o' in myargs:
+        out_path = myargs['-o']
+    else:
+        logging.error('No output path provided')
+        exit(-1)
+
+    if '-n' in myargs:
+        settings['frames'] = int(myargs['-n'])
+
+    if '--first' in myargs:
+        first = int(myargs['--first'])
+
+    if '-s' in myargs:
+        settings['seed'] = int(myargs['-s'])
+
+    if '-m' in myargs:
+        settings['marker_size'] = float(myargs['-m'])
+
+    if '-j' in myargs:
+        workers = int(myargs['-j'])
+
+    if '--distance' in myargs:
+        settings['distance'] = parse_range(myargs['--distance'])
+
+    if '--tilt' in myargs:
+        settings['tilt'] = float(myargs['--tilt'])
+
+    if '--blur' in myargs:
+        settings['blur'] = float(myargs['--blur'])
+
+    if '--noise' in myargs:
+        settings['noise'] = float(myargs['--noise'])
+
+    if '--quality' in myargs:
+        settings['quality'] = parse_range(myargs['--quality'], int)
+
+    if '--no-distortion' in myargs:
+        settings['distortion'] = False
+
+    if '--check' not in myargs or '-n' in myargs:
+        generate_scenes(camera, out_path, settings, workers, first)
+
+    if '--check' in myargs:
+        total, missed, translations, rotations = check_scenes(out_path,
+                                                              camera)
+
+        if not translations:
+            logging.error('No marker found')
+            exit(-1)
+
+        print('{} of {} markers found'.format(total - missed, total))
+        print('Translation error mm: median {:.2f} p95 {:.2f}'.format(
+            np.median(translations) * 1000,
+            np.percentile(translations, 95) * 1000))
+        print('Rotation error deg: median {:.3f} p95 {:.3f}'.format(
+            np.median(rotations), np.percentile(rotations, 95)))
+
+    exit(0)
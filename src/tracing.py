@@ -0,0 +1,229 @@
+# Copyright 2018 Pedro Cuadra - pjcuadra@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import os
+import threading
+import time
+
+# Timing of the processing stages
+#
+# Stages are timed with `span` once tracing is enabled, spans of the same
+# thread nest by time. Each process keeps its own events; worker processes
+# hand theirs over with `pop_events` and the parent merges them with
+# `add_events`. The timestamps are taken from time.perf_counter, the
+# monotonic clock of the system, so the events of all processes line up on
+# one time line.
+#
+# The events are kept in the Chrome trace event format, the written traces
+# can be opened with chrome://tracing or https://ui.perfetto.dev
+#
+# Spans cost next to nothing while tracing is disabled, so they can stay in
+# the per frame code paths.
+
+enabled = False
+events = list()
+events_pid = os.getpid()
+thread_names = set()
+events_lock = threading.Lock()
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def is_enabled():
+    return enabled
+
+
+def get_timestamp():
+    """Get the current time in microseconds"""
+    return time.perf_counter() * 1e6
+
+
+class Span(object):
+    """Time the enclosed block as a complete event"""
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = get_timestamp()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = get_timestamp()
+
+        event = {'name': self.name,
+                 'ph': 'X',
+                 'ts': self.start,
+                 'dur': end - self.start,
+                 'pid': os.getpid(),
+                 'tid': threading.get_ident()}
+
+        if self.args:
+            event['args'] = self.args
+
+        add_event(event)
+
+        return False
+
+
+class NoSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+no_span = NoSpan()
+
+
+def span(name, **args):
+    """
+    Get a context manager timing a stage
+
+    `args` are shown along with the event in the trace.
+    """
+    if not enabled:
+        return no_span
+
+    return Span(name, args)
+
+
+def add_event(event):
+    global events, events_pid
+    thread = (event['pid'], event['tid'])
+
+    with events_lock:
+        if event['pid'] != events_pid:
+            # Forked worker, the events of the parent stay with the parent
+            events = list()
+            events_pid = event['pid']
+            thread_names.clear()
+
+        if thread not in thread_names:
+            thread_names.add(thread)
+            events.append({'name': 'thread_name',
+                           'ph': 'M',
+                           'pid': event['pid'],
+                           'tid': event['tid'],
+                           'args': {'name':
+                                    threading.current_thread().name}})
+
+        events.append(event)
+
+
+def add_events(new_events):
+    """Merge the events of another process"""
+    if not new_events:
+        return
+
+    with events_lock:
+        events.extend(new_events)
+
+
+def pop_events():
+    """Get the events recorded so far and forget them"""
+    global events
+
+    with events_lock:
+        popped = events
+        events = list()
+
+    return popped
+
+
+def get_events():
+    return list(events)
+
+
+def write_json(path, content, indent=4):
+    """
+    Write a JSON file as json.dump does
+
+    Serializing the content and writing the file are timed separately.
+    """
+    with span('serialize_json'):
+        data = json.dumps(content, indent=indent)
+
+    with span('write', path=path):
+        with open(path, 'w') as f:
+            f.write(data)
+
+
+def write_trace(path, trace_events=None):
+    """Write events in the Chrome trace event format"""
+    if trace_events is None:
+        trace_events = get_events()
+
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': trace_events,
+                   'displayTimeUnit': 'ms'}, f)
+
+
+def get_percentile(values, percentile):
+    """Get a percentile of sorted values, interpolated as NumPy does"""
+    position = (len(values) - 1) * percentile / 100.0
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def get_timings(trace_events=None, percentiles=(50, 95, 99)):
+    """
+    Get the duration percentiles of each stage in milliseconds
+
+    Returns the count, total and percentiles of the spans by name.
+    """
+    if trace_events is None:
+        trace_events = get_events()
+
+    durations = dict()
+
+    for event in trace_events:
+        if event['ph'] != 'X':
+            continue
+
+        durations.setdefault(event['name'], list()).append(event['dur'] /
+                                                           1000.0)
+
+    timings = dict()
+
+    for name, values in durations.items():
+        values.sort()
+        timings[name] = {'count': len(values), 'total': sum(values)}
+
+        for p in percentiles:
+            timings[name]['p{}'.format(p)] = get_percentile(values, p)
+
+    return timings
+
+
+def print_timings(trace_events=None):
+    """Print the duration percentiles of each stage, slowest first"""
+    timings = get_timings(trace_events)
+
+    print('{:<24}{:>8}{:>12}{:>10}{:>10}{:>10}'.format(
+        'stage', 'count', 'total [ms]', 'p50 [ms]', 'p95 [ms]', 'p99 [ms]'))
+
+    for name, timing in sorted(timings.items(),
+                               key=lambda item: -item[1]['total']):
+        print('{:<24}{:>8}{:>12.1f}{:>10.3f}{:>10.3f}{:>10.3f}'.format(
+            name, timing['count'], timing['total'], timing['p50'],
+            timing['p95'], timing['p99']))
@@ -0,0 +1,143 @@
+# Copyright 2018 Pedro Cuadra - pjcuadra@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import cv2
+import numpy as np
+
+# Transforms between the coordinates systems involved, as 4x4 homogeneous
+# matrices mapping column vectors;
+#
+#  * marker to camera: Given by the rvec and tvec of a detected marker
+#  * camera to marker: Its inverse, the camera pose in the marker system
+#  * shared base: Logged by the HoloLens, maps the shared (marker) system
+#    to the HoloLens world, "Inverted shared base" is its inverse
+#    (`pose_gate.get_matrix_pose` reads both layouts the logs use)
+#
+# Transform(a_to_b) @ Transform(c_to_a) gives the c_to_b transform.
+
+
+class Transform(object):
+    """
+    4x4 homogeneous transform with a cached inverse
+
+    Composition is lazy; the product of the matrices is only computed when
+    the matrix of the composed transform is needed, and its inverse is the
+    reversed composition of the cached inverses.
+    """
+
+    def __init__(self, matrix=None, inverse=None, rigid=False, factors=None):
+        self._matrix = None
+        self._inverse = inverse
+        self.rigid = rigid
+        self.factors = factors
+
+        if matrix is not None:
+            self._matrix = np.asarray(matrix, dtype=np.float64).reshape(4, 4)
+
+    @classmethod
+    def from_rotation(cls, rotation, translation=(0, 0, 0)):
+        """Rigid transform of a 3x3 rotation matrix and a translation"""
+        matrix = np.identity(4)
+        matrix[:3, :3] = rotation
+        matrix[:3, 3] = np.ravel(translation)
+
+        return cls(matrix, rigid=True)
+
+    @classmethod
+    def from_pose(cls, rvec, tvec):
+        """Marker to camera transform of a marker pose"""
+        rotation, _ = cv2.Rodrigues(np.asarray(rvec,
+                                               dtype=np.float64).reshape(3))
+
+        return cls.from_rotation(rotation, tvec)
+
+    @property
+    def matrix(self):
+        if self._matrix is None:
+            matrix = self.factors[0].matrix
+            for factor in self.factors[1:]:
+                matrix = np.matmul(matrix, factor.matrix)
+
+            self._matrix = matrix
+            self.factors = None
+
+        return self._matrix
+
+    @property
+    def inverse(self):
+        if self._inverse is not None:
+            return self._inverse
+
+        if self.factors is not None:
+            inverse = Transform(rigid=self.rigid,
+                                factors=[factor.inverse
+                                         for factor in reversed(self.factors)])
+        elif self.rigid:
+            rotation = self.matrix[:3, :3].T
+            matrix = np.identity(4)
+            matrix[:3, :3] = rotation
+            matrix[:3, 3] = -np.matmul(rotation, self.matrix[:3, 3])
+            inverse = Transform(matrix, rigid=True)
+        else:
+            inverse = Transform(np.linalg.inv(self.matrix))
+
+        inverse._inverse = self
+        self._inverse = inverse
+
+        return inverse
+
+    @property
+    def rotation(self):
+        return self.matrix[:3, :3]
+
+    @property
+    def translation(self):
+        return self.matrix[:3, 3]
+
+    @property
+    def rvec(self):
+        rvec, _ = cv2.Rodrigues(self.rotation)
+        return rvec
+
+    def compose(self, other):
+        """Transform applying `other` first and then this one"""
+        left = self.factors if self.factors is not None else [self]
+        right = other.factors if other.factors is not None else [other]
+
+        return Transform(rigid=self.rigid and other.rigid,
+                         factors=left + right)
+
+    def __matmul__(self, other):
+        return self.compose(other)
+
+    def apply(self, points):
+        """
+        Transform points
+
+        Takes a single point or an (N, 3) array of them and returns the same
+        shape.
+        """
+        points = np.asarray(points, dtype=np.float64)
+        matrix = self.matrix
+
+        return np.matmul(points, matrix[:3, :3].T) + matrix[:3, 3]
+
+    def apply_vectors(self, vectors):
+        """Rotate directions, the translation isn't applied to them"""
+        vectors = np.asarray(vectors, dtype=np.float64)
+
+        return np.matmul(vectors, self.matrix[:3, :3].T)
+
+    def tolist(self):
+        return self.matrix.tolist()
+